@@ -0,0 +1,355 @@
+# File: configindex.py
+# Author: Tyler Jordan
+# Purpose: Searchable index of the newest configuration of every device. Each distinct config line is stored once
+# and indexed by its tokens, so a search reads the few lines that contain the search terms instead of every config.
+
+import os
+import re
+import sys
+import bisect
+import getopt
+import sqlite3
+import threading
+
+from configstore import ConfigStore, config_digest
+
+# Lines looked up in one statement, kept under SQLite's limit on statement parameters
+chunk_size = 500
+
+# Search types
+search_modes = ['contains', 'prefix', 'regex']
+
+
+# The index file kept in the configs folder
+def config_index_file(config_dir):
+    return os.path.join(config_dir, "config_index.sqlite")
+
+# Lines of a config as they are indexed, without trailing spaces or blank lines
+def index_lines(config):
+    lines = []
+    for line in config.splitlines():
+        line = line.rstrip()
+        if line:
+            lines.append(line)
+    return lines
+
+# Split a list into lists of at most chunk_size items
+def chunks(items):
+    items = list(items)
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+class ConfigIndex(object):
+    """ Purpose: SQLite inverted index over the newest configuration of each device.
+
+        - lines: every distinct config line in the fleet, stored once however many devices have it
+        - postings: token -> line, a token is a whitespace separated word of a line
+        - host_lines: the lines of each device's config, in order
+        - configs: digest and save time of the config indexed for each device
+
+    update() is called when a new config is saved, so only the lines that are new to the fleet are tokenized. Safe
+    to share between check worker threads.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.text_factory = str
+        self.create_tables()
+        self.vocab = []
+        self.vocab_generation = None
+
+    def create_tables(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS configs (
+                hostname TEXT PRIMARY KEY,
+                digest TEXT,
+                saved TEXT
+            );
+            CREATE TABLE IF NOT EXISTS lines (
+                id INTEGER PRIMARY KEY,
+                text TEXT UNIQUE NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                token TEXT NOT NULL,
+                line_id INTEGER NOT NULL,
+                PRIMARY KEY (token, line_id)
+            );
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS host_lines (
+                hostname TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                line_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS host_lines_hostname ON host_lines (hostname);
+            CREATE INDEX IF NOT EXISTS host_lines_line_id ON host_lines (line_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+        """)
+        self.conn.commit()
+
+    ###########
+    # CHANGES #
+    ###########
+
+    def update(self, hostname, config, digest=None, saved=''):
+        """ Purpose: Index the newest configuration of a device, replacing the one indexed before.
+
+            :param hostname:    -   Hostname of the device
+            :param config:      -   Text of the configuration
+            :param digest:      -   SHA-256 of the configuration, as kept by the ConfigStore
+            :param saved:       -   Timestamp the configuration was saved
+            :return:            -   True if the index changed, False if this config was already indexed
+        """
+        if isinstance(config, unicode):
+            config = config.encode('utf-8')
+        if digest is None:
+            digest = config_digest(config)
+        lines = index_lines(config)
+        with self.lock:
+            if self.config_info(hostname).get('digest') == digest:
+                return False
+            with self.conn:
+                line_ids = self.add_lines(set(lines))
+                self.conn.execute("DELETE FROM host_lines WHERE hostname = ?", (hostname,))
+                self.conn.executemany("INSERT INTO host_lines (hostname, position, line_id) VALUES (?, ?, ?)",
+                                      [(hostname, position, line_ids[line]) for position, line in enumerate(lines)])
+                self.conn.execute("INSERT OR REPLACE INTO configs (hostname, digest, saved) VALUES (?, ?, ?)",
+                                  (hostname, digest, saved))
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        return True
+
+    def add_lines(self, lines):
+        """ Purpose: Return the id of each line, adding and tokenizing the lines not in the index yet. """
+        line_ids = {}
+        for chunk in chunks(lines):
+            query = "SELECT id, text FROM lines WHERE text IN ({0})".format(",".join("?" * len(chunk)))
+            for line_id, text in self.conn.execute(query, chunk):
+                line_ids[text] = line_id
+        postings = []
+        tokens = set()
+        for line in lines:
+            if line not in line_ids:
+                line_ids[line] = self.conn.execute("INSERT INTO lines (text) VALUES (?)", (line,)).lastrowid
+                line_tokens = set(line.split())
+                postings.extend((token, line_ids[line]) for token in line_tokens)
+                tokens.update(line_tokens)
+        self.conn.executemany("INSERT OR IGNORE INTO postings (token, line_id) VALUES (?, ?)", postings)
+        self.conn.executemany("INSERT OR IGNORE INTO tokens (token) VALUES (?)", [(token,) for token in tokens])
+        return line_ids
+
+    def remove(self, hostname):
+        """ Purpose: Remove a device from the index. """
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM host_lines WHERE hostname = ?", (hostname,))
+                self.conn.execute("DELETE FROM configs WHERE hostname = ?", (hostname,))
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def prune(self):
+        """ Purpose: Remove the lines and tokens no device's config has anymore. """
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM lines WHERE id NOT IN (SELECT line_id FROM host_lines)")
+                self.conn.execute("DELETE FROM postings WHERE line_id NOT IN (SELECT id FROM lines)")
+                self.conn.execute("DELETE FROM tokens WHERE token NOT IN (SELECT token FROM postings)")
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def sync(self, config_dir):
+        """ Purpose: Index every device under the configs folder whose newest config isn't indexed yet, and remove
+        the devices whose folder is gone. Used to build the index the first time and to catch up with changes made
+        outside save_config_file.
+
+            :param config_dir:  -   The configs folder (<site>/<hostname>/...)
+            :return:            -   Number of devices indexed
+        """
+        updated = 0
+        on_disk = set()
+        for site in sorted(os.listdir(config_dir)):
+            site_dir = os.path.join(config_dir, site)
+            if not os.path.isdir(site_dir):
+                continue
+            for hostname in sorted(os.listdir(site_dir)):
+                device_dir = os.path.join(site_dir, hostname)
+                if not os.path.isdir(device_dir):
+                    continue
+                on_disk.add(hostname)
+                revision = ConfigStore(device_dir).newest_revision()
+                if revision:
+                    if self.config_info(hostname).get('digest') != revision['digest']:
+                        config = ConfigStore(device_dir).newest()
+                        updated += self.update(hostname, config, revision['digest'], revision['saved'])
+                    continue
+                # Configs saved before the history existed
+                conf_files = sorted([file for file in os.listdir(device_dir) if file.startswith(hostname) and
+                                     re.search('\d{4}-\d{2}-\d{2}_\d{4}\.conf$', file)],
+                                    key=lambda file: re.search('\d{4}-\d{2}-\d{2}_\d{4}', file).group(0))
+                if conf_files:
+                    with open(os.path.join(device_dir, conf_files[-1]), 'r') as fin:
+                        config = fin.read()
+                    saved = re.search('\d{4}-\d{2}-\d{2}_\d{4}', conf_files[-1]).group(0)
+                    updated += self.update(hostname, config, saved=saved)
+        # Devices removed from the database, or aged out, no longer have a folder
+        for hostname in set(self.hostnames()) - on_disk:
+            self.remove(hostname)
+        self.prune()
+        return updated
+
+    ###########
+    # LOOKUPS #
+    ###########
+
+    def config_info(self, hostname):
+        """ Purpose: Return the digest and save time of the config indexed for a device, empty if there isn't one. """
+        with self.lock:
+            row = self.conn.execute("SELECT digest, saved FROM configs WHERE hostname = ?", (hostname,)).fetchone()
+        if row:
+            return {'digest': row[0], 'saved': row[1]}
+        return {}
+
+    def hostnames(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT hostname FROM configs")]
+
+    def host_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM configs").fetchone()[0]
+
+    def tokens(self):
+        """ Purpose: Return every indexed token, sorted. Kept in memory until the index changes. """
+        with self.lock:
+            generation = self.conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            if generation != self.vocab_generation:
+                self.vocab = [row[0] for row in self.conn.execute("SELECT token FROM tokens ORDER BY token")]
+                self.vocab_generation = generation
+            return self.vocab
+
+    def matching_tokens(self, word, position):
+        """ Purpose: Return the indexed tokens a word of a search could be part of.
+
+            :param word:        -   Word of the search
+            :param position:    -   'only' (the search is one word), 'first', 'last' or 'middle'
+            :return:            -   List of tokens
+        """
+        vocab = self.tokens()
+        start = bisect.bisect_left(vocab, word)
+        if position == 'middle':
+            # Spaces on both sides, it has to be a whole token
+            if start < len(vocab) and vocab[start] == word:
+                return [word]
+            return []
+        if position == 'last':
+            # Spaces before it, so a token that starts with it
+            end = start
+            while end < len(vocab) and vocab[end].startswith(word):
+                end += 1
+            return vocab[start:end]
+        if position == 'first':
+            return [token for token in vocab if token.endswith(word)]
+        return [token for token in vocab if word in token]
+
+    def candidate_lines(self, term):
+        """ Purpose: Return the ids of the lines that contain the most selective word of a search. None means every
+        line is a candidate (a search with no words).
+        """
+        words = term.split()
+        if not words:
+            return None
+        # The longest word is usually the rarest
+        index = max(range(len(words)), key=lambda i: len(words[i]))
+        if len(words) == 1:
+            position = 'only'
+        elif index == 0:
+            position = 'first'
+        elif index == len(words) - 1:
+            position = 'last'
+        else:
+            position = 'middle'
+        line_ids = set()
+        for chunk in chunks(self.matching_tokens(words[index], position)):
+            query = "SELECT line_id FROM postings WHERE token IN ({0})".format(",".join("?" * len(chunk)))
+            line_ids.update(row[0] for row in self.conn.execute(query, chunk))
+        return line_ids
+
+    def search(self, term, mode='contains'):
+        """ Purpose: Find the config lines of every device that match a search.
+
+            :param term:        -   The text (or regex) to search for
+            :param mode:        -   'contains' (the line contains the text), 'prefix' (the line starts with the text)
+                                    or 'regex' (re.search of the line)
+            :return:            -   Dictionary of hostname -> matching lines, in config order
+        """
+        if mode == 'regex':
+            pattern = re.compile(term)
+            matches = lambda text: pattern.search(text)
+        elif mode == 'prefix':
+            matches = lambda text: text.startswith(term)
+        else:
+            matches = lambda text: term in text
+
+        with self.lock:
+            # Narrow down with the token index, then check the text of each candidate line
+            matched = {}
+            line_ids = None
+            if mode != 'regex':
+                line_ids = self.candidate_lines(term)
+            if line_ids is None:
+                for line_id, text in self.conn.execute("SELECT id, text FROM lines"):
+                    if matches(text):
+                        matched[line_id] = text
+            else:
+                for chunk in chunks(line_ids):
+                    query = "SELECT id, text FROM lines WHERE id IN ({0})".format(",".join("?" * len(chunk)))
+                    for line_id, text in self.conn.execute(query, chunk):
+                        if matches(text):
+                            matched[line_id] = text
+
+            # Devices that have the matching lines
+            results = {}
+            for chunk in chunks(matched):
+                query = "SELECT hostname, position, line_id FROM host_lines WHERE line_id IN ({0})".format(
+                    ",".join("?" * len(chunk)))
+                for hostname, position, line_id in self.conn.execute(query, chunk):
+                    results.setdefault(hostname, []).append((position, matched[line_id]))
+        for hostname in results:
+            results[hostname] = [text for position, text in sorted(results[hostname])]
+        return results
+
+    def close(self):
+        self.conn.close()
+
+
+# Build or refresh the index from the command line
+def main(argv):
+    """ Purpose: Command line access to the config index.
+
+        configindex.py -s <configs dir>      Index every device whose newest config isn't indexed yet
+        configindex.py -r <configs dir>      Rebuild the index from scratch
+    """
+    try:
+        opts, args = getopt.getopt(argv, "hs:r:", ["sync=", "rebuild="])
+    except getopt.GetoptError:
+        print "configindex -s <configs dir> | -r <configs dir>"
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print 'SYNTAX: configindex -s <configs dir> | -r <configs dir>'
+            print '  -s : Index the devices whose newest config is not in the index, drop the removed devices.'
+            print '  -r : Delete the index and index every device again.'
+            sys.exit()
+        elif opt in ("-s", "--sync", "-r", "--rebuild"):
+            db_file = config_index_file(arg)
+            if opt in ("-r", "--rebuild") and os.path.exists(db_file):
+                os.remove(db_file)
+            index = ConfigIndex(db_file)
+            print "Indexed {0} devices in {1}".format(index.sync(arg), db_file)
+            index.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+# File: configstore.py
+# Author: Tyler Jordan
+# Purpose: Configuration history for the device_refresh config check. Each device keeps every revision of its
+# configuration in a "snapshots" folder. The newest revision is stored whole, so it is read in one step, and each
+# older revision is stored as a compressed delta against the revision that replaced it.
+
+import os
+import json
+import zlib
+import hashlib
+import difflib
+
+from collections import Counter
+
+# Folder, inside each device's config folder, that holds the snapshots
+snapshot_dir_name = "snapshots"
+
+# Revisions kept per device, the oldest are pruned past this
+max_revisions = 500
+
+
+# SHA-256 of a configuration, used as its address in the store
+def config_digest(config):
+    if isinstance(config, unicode):
+        config = config.encode('utf-8')
+    return hashlib.sha256(config).hexdigest()
+
+# Config text with line endings, trailing spaces and blank lines made uniform
+def normalize_config(config):
+    lines = []
+    for line in config.splitlines():
+        line = line.rstrip()
+        if line:
+            lines.append(line)
+    return "\n".join(lines)
+
+# SHA-256 of the normalized config, equal for two configs that differ only in whitespace
+def config_fingerprint(config):
+    return config_digest(normalize_config(config))
+
+# Write a file so that a crash leaves either the old or the new contents
+def replace_file(path, contents):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as fout:
+        fout.write(contents)
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(path)
+        os.rename(temp_path, path)
+
+# Build the lines of "old" out of ranges copied from "new" and added lines
+def make_delta(new_lines, old_lines):
+    ops = []
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(old_lines[j1:j2])
+    return ops
+
+# Rebuild the lines of "old" from the lines of "new" and a delta from make_delta()
+def apply_delta(new_lines, ops):
+    old_lines = []
+    for op in ops:
+        if len(op) == 2 and isinstance(op[0], int) and isinstance(op[1], int):
+            old_lines.extend(new_lines[op[0]:op[1]])
+        else:
+            old_lines.extend(op)
+    return old_lines
+
+
+###############
+# CONFIG DIFF #
+###############
+
+class ConfigDiff(object):
+    """ Purpose: Differences between two configurations, in difflib.Differ format ("- line" / "+ line"), produced
+    one line at a time.
+
+        - Lines shared at the start and end of both configs are skipped without comparing the rest.
+        - "set" style configs are compared as multisets of statements in linear time. Removed statements come out in
+          the old config's order, then added statements in the new config's order.
+        - If the statements are the same but their order changed (ie. firewall filter terms), or the configs aren't
+          "set" style, the changed region is compared in order with difflib.
+
+    The added and removed counts are kept as the lines are produced, count() runs the diff just to get them.
+    """
+    def __init__(self, old_config, new_config):
+        self.old_lines = old_config.splitlines(True)
+        self.new_lines = new_config.splitlines(True)
+        self.added = 0
+        self.removed = 0
+
+    def __iter__(self):
+        self.added = 0
+        self.removed = 0
+        old_lines, new_lines = self.changed_region()
+        if not old_lines and not new_lines:
+            return
+        if is_set_config(old_lines) and is_set_config(new_lines):
+            changes = self.set_changes(old_lines, new_lines)
+        else:
+            changes = self.ordered_changes(old_lines, new_lines)
+        for line in changes:
+            if line[0] == '-':
+                self.removed += 1
+            else:
+                self.added += 1
+            yield line
+
+    def changed_region(self):
+        """ Purpose: Return the old and new lines left after removing the lines both configs start and end with. """
+        old_lines = self.old_lines
+        new_lines = self.new_lines
+        start = 0
+        limit = min(len(old_lines), len(new_lines))
+        while start < limit and old_lines[start] == new_lines[start]:
+            start += 1
+        old_end = len(old_lines)
+        new_end = len(new_lines)
+        while old_end > start and new_end > start and old_lines[old_end - 1] == new_lines[new_end - 1]:
+            old_end -= 1
+            new_end -= 1
+        return old_lines[start:old_end], new_lines[start:new_end]
+
+    def set_changes(self, old_lines, new_lines):
+        new_counts = Counter(new_lines)
+        found = False
+        for line in old_lines:
+            if new_counts[line] > 0:
+                new_counts[line] -= 1
+            else:
+                found = True
+                yield "- " + line
+        old_counts = Counter(old_lines)
+        for line in new_lines:
+            if old_counts[line] > 0:
+                old_counts[line] -= 1
+            else:
+                found = True
+                yield "+ " + line
+        # Same statements in a different order
+        if not found:
+            for line in self.ordered_changes(old_lines, new_lines):
+                yield line
+
+    def ordered_changes(self, old_lines, new_lines):
+        for line in difflib.Differ().compare(old_lines, new_lines):
+            if line[0] in '-+':
+                yield line
+
+    def count(self):
+        """ Purpose: Run the diff and return (added, removed) without keeping the lines. """
+        for line in self:
+            pass
+        return self.added, self.removed
+
+
+# True if every statement is a Junos "set" style command
+def is_set_config(lines):
+    for line in lines:
+        statement = line.strip()
+        if statement and not statement.startswith(('set ', 'deactivate ', 'delete ', 'protect ', '#')):
+            return False
+    return True
+
+
+class ConfigStore(object):
+    """ Purpose: Content-addressed configuration history for one device.
+
+        - Each distinct configuration is kept once, named by its SHA-256. A device that goes back to an earlier
+          configuration reuses that object.
+        - The newest revision is the only object stored whole (<digest>.z). When a new revision arrives, the previous
+          newest is written as a zlib compressed delta against it (<digest>.delta.z). index.json is switched to the
+          delta before the whole copy is removed, so a crash at any point leaves every revision readable.
+        - Checking a device that hasn't changed only updates the "refreshed" time of the newest revision, no new
+          object is written.
+
+    index.json lists the revisions, oldest first, and the base each delta object is built against:
+        {"revisions": [{"digest": ..., "saved": <time>, "refreshed": <time>, "fingerprint": <normalized digest>,
+                        "commit_marker": <last commit on the device>}, ...],
+         "objects": {<digest>: <base digest, or null if stored whole>}}
+    """
+    def __init__(self, device_dir):
+        self.device_dir = device_dir
+        self.snapshot_dir = os.path.join(device_dir, snapshot_dir_name)
+        self.index_file = os.path.join(self.snapshot_dir, "index.json")
+        self.index = {'revisions': [], 'objects': {}}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as fin:
+                self.index = json.load(fin)
+
+    def save_index(self):
+        replace_file(self.index_file, json.dumps(self.index))
+
+    def object_file(self, digest, delta=False):
+        if delta:
+            return os.path.join(self.snapshot_dir, digest + ".delta.z")
+        return os.path.join(self.snapshot_dir, digest + ".z")
+
+    def write_object(self, digest, data, delta=False):
+        replace_file(self.object_file(digest, delta), zlib.compress(json.dumps(data)))
+
+    def read_object(self, digest):
+        path = self.object_file(digest)
+        # Deltas written before they had their own name are kept in <digest>.z
+        if self.index['objects'].get(digest) is not None and os.path.exists(self.object_file(digest, True)):
+            path = self.object_file(digest, True)
+        with open(path, 'rb') as fin:
+            return json.loads(zlib.decompress(fin.read()))
+
+    def remove_object_file(self, digest, delta=False):
+        try:
+            os.remove(self.object_file(digest, delta))
+        except OSError:
+            pass
+
+    ###########
+    # LOOKUPS #
+    ###########
+
+    def revisions(self):
+        """ Purpose: Return the revision entries, oldest first. """
+        return list(self.index['revisions'])
+
+    def newest_revision(self):
+        """ Purpose: Return the entry of the newest revision, None if nothing is stored. """
+        if self.index['revisions']:
+            return self.index['revisions'][-1]
+        return None
+
+    def newest(self):
+        """ Purpose: Return the text of the newest configuration, None if nothing is stored. """
+        revision = self.newest_revision()
+        if revision:
+            return self.read_object(revision['digest'])['text']
+        return None
+
+    def get(self, digest):
+        """ Purpose: Return the text of any stored configuration by its digest. Deltas are applied back from the
+        newest revision.
+        """
+        chain = []
+        while self.index['objects'][digest] is not None:
+            chain.append(self.read_object(digest)['ops'])
+            digest = self.index['objects'][digest]
+        lines = self.read_object(digest)['text'].splitlines(True)
+        for ops in reversed(chain):
+            lines = apply_delta(lines, ops)
+        return "".join(lines)
+
+    ###########
+    # CHANGES #
+    ###########
+
+    def add(self, config, now, commit_marker=''):
+        """ Purpose: Store a configuration as the newest revision.
+
+            :param config:      -   Text of the configuration ("set" style)
+            :param now:         -   Timestamp of the check (get_now_time() format)
+            :param commit_marker:   -   Last commit seen on the device, if it was asked for
+            :return:            -   True if a new revision was stored, False if it matched the newest revision and
+                                    only the refreshed time was updated
+        """
+        if isinstance(config, str):
+            config = config.decode('utf-8', 'ignore')
+        digest = config_digest(config)
+        newest = self.newest_revision()
+        fingerprint = config_fingerprint(config)
+        if newest and newest['digest'] == digest:
+            self.refresh(now, fingerprint, commit_marker)
+            return False
+        if not os.path.isdir(self.snapshot_dir):
+            os.mkdir(self.snapshot_dir)
+
+        # Write the new newest whole and the previous newest as a delta against it, next to the files the saved index
+        # still uses. Saving the index switches to them in one rename.
+        self.write_object(digest, {'text': config})
+        if newest:
+            old_text = self.read_object(newest['digest'])['text']
+            ops = make_delta(config.splitlines(True), old_text.splitlines(True))
+            self.write_object(newest['digest'], {'ops': ops}, delta=True)
+            self.index['objects'][newest['digest']] = digest
+        self.index['objects'][digest] = None
+        self.index['revisions'].append({'digest': digest, 'saved': now, 'refreshed': now, 'fingerprint': fingerprint,
+                                        'commit_marker': commit_marker})
+        pruned = self.prune()
+        self.save_index()
+
+        # Remove the files the index no longer uses: the previous newest's whole copy, any delta of this config from
+        # before it was returned to, and the pruned objects
+        if newest and newest['digest'] in self.index['objects']:
+            self.remove_object_file(newest['digest'])
+        self.remove_object_file(digest, delta=True)
+        for old_digest in pruned:
+            self.remove_object_file(old_digest)
+            self.remove_object_file(old_digest, delta=True)
+        return True
+
+    def refresh(self, now, fingerprint='', commit_marker=''):
+        """ Purpose: Record that the newest revision was still current at this time, and what it was checked with. """
+        newest = self.newest_revision()
+        if newest:
+            newest['refreshed'] = now
+            if fingerprint:
+                newest['fingerprint'] = fingerprint
+            if commit_marker:
+                newest['commit_marker'] = commit_marker
+            self.save_index()
+
+    def prune(self):
+        """ Purpose: Remove the oldest revisions past max_revisions, and any object nothing refers to anymore, from
+        the index. Returns the digests removed, their files are deleted once the index is saved.
+        """
+        if len(self.index['revisions']) <= max_revisions:
+            return []
+        self.index['revisions'] = self.index['revisions'][-max_revisions:]
+        used = set(revision['digest'] for revision in self.index['revisions'])
+        # Objects that other deltas are built against must stay
+        changed = True
+        while changed:
+            changed = False
+            for digest, base in self.index['objects'].items():
+                if base is not None and digest in used and base not in used:
+                    used.add(base)
+                    changed = True
+        pruned = [digest for digest in self.index['objects'] if digest not in used]
+        for digest in pruned:
+            del self.index['objects'][digest]
+        return pruned
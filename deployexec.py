@@ -0,0 +1,226 @@
+# File: deployexec.py
+# Author: Tyler Jordan
+# Purpose: Runs configuration pushes over a pool of worker processes. The number of devices being pushed at once
+# follows how the pushes are going, and a per-site limit keeps one building from having all its switches commit at
+# the same time. Results are handed back as each device finishes.
+
+import os
+import time
+import errno
+
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.queues import SimpleQueue
+from logsink import CaptureSink, set_sink, write_log
+from utility import getSpecSiteCode
+
+# Devices pushed at once when a run starts, and the limits it can move between
+start_workers = 5
+min_workers = 1
+max_workers = 20
+
+# Devices of one site pushed at once
+site_limit = 5
+
+# Completions the error rate and latency are measured over
+sample_size = 10
+
+# Concurrency is halved when more than this share of the samples failed...
+error_threshold = 0.3
+
+# ...or when the samples took this many times longer than the best window seen
+slow_factor = 2.0
+
+# Seconds a push may run before it is counted as failed and its place given to the next device
+job_timeout = 3600
+
+# Seconds between checks for finished pushes
+poll_interval = 0.2
+
+# The log sink of a worker process, and the queue it reports the jobs it starts on
+worker_sink = None
+started_queue = None
+
+
+# Site (building) a device belongs to, from its hostname, or its /24 when the hostname doesn't have one
+def site_key(ip, hostname=''):
+    if hostname:
+        site = getSpecSiteCode(hostname)
+        if site != "MISC":
+            return site
+    return ip.rsplit('.', 1)[0]
+
+def worker_init(started, initializer=None, initargs=()):
+    """ Purpose: Sets up a worker process. Its log output is captured and sent back with each result, so only the
+    main process writes the logs.
+    """
+    global worker_sink
+    global started_queue
+    started_queue = started
+    worker_sink = CaptureSink()
+    set_sink(worker_sink)
+    if initializer:
+        initializer(*initargs)
+
+def run_job(func, arg, index):
+    """ Purpose: Runs one job in a worker process. The job's index and this process's pid are reported first, so
+    the main process can tell the job was lost if this process dies.
+
+        :return:            -   Tuple of (result, error message or '', captured logs, seconds taken)
+    """
+    started_queue.put((index, os.getpid()))
+    start = time.time()
+    try:
+        result = func(arg)
+        error = ''
+    except Exception as err:
+        result = None
+        error = error_text(err)
+    return result, error, worker_sink.take(), time.time() - start
+
+# Message of an exception, without failing on one that can't be shown as ascii
+def error_text(err):
+    try:
+        return str(err)
+    except Exception:
+        return repr(err)
+
+# True if a process still exists
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class DeployExecutor(object):
+    """ Purpose: Runs a push function over a list of devices in worker processes.
+
+        - At most "window" devices are in progress, and at most site_limit of them from the same site. Waiting
+          devices are started in list order, skipping those whose site is at its limit.
+        - Every completion is a sample of latency and success. When too many recent samples failed, or they took
+          much longer than the best samples so far, the window is halved. After a window's worth of clean
+          completions it grows by one, up to max_workers.
+        - Each device's captured log output is written, then on_result() is called, in the main process as soon as
+          the device finishes.
+        - A push whose result can't be sent back, whose worker process died, or that ran past job_timeout counts as
+          a failed completion, so it never holds its place in the window.
+    """
+    def __init__(self, workers=start_workers, max_workers=max_workers, min_workers=min_workers,
+                 site_limit=site_limit):
+        self.max_workers = max(1, max_workers)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.window = max(self.min_workers, min(workers, self.max_workers))
+        self.site_limit = max(1, site_limit)
+        self.samples = deque(maxlen=sample_size)
+        self.best_latency = None
+        self.clean_runs = 0
+
+    def adapt(self, seconds, failed):
+        """ Purpose: Record a completion and resize the window. """
+        self.samples.append((seconds, failed))
+        if len(self.samples) < self.samples.maxlen:
+            if failed:
+                self.clean_runs = 0
+            return
+        error_rate = sum(1 for sample in self.samples if sample[1]) / float(len(self.samples))
+        latency = sum(sample[0] for sample in self.samples) / len(self.samples)
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if error_rate > error_threshold or latency > self.best_latency * slow_factor:
+            if self.window > self.min_workers:
+                self.window = max(self.min_workers, self.window // 2)
+                print "Concurrency -> {0} (Errors: {1:.0%} | Avg: {2:.0f}s)".format(self.window, error_rate, latency)
+            # Measure again at the new size before changing it again
+            self.samples.clear()
+            self.clean_runs = 0
+        elif failed:
+            self.clean_runs = 0
+        else:
+            self.clean_runs += 1
+            if self.clean_runs >= self.window and self.window < self.max_workers:
+                self.window += 1
+                self.clean_runs = 0
+
+    def run(self, func, jobs, on_result=None, failed=None, initializer=None, initargs=()):
+        """ Purpose: Push to every device and return the results.
+
+            :param func:        -   Module level function run in the worker, called with the job argument
+            :param jobs:        -   List of (site, argument) tuples
+            :param on_result:   -   Called in this process as each device finishes, with (argument, result, error)
+            :param failed:      -   Called with a result, True if the push failed (counted against the window)
+            :param initializer: -   Extra setup for each worker process
+            :return:            -   List of results in job order, None for a job that raised an exception
+        """
+        results = [None] * len(jobs)
+        if not jobs:
+            return results
+        waiting = deque(enumerate(jobs))
+        running = {}            # index -> (AsyncResult, time started)
+        workers = {}            # index -> pid of the worker running it
+        site_counts = {}
+        lost = False            # A job was given up on, its task never leaves the pool
+        started = SimpleQueue()
+        pool = Pool(min(self.max_workers, len(jobs)), initializer=worker_init,
+                    initargs=(started, initializer, initargs))
+        try:
+            while waiting or running:
+                # Start what the window and site limits allow
+                skipped = deque()
+                while waiting and len(running) < self.window:
+                    index, (site, arg) = waiting.popleft()
+                    if site_counts.get(site, 0) >= self.site_limit:
+                        skipped.append((index, (site, arg)))
+                        continue
+                    site_counts[site] = site_counts.get(site, 0) + 1
+                    running[index] = (pool.apply_async(run_job, (func, arg, index)), time.time())
+                skipped.extend(waiting)
+                waiting = skipped
+
+                # Collect the devices that finished, or that will never finish
+                while not started.empty():
+                    index, pid = started.get()
+                    workers[index] = pid
+                finished = []
+                for index, (async_result, start) in running.items():
+                    if async_result.ready():
+                        try:
+                            outcome = async_result.get()
+                        except Exception as err:
+                            outcome = (None, "Result Failed: " + error_text(err), [], time.time() - start)
+                    elif index in workers and not pid_alive(workers[index]):
+                        lost = True
+                        outcome = (None, "Worker Process Died", [], time.time() - start)
+                    elif time.time() - start > job_timeout:
+                        lost = True
+                        outcome = (None, "Timed Out After {0}s".format(job_timeout), [], time.time() - start)
+                    else:
+                        continue
+                    finished.append((index, outcome))
+                if not finished:
+                    time.sleep(poll_interval)
+                    continue
+
+                for index, (result, error, logs, seconds) in finished:
+                    site, arg = jobs[index]
+                    site_counts[site] -= 1
+                    del running[index]
+                    workers.pop(index, None)
+                    results[index] = result
+                    for logfile, statement in logs:
+                        write_log(statement, logfile)
+                    if on_result:
+                        on_result(arg, result, error)
+                    self.adapt(seconds, bool(error) or bool(failed and failed(result)))
+            # The pool waits forever on a job whose worker died, and a push that timed out may still be stuck
+            if lost:
+                pool.terminate()
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return results
@@ -44,13 +44,18 @@ __email__ = "tjordan@juniper.net"
 # Imports:
 import getopt
 import platform
+import sys
+import threading
+import time
 import re
 import jxmlease
 import difflib
 import datetime
 import pprint
 import multiprocessing
+import utility
 
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from lxml import etree
 
@@ -58,6 +63,12 @@ from jnpr.junos import *
 from jnpr.junos.exception import *
 from netaddr import *
 from utility import *
+from devicedb import DeviceStore, FailTracker, JournalLock
+from configstore import ConfigStore, ConfigDiff, config_digest, config_fingerprint, replace_file
+from template_engine import TemplateCompiler
+from configindex import ConfigIndex, config_index_file
+from l2snapshot import L2Snapshot, l2_snapshot_file, collect_snapshot, collect_workers
+from sessions import ConnectionPool, set_default_pool, borrow_device, release_device, device_fact
 
 # Paths
 iplist_dir = ''
@@ -78,6 +89,10 @@ template_ospf = ''
 
 template_regex_csv = ''
 template_map_csv = ''
+template_compiler = None
+config_index = None
+config_stores = {}
+checked_dirs = set()
 iplistfile = ''
 access_error_log = ''
 access_error_list = []
@@ -89,13 +104,14 @@ run_change_log = ''
 run_change_list = []
 failing_devices_csv = ''
 removed_devices_csv = ''
+fail_tracker = None
 
 # Log Keys
 error_key_list = ['ip', 'message', 'error', 'timestamp'] # access_error_log, ops_error_log
 standard_key_list = ['ip', 'message', 'timestamp'] # new_devices_log
 
 # Params
-listDict = []
+listDict = DeviceStore()
 mypwd = ''
 myuser = ''
 alt_myuser = ''
@@ -106,6 +122,16 @@ current_dev = 0
 addl_opt = ''
 detail_ip = ''
 subsetlist = ''
+num_workers = 1
+use_commit_marker = False
+run_template_sweep = False
+run_l2_snapshot = False
+discovery_ports = [830, 22]
+probe_timeout = 2
+sweep_workers = 64
+discover_workers = 10
+checkpoint_interval = 300
+last_checkpoint = 0
 
 # Check Lists
 no_changes_ips = []
@@ -125,6 +151,17 @@ config_change_ips = []
 templ_change_ips = []
 inet_change_ips = []
 
+# Shared lists that check workers collect into their own result, merged by the main thread
+result_list_names = ['access_error_list', 'ops_error_list', 'new_devices_list', 'run_change_list', 'no_changes_ips',
+                     'no_ping_ips', 'no_netconf_ips', 'no_auth_ips', 'no_connect_ips', 'config_save_error_ips',
+                     'config_update_error_ips', 'param_attrib_error_ips', 'inet_error_ips', 'templ_error_ips',
+                     'param_change_ips', 'config_change_ips', 'templ_change_ips', 'inet_change_ips']
+
+# Worker State
+thread_data = threading.local()
+index_lock = threading.Lock()
+store_lock = threading.Lock()
+
 # Key Lists
 dbase_order = [ 'hostname', 'ip', 'version', 'model', 'serialnumber', 'last_access_attempt', 'last_access_success',
                 'last_config_check', 'last_config_change', 'last_param_check', 'last_param_change', 'last_inet_check',
@@ -146,6 +183,7 @@ def detect_env():
     global template_ospf
     global template_regex_csv
     global template_map_csv
+    global template_compiler
     global access_error_log
     global ops_error_log
     global new_devices_log
@@ -182,6 +220,9 @@ def detect_env():
     template_els = os.path.join(dir_path, template_dir, "template_els.conf")
     template_nonels = os.path.join(dir_path, template_dir, "template_nonels.conf")
     template_ospf = os.path.join(dir_path, template_dir, "template_ospf.conf")
+    template_compiler = TemplateCompiler({'all': template_all, 'els': template_els, 'nonels': template_nonels,
+                                          'ospf': template_ospf, 'opt': template_all_opt,
+                                          'regex_csv': template_regex_csv, 'map_csv': template_map_csv})
     access_error_log = os.path.join(log_dir, "Access_Error_Log.csv")
     ops_error_log = os.path.join(log_dir, "Ops_Error_Log.csv")
     new_devices_log = os.path.join(log_dir, "New_Devices_Log.csv")
@@ -191,23 +232,72 @@ def detect_env():
 # -----------------------------------------------------------------
 # FILE OPERATIONS
 # -----------------------------------------------------------------
+def config_store(hostname):
+    """ Purpose: Open the configuration history of a device. Config files saved before the history existed are added
+    to it the first time, oldest first, and only the newest is kept as the device's config file. The history index
+    is the device's manifest of its config files, it is read once per run and kept current as configs are saved.
+
+        :param hostname:    -   Hostname of the device
+        :return:            -   ConfigStore of the device
+    """
+    device_dir = os.path.join(config_dir, getSiteCode(hostname), hostname)
+    with store_lock:
+        store = config_stores.get(device_dir)
+    if store:
+        return store
+    store = ConfigStore(device_dir)
+    if not store.newest_revision() and os.path.isdir(device_dir):
+        old_files = [os.path.join(device_dir, file) for file in listdir(device_dir)
+                     if file.startswith(hostname) and file.endswith(".conf")]
+        old_files.sort(key=os.path.getctime)
+        for old_file in old_files:
+            file_time = re.search('\d{4}-\d{2}-\d{2}_\d{4}', old_file)
+            if file_time:
+                saved = file_time.group(0)
+            else:
+                saved = get_now_time()
+            with open(old_file, 'r') as fin:
+                store.add(fin.read(), saved)
+        for old_file in old_files[:-1]:
+            os.remove(old_file)
+    with store_lock:
+        config_stores[device_dir] = store
+    return store
+
+def config_filename(hostname, revision):
+    """ Purpose: Returns the path of the config file written for a revision in the config history. """
+    return os.path.join(config_dir, getSiteCode(hostname), hostname, hostname + "_" + revision['saved'] + ".conf")
+
+def get_config_index():
+    """ Purpose: Open the config search index the first time it is needed.
+
+        :return:            -   ConfigIndex shared by all check workers
+    """
+    global config_index
+    with index_lock:
+        if config_index is None:
+            config_index = ConfigIndex(config_index_file(config_dir))
+        return config_index
+
 def get_config_str(hostname, newest):
-    """ Purpose: Load the selected device's configuration file into a variable.
+    """ Purpose: Load the selected device's configuration into a variable.
     
         :param hostname     -   Hostname of the device
-        :param newest:      -   True/False (True means newest, false means oldest file)
+        :param newest:      -   True/False (True means newest, false means oldest revision)
         :return:            -   A string containing the configuration   
     """
-    my_file = get_config_filename(hostname, hostname, newest)
-    #print "File: {0}".format(my_file)
-    if my_file:
-        try:
-            file_string = open(my_file, 'r').read()
-        except Exception as err:
-            print 'ERROR: Unable to read file: {0} | File: {1}'.format(err, my_file)
+    try:
+        store = config_store(hostname)
+        revisions = store.revisions()
+        if not revisions:
             return False
+        elif newest:
+            return store.newest().encode('utf-8')
         else:
-            return file_string
+            return store.get(revisions[0]['digest']).encode('utf-8')
+    except Exception as err:
+        print 'ERROR: Unable to read config history: {0} | Device: {1}'.format(err, hostname)
+        return False
 
 def get_config_filename(hostname, startwith, newest):
     """ Purpose: Returns the oldest or newest config file from specified hostname
@@ -217,6 +307,15 @@ def get_config_filename(hostname, startwith, newest):
         :param newest:      -   True/False (True means newest, false means oldest file)
         :return:            -   A string containing the file with complete path. False   
     """
+    # The config history and template cache know their files, no need to list the directory
+    if startwith == hostname:
+        revision = config_store(hostname).newest_revision()
+        if revision:
+            return config_filename(hostname, revision)
+    elif startwith == "Template_Deviation":
+        cache = load_template_cache(hostname)
+        if cache and cache.get('log_file'):
+            return os.path.join(config_dir, getSiteCode(hostname), hostname, cache['log_file'])
     #print "vars: {0}|{1}|{2}".format(hostname, startwith, newest)
     filtered_list = []
     # Create the appropriate absolute path for the config file
@@ -294,12 +393,23 @@ def remove_template_file(hostname):
     """
     file_start = "Template_Deviation_"
     device_dir = os.path.join(config_dir, getSiteCode(hostname), hostname)
+    # The template cache names the current deviation log, only logs from before the cache need a directory listing
+    cache = load_template_cache(hostname)
+    if cache and cache.get('log_file'):
+        # Pending lines of the log would bring it back once they're written
+        flush_logs(os.path.join(device_dir, cache['log_file']))
+        try:
+            os.remove(os.path.join(device_dir, cache['log_file']))
+        except OSError:
+            pass
+        return True
     # Check if the specified directory exists
     if os.path.exists(device_dir):
         # Loop over the files in the directory
         for file in getFileList(device_dir):
             # Find a file that starts with the "file_start" string
             if file.startswith(file_start):
+                flush_logs(os.path.join(device_dir, file))
                 try:
                     os.remove(os.path.join(device_dir, file))
                     #print "Removed: {0}".format(file)
@@ -329,6 +439,9 @@ def directory_check(record):
         :param record:      -   Dictionary record of the device.
         :return:            -   True/False
     """
+    # Directories already checked during this run
+    if os.path.join(getSiteCode(record['hostname']), record['hostname']) in checked_dirs:
+        return True
     # Check for site specific directory
     #print "Hostname: {0}".format(record['hostname'])
     #print "Site Name: {0}".format(getSiteCode(record['hostname']))
@@ -336,11 +449,14 @@ def directory_check(record):
         try:
             os.mkdir(os.path.join(config_dir, getSiteCode(record['hostname'])))
         except Exception as err:
-            print "Failed Creating Directory -> ERROR: {0}".format(err)
-            return False
+            # Another check worker may have created this site directory first
+            if not os.path.isdir(os.path.join(config_dir, getSiteCode(record['hostname']))):
+                print "Failed Creating Directory -> ERROR: {0}".format(err)
+                return False
 
     # Check for the device specific directory
     if os.path.isdir(os.path.join(config_dir, getSiteCode(record['hostname']), record['hostname'])):
+        checked_dirs.add(os.path.join(getSiteCode(record['hostname']), record['hostname']))
         return True
     else:
         try:
@@ -349,13 +465,16 @@ def directory_check(record):
             print "Failed Creating Directory -> ERROR: {0}".format(err)
             return False
         else:
+            checked_dirs.add(os.path.join(getSiteCode(record['hostname']), record['hostname']))
             return True
 
-def save_config_file(myconfig, record):
-    """ Purpose: Creates a config file and adds text to the file.
+def save_config_file(myconfig, record, commit_marker=''):
+    """ Purpose: Adds the config to the device's config history and writes it to the device's config file. Older
+    revisions are kept in the history, so only the newest config file is kept.
  
         :param myconfig:    -   Text version of the current configuration. ("set" style)
         :param record:      -   Dictionary record of the device.
+        :param commit_marker:   -   Last commit on the device, from fetch_commit_marker()
         :return:            -   True/False
     """
     # Check if the appropriate site directory is created. If not, then create it.
@@ -369,39 +488,49 @@ def save_config_file(myconfig, record):
         filename = record['hostname'] + "_" + now + ".conf"
         fileandpath = os.path.join(site_dir, filename)
         try:
-            newfile = open(fileandpath, "w+")
+            store = config_store(record['hostname'])
+            previous = store.newest_revision()
+            # An unchanged config only refreshes the history, the config file is already current
+            if not store.add(myconfig, now, commit_marker):
+                return True
         except Exception as err:
-            #print 'ERROR: Unable to open file: {0} | File: {1}'.format(err, fileandpath)
-            message = "Unable to open file: " + fileandpath + "."
+            message = "Unable to add config to history: " + site_dir + "."
             contentList = [record['ip'], message, str(err), get_now_time()]
-            ops_error_list.append(dict(zip(error_key_list, contentList)))
+            get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+            print "ERROR: Unable to add config to history: {0} | Device: {1}".format(err, record['hostname'])
             return False
-        else:
-            mydir = os.path.join(config_dir, getSiteCode(record['hostname']), record['hostname'])
-            # Remove excess configurations if necessary
-            if get_file_number(mydir, record['hostname']) > 5:
-                del_file = get_config_filename(record['hostname'], record['hostname'], newest=False)
-                try:
-                    os.remove(del_file)
-                except Exception as err:
-                    message = "Unable to remove config file: " + del_file + "."
-                    contentList = [record['ip'], message, str(err), get_now_time()]
-                    ops_error_list.append(dict(zip(error_key_list, contentList)))
-                    print "ERROR: Unable to remove old file: {0} | File: {1}".format(err, del_file)
-            try:
-                # Write the new configuration to the new file
+        try:
+            # Write the new configuration to the new file
+            with open(fileandpath, "w+") as newfile:
                 newfile.write(myconfig.encode("utf-8"))
-            except Exception as err:
-                #print "ERROR: Unable to write config to file: {0}".format(err)
-                message = "Unable to write config to file: " + fileandpath + "."
-                contentList = [ record['ip'], message, str(err), get_now_time() ]
-                ops_error_list.append(dict(zip(error_key_list, contentList)))
-                print "ERROR: Unable to write config to file: {0} | File: {1}".format(err, del_file)
-                return False
-            else:
-                # Close the file
-                newfile.close()
-                return True
+        except Exception as err:
+            #print "ERROR: Unable to write config to file: {0}".format(err)
+            message = "Unable to write config to file: " + fileandpath + "."
+            contentList = [ record['ip'], message, str(err), get_now_time() ]
+            get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+            print "ERROR: Unable to write config to file: {0} | File: {1}".format(err, fileandpath)
+            return False
+        # Keep the search index current with the newest config
+        try:
+            get_config_index().update(record['hostname'], myconfig, config_digest(myconfig), now)
+        except Exception as err:
+            message = "Unable to update config index."
+            contentList = [record['ip'], message, str(err), get_now_time()]
+            get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+            print "ERROR: Unable to update config index: {0} | Device: {1}".format(err, record['hostname'])
+        # Remove the previous config file, its contents are in the history
+        if previous and config_filename(record['hostname'], previous) != fileandpath:
+            file = config_filename(record['hostname'], previous)
+            try:
+                os.remove(file)
+            except OSError as err:
+                # Already gone (ie. removed by hand)
+                if err.errno != 2:
+                    message = "Unable to remove config file: " + file + "."
+                    contentList = [record['ip'], message, str(err), get_now_time()]
+                    get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+                    print "ERROR: Unable to remove old file: {0} | File: {1}".format(err, file)
+        return True
     # If this is executed, the myconfig variable was empty. Fetch did not work.
     else:
         return False
@@ -437,13 +566,26 @@ def sort_and_save_json(db_list_dict, db_file):
     """
     if db_list_dict:
         stdout.write("Saving -> " + db_file + ": ")
-        if write_to_json(db_list_dict, db_file):
+        if checkpoint_device_db(db_list_dict, db_file):
             print "Successful!"
         else:
             print "Failed!"
     else:
         print "Database list dict not found!"
 
+def periodic_checkpoint():
+    """ Purpose: Save the database and empty its journal once checkpoint_interval seconds have passed since the last
+    save. Only call from the main thread.
+
+    :return: None
+    """
+    global last_checkpoint
+    if time.time() - last_checkpoint >= checkpoint_interval:
+        checkpoint_device_db(listDict, main_list_dict)
+        if fail_tracker:
+            fail_tracker.save()
+        last_checkpoint = time.time()
+
 def sort_and_save():
     """ Purpose: Saves main database and sorts and saves the logs.
     :param: None
@@ -452,6 +594,14 @@ def sort_and_save():
     # Main Database
     sort_and_save_json(listDict, main_list_dict)
 
+    # Failing Devices
+    if fail_tracker and fail_tracker.changed:
+        stdout.write("Saving -> " + failing_devices_csv + ": ")
+        if fail_tracker.save():
+            print "Successful!"
+        else:
+            print "Failed!"
+
     # Access Error Log
     sort_and_save_csv(access_error_log, access_error_list, error_key_list, 3)
 
@@ -472,7 +622,7 @@ def get_vc_fact(dev):
     #
     # Return appropriate value for virutal chassis status
     junos_info = 'UNDEFINED'
-    capt_info = str(dev.facts['junos_info'])
+    capt_info = str(device_fact(dev, 'junos_info'))
     #print "JUNOS_INFO: {0}".format(capt_info)
     if capt_info.count('fpc') > 1:
         junos_info = 'YES'
@@ -489,80 +639,77 @@ def connect(ip, hostname="UNKNOWN", indbase=False, probe=0, timeout=300):
 
     :param ip:          -   IP of the device
     :param indbase:     -   Boolean if this device is in the database or not, defaults to False if not specified
-    :return dev:        -   Returns the device handle if its successfully opened.
+    :return dev:        -   Returns the device handle if its successfully opened. Return it with release_device().
     """
-    dev = Device(host=ip, user=myuser, passwd=mypwd, auto_probe=probe)
     # Try to open a connection to the device
     try:
-        dev.open()
-        dev.timeout = timeout
+        dev = borrow_device(ip, myuser, mypwd, port=port, timeout=timeout, probe=probe)
     # If there is an error when opening the connection, display error and exit upgrade process
     except ConnectRefusedError as err:
         message = "Host Reachable, but NETCONF not configured."
         stdout.write(hostname + " (" + ip + ") | Connect Fail - " + message + "\n")
         if indbase:
             contentList = [ip, message, str(err), get_now_time()]
-            access_error_list.append(dict(zip(error_key_list, contentList)))
+            get_list('access_error_list').append(dict(zip(error_key_list, contentList)))
         else:
             contentList = [ip, message, get_now_time()]
-            new_devices_list.append(dict(zip(standard_key_list, contentList)))
-        no_netconf_ips.append(ip)
+            get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
+        get_list('no_netconf_ips').append(ip)
         return False
     except ConnectAuthError as err:
         message = "Unable to connect with credentials. User:" + myuser
         stdout.write(hostname + " (" + ip + ") | Connect Fail - " + message + "\n")
         if alt_myuser:
             stdout.write("Attempt to connect. User:" + alt_myuser + " |")
-            dev = Device(host=ip, user=alt_myuser, passwd=alt_mypwd)
             try:
-                dev.open()
+                dev = borrow_device(ip, alt_myuser, alt_mypwd, port=port, timeout=timeout)
             except Exception as err:
                 if indbase:
                     contentList = [ip, message, str(err), get_now_time()]
-                    access_error_list.append(dict(zip(error_key_list, contentList)))
+                    get_list('access_error_list').append(dict(zip(error_key_list, contentList)))
                 else:
                     contentList = [ip, message, get_now_time()]
-                    new_devices_list.append(dict(zip(standard_key_list, contentList)))
-                no_auth_ips.append(ip)
+                    get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
+                get_list('no_auth_ips').append(ip)
                 return False
             else:
                 return dev
         else:
             if indbase:
                 contentList = [ip, message, str(err), get_now_time()]
-                access_error_list.append(dict(zip(error_key_list, contentList)))
+                get_list('access_error_list').append(dict(zip(error_key_list, contentList)))
             else:
                 contentList = [ip, message, get_now_time()]
-                new_devices_list.append(dict(zip(standard_key_list, contentList)))
-            no_auth_ips.append(ip)
+                get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
+            get_list('no_auth_ips').append(ip)
             return False
     except ConnectTimeoutError as err:
         message = "Timeout error, possible IP reachability issues."
         stdout.write(hostname + " (" + ip + ") | Connect Fail - " + message + "\n")
         contentList = [ ip, message, str(err), get_now_time() ]
         fail_num = fail_check(ip, indbase, contentList)
-        no_ping_ips.append({'ip': ip, 'days': fail_num})
+        get_list('no_ping_ips').append({'ip': ip, 'days': fail_num})
         return False
     except ProbeError as err:
         message = "Probe timeout, possible IP reachability issues."
         stdout.write(hostname + " (" + ip + ") | Connect Fail - " + message + "\n")
         contentList = [ ip, message, str(err), get_now_time() ]
         fail_num = fail_check(ip, indbase, contentList)
-        no_ping_ips.append({'ip': ip, 'days': fail_num})
+        get_list('no_ping_ips').append({'ip': ip, 'days': fail_num})
         return False
     except ConnectError as err:
         message = "Unknown connection issue."
         stdout.write(hostname + " (" + ip + ") | Connect Fail - " + message + "\n")
         contentList = [ ip, message, str(err), get_now_time() ]
         fail_num = fail_check(ip, indbase, contentList)
-        no_connect_ips.append({'ip': ip, 'days': fail_num})
+        get_list('no_connect_ips').append({'ip': ip, 'days': fail_num})
         return False
     except Exception as err:
         message = "Undefined exception."
         stdout.write(hostname + " (" + ip + ") | Connect Fail - " + message + "\n")
         contentList = [ip, message, str(err), get_now_time()]
         fail_num = fail_check(ip, indbase, contentList)
-        no_connect_ips.append({'ip': ip, 'days': fail_num})
+        get_list('no_connect_ips').append({'ip': ip, 'days': fail_num})
         return False
     # If try arguments succeeded...
     else:
@@ -580,93 +727,26 @@ def fail_check(ip, indbase, contentList):
     :param contentList: -   Content for the log entry.
     :return days_exp:   -   Number of days expired for this device
     """
-    # Number of days to keep IP after first fail attempt
-    attempt_limit = 10
-    matched = False
     days_exp = "0"
-
     # If the device is in the database...
     if indbase:
-        oldListDict = csv_to_listdict(failing_devices_csv)
-        myDelimiter = ","
-        newListDict = []
-
-        # If the CSV exists...
-        if oldListDict:
-            # Loop over records in the CSV...
-            for myDict in oldListDict:
-                # If we find the subject IP in the CSV...
-                if myDict['ip'] == ip:
-                    matched = True
-                    # Remove the previous record from the Fail Devices list dict
-                    oldListDict.remove(myDict)
-                    # Determine calculate how long device has been unreachable
-                    past_time = datetime.datetime.strptime(myDict['date_added'], "%Y-%m-%d_%H%M")
-                    now_time = datetime.datetime.now()
-                    days_exp = str((now_time - past_time).days)
-                    # Update the record
-                    stdout.write(" Consecutive Failed Days: {0} |".format(days_exp))
-                    # Check if time exceeds the allowable attempt limit
-                    if int(days_exp) > attempt_limit:
-                        # Remove record from main database
-                        stdout.write(" Attempts Exceeded Limit - Removing from Database |")
-                        remove_record(listDict, 'ip', ip, config_dir)
-                        # Add record to Removed_Devices CSV
-                        attribOrderRemove = ['ip', 'consec_days', 'date_removed']
-                        remListDict = [{'ip': ip, 'consec_days': days_exp, 'date_removed': get_now_time()}]
-                        listdict_to_csv(remListDict, removed_devices_csv, myDelimiter, attribOrderRemove)
-                    else:
-                        # Update the record last attempt and consecutive days
-                        myDict.update({'last_attempt': get_now_time()})
-                        myDict.update({'consec_days': days_exp})
-                        # Add the record to the list dictionary
-                        newListDict = oldListDict
-                        newListDict.append(myDict)
-                    # Update the Failed Devices CSV
-                    attribOrderFail = ['ip', 'consec_days', 'last_attempt', 'date_added']
-                    listdict_to_csv(newListDict, failing_devices_csv, myDelimiter, attribOrderFail)
-                    # Add the error to the appropriate list
-                    access_error_list.append(dict(zip(error_key_list, contentList)))
-                    return days_exp
-            # If IP is not in the CSV...
-            if not matched:
-                # Create new record
-                myDict = {
-                    'ip': ip,
-                    'consec_days': "1",
-                    'last_attempt': get_now_time(),
-                    'date_added': get_now_time(),
-                }
-                # Preserve the existing records and add this dictionary to the end
-                newListDict = oldListDict
-                newListDict.append(myDict)
-        # Otherwise, if the CSV doesn't exist...
-        else:
-            # Create new record
-            myDict = {
-                'ip': ip,
-                'consec_days': "1",
-                'last_attempt': get_now_time(),
-                'date_added': get_now_time(),
-            }
-            # Add this record to the new listDict
-            newListDict.append(myDict)
-
-        stdout.write(" Adding to Failed Devices |")
-        days_exp = "1"
-        # Add record to failing CSV
-        attribOrderFail = ['ip', 'consec_days', 'last_attempt', 'date_added']
-        if listdict_to_csv(newListDict, failing_devices_csv, myDelimiter, attribOrderFail):
-            stdout.write(" Adding Successful |")
+        days_exp, first_fail, exceeded = fail_tracker.failed(ip, get_now_time())
+        if first_fail:
+            stdout.write(" Adding to Failed Devices |")
         else:
-            stdout.write(" Adding Failed |")
+            stdout.write(" Consecutive Failed Days: {0} |".format(days_exp))
+            # Check if time exceeds the allowable attempt limit
+            if exceeded:
+                # Remove record from main database
+                stdout.write(" Attempts Exceeded Limit - Removing from Database |")
+                drop_record(ip)
         # This applies to devices that are in the database already. Add to access error log.
-        access_error_list.append(dict(zip(error_key_list, contentList)))
+        get_list('access_error_list').append(dict(zip(error_key_list, contentList)))
     # If the device is not in the database...
     else:
         # This applies to new devices that had a connection issue. Add to new devices log.
         del contentList[2]
-        new_devices_list.append(dict(zip(standard_key_list, contentList)))
+        get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
     return days_exp
 
 def summaryLog():
@@ -857,8 +937,9 @@ def check_params(record, dev):
             remoteDict['vc'] = get_vc_fact(dev)
         # Check the rest of the keys that are in the 'facts'
         else:
-            if key in dev.facts and dev.facts[key]:
-                remoteDict[key] = dev.facts[key]
+            fact = device_fact(dev, key)
+            if fact:
+                remoteDict[key] = fact
             else:
                 #print "No Key Match!"
                 remoteDict[key] = "UNDEFINED"
@@ -867,7 +948,7 @@ def check_params(record, dev):
     if remoteDict:
         if record:
             # Update database date for parameter check
-            record.update({'last_param_check': get_now_time()})
+            listDict.update_record(record, {'last_param_check': get_now_time()})
             # Check that the existing record is up-to-date. If not, update.
             #print "\t- Check parameters:"
 
@@ -953,28 +1034,28 @@ def param_check(record, chg_log, dev):
     # Param Results: 0 = Error, 1 = No Changes, 2 = Changes
     # Scan param results
     if param_results[-1] == 2:  # If changes are detected
-        print_log("Report: Parameter Check\n", chg_log)
-        print_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), chg_log)
-        print_log("User: {0}\n".format(myuser), chg_log)
-        print_log("Checked: {0}\n".format(get_now_time()), chg_log)
+        change_log("Report: Parameter Check\n", chg_log)
+        change_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), chg_log)
+        change_log("User: {0}\n".format(myuser), chg_log)
+        change_log("Checked: {0}\n".format(get_now_time()), chg_log)
         # The "run_change_log" format is "IP,HOSTNAME,DATE"
         contentList = [record['ip'], record['hostname'], get_now_time()]
-        run_change_list.append(dict(zip(standard_key_list, contentList)))
+        get_list('run_change_list').append(dict(zip(standard_key_list, contentList)))
 
     # If param results detect changes
     if param_results[-1] == 2:
-        print_log("Parameter Check:\n", chg_log)
+        change_log("Parameter Check:\n", chg_log)
         for result in param_results[:-1]:
-            print_log("\t> {0}\n".format(result), chg_log)
-        print_log("\n", chg_log)
-        param_change_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+            change_log("\t> {0}\n".format(result), chg_log)
+        change_log("\n", chg_log)
+        get_list('param_change_ips').append(record['hostname'] + " (" + record['ip'] + ")")
 
     # If param results are errors
     elif param_results[-1] == 0:
         message = "Parameters results, errors."
         contentList = [record['ip'], message, param_results[0], get_now_time()]
-        ops_error_list.append(dict(zip(error_key_list, contentList)))
-        param_attrib_error_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+        get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+        get_list('param_attrib_error_ips').append(record['hostname'] + " (" + record['ip'] + ")")
 
     return param_results[-1]
 
@@ -1000,7 +1081,7 @@ def check_inet(record, dev):
     # Get current information to compare against database info
     if record:
         # Update database date for parameter check
-        record.update({'last_inet_check': get_now_time()})
+        listDict.update_record(record, {'last_inet_check': get_now_time()})
         # Check that the existing record is up-to-date. If not, update.
         #print "\t- Check parameters:"
         # Check inet interfaces, if they have changed, update them
@@ -1021,7 +1102,7 @@ def check_inet(record, dev):
                 if any(x != y for x, y in pairs):
                     # print "Change True"
                     if change_record(record['ip'], list1, key='inet_intf'):
-                        record.update({'last_inet_change': get_now_time()})
+                        listDict.update_record(record, {'last_inet_change': get_now_time()})
                         message = "Inet intefaces have changed."
                         stdout.write(record['hostname'] + " (" + record['ip'] + ") | Inet Check: " + message + "\n")
                         results.append(message)
@@ -1038,7 +1119,7 @@ def check_inet(record, dev):
             if list1:
                 # Save info to device record
                 if change_record(record['ip'], list1, key='inet_intf'):
-                    record.update({'last_inet_change': get_now_time()})
+                    listDict.update_record(record, {'last_inet_change': get_now_time()})
                     message = "Inet intefaces have changed."
                     stdout.write(record['hostname'] + " (" + record['ip'] + ") | Inet Check: " + message + "\n")
                     results.append(message)
@@ -1074,28 +1155,28 @@ def inet_check(record, chg_log, dev):
     # Inet Results: 0 = Error, 1 = No Changes, 2 = Changes Detected
     # Compare Results: 0 = Saving Error, 1 = No Changes, 2 = Changes Detected 3 = Update Error
     if inet_results[-1] == 2:  # If changes are detected
-        print_log("Report: Inet Interfaces\n", chg_log)
-        print_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), chg_log)
-        print_log("User: {0}\n".format(myuser), chg_log)
-        print_log("Checked: {0}\n".format(get_now_time()), chg_log)
+        change_log("Report: Inet Interfaces\n", chg_log)
+        change_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), chg_log)
+        change_log("User: {0}\n".format(myuser), chg_log)
+        change_log("Checked: {0}\n".format(get_now_time()), chg_log)
         # The "run_change_log" format is "IP,HOSTNAME,DATE"
         contentList = [record['ip'], record['hostname'], get_now_time()]
-        run_change_list.append(dict(zip(standard_key_list, contentList)))
+        get_list('run_change_list').append(dict(zip(standard_key_list, contentList)))
 
     # If inet results detect changes
     if inet_results[-1] == 2:
-        print_log("Inet Check:\n", chg_log)
+        change_log("Inet Check:\n", chg_log)
         for result in inet_results[:-1]:
-            print_log("\t> {0}\n".format(result), chg_log)
-        print_log("\n", chg_log)
-        inet_change_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+            change_log("\t> {0}\n".format(result), chg_log)
+        change_log("\n", chg_log)
+        get_list('inet_change_ips').append(record['hostname'] + " (" + record['ip'] + ")")
 
     # If inet results are errors
     elif inet_results[-1] == 0:
         message = "Inet results, errors."
         contentList = [record['ip'], message, inet_results[0], get_now_time()]
-        ops_error_list.append(dict(zip(error_key_list, contentList)))
-        inet_error_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+        get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+        get_list('inet_error_ips').append(record['hostname'] + " (" + record['ip'] + ")")
 
     return inet_results[-1]
 
@@ -1119,7 +1200,7 @@ def get_inet_interfaces(ip, dev):
         message = "Error collecting interface information via RPC. "
         #print message + "ERROR: {0}".format(err)
         contentList = [ip, message, str(err), get_now_time()]
-        ops_error_list.append(dict(zip(error_key_list, contentList)))
+        get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
         blank_list = []
         return blank_list
     else:
@@ -1208,7 +1289,7 @@ def get_inet_interfaces(ip, dev):
             message = "Error collecting interface information."
             err = "KeyError: run show interfaces on device."
             contentList = [ip, message, err, get_now_time()]
-            ops_error_list.append(dict(zip(error_key_list, contentList)))
+            get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
             blank_list = []
             return blank_list
 
@@ -1225,29 +1306,15 @@ def get_inet_interfaces(ip, dev):
 # Compare two configurations and provide a list of the differences
 def compare_configs(config1, config2):
     """ Purpose: To compare two configs and get the changes.
-        Returns: True means there are differences, false means they are the same.
+        Returns: A list of the removed ("- ") and added ("+ ") lines, empty if they are the same. False if the
+        comparison failed.
     """
-    change_list = []
-    config1_lines = config1.splitlines(1)
-    config2_lines = config2.splitlines(1)
-
-    diffInstance = difflib.Differ()
     try:
-        diffList = list(diffInstance.compare(config1_lines, config2_lines))
+        change_list = list(ConfigDiff(config1, config2))
     except Exception as err:
         print "ERROR: Config comparison failed."
         return False
     else:
-        #print '-'*50
-        #print "Lines different in config1 from config2:"
-        for line in diffList:
-            if line[0] == '-':
-                change_list.append(line)
-                #print "\t" + line
-            elif line[0] == '+':
-                change_list.append(line)
-                #print "\t" + line
-        #print '-'*50
         return change_list
 
 def config_compare(record, dev):
@@ -1261,23 +1328,39 @@ def config_compare(record, dev):
     # 0 = Save Failed, 1 = No Changes, 2 = Changes Detected, 3 = Update Failed
     returncode = 1
 
-    # Loads the existing (latest) configuration file into a string.
-    loaded_config = get_config_str(record['hostname'], newest=True)
-    #print "Loaded Config: " + loaded_config
+    # Get the newest revision from the config history, the config itself is only read if it is needed
+    try:
+        newest = config_store(record['hostname']).newest_revision()
+    except Exception as err:
+        print 'ERROR: Unable to read config history: {0} | Device: {1}'.format(err, record['hostname'])
+        newest = None
 
     # Update check date
-    record.update({'last_config_check': get_now_time()})
-    # If loaded_config has nothing, then no configuration exists
-    if not loaded_config:
+    listDict.update_record(record, {'last_config_check': get_now_time()})
+
+    # If nothing was committed since the newest revision was saved, the config can't have changed
+    commit_marker = ''
+    if use_commit_marker:
+        commit_marker = fetch_commit_marker(dev)
+        if newest and commit_marker and newest.get('commit_marker') == commit_marker:
+            config_store(record['hostname']).refresh(get_now_time())
+            message = "No configuration changes (no new commits)"
+            stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: " + message + "\n")
+            results.append(message)
+            results.append(returncode)
+            return results
+
+    # If there is no newest revision, then no configuration exists
+    if not newest:
         # Try to collect the config
         myconfig = fetch_config(dev, record['version'])
         # If the config was collected, try to save it as well
         if myconfig:
             # If the configuration save works
-            if save_config_file(myconfig, record):
+            if save_config_file(myconfig, record, commit_marker):
                 #stdout.write("\n\t\tNo existing config, config saved")
                 results.append("No Existing Config, Configuration Saved")
-                record.update({'last_config_change': get_now_time()})
+                listDict.update_record(record, {'last_config_change': get_now_time()})
             # If the configuration save doesn't work
             else:
                 message = "Unable to save configuration."
@@ -1290,25 +1373,32 @@ def config_compare(record, dev):
             stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: ERROR: " + message + "\n")
             results.append(message)
             returncode = 0
-    # If loaded_config returns a configuration...
+    # If the history has a configuration...
     else:
         # Try to get the current configuration
         current_config = fetch_config(dev, record['version'])
 
         # If the current configuration is returned...
         if current_config:
+            fingerprint = config_fingerprint(current_config)
+            # An unchanged config has the same fingerprint, so the stored config isn't read or compared
+            if newest.get('fingerprint') == fingerprint:
+                change_list = []
             # Compare configurations
-            change_list = compare_configs(loaded_config, current_config)
+            else:
+                change_list = compare_configs(get_config_str(record['hostname'], newest=True), current_config)
             # If change_list returns with values, the configs are different
             if change_list:
-                record.update({'last_config_change': get_now_time()})
-                stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: Configuration was changed")
+                listDict.update_record(record, {'last_config_change': get_now_time()})
+                added = len([line for line in change_list if line[0] == '+'])
+                stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: Configuration was changed " +
+                             "(+{0}/-{1})".format(added, len(change_list) - added))
                 returncode = 2
                 # Try to write diffList output to a list
                 for item in change_list:
                     results.append(item)
                 # Try to save the new config file
-                if save_config_file(current_config, record):
+                if save_config_file(current_config, record, commit_marker):
                     stdout.write(" | New config saved\n")
                 else:
                     message = "Unable to save new config"
@@ -1317,26 +1407,14 @@ def config_compare(record, dev):
                     returncode = 3
             # If change_list length is 0, there are no differences in config
             elif len(change_list) == 0:
-                # Calculate how old the newest configuration file is
-                newest_config_file = get_config_filename(record['hostname'], record['hostname'], newest=True)
-                config_time_obj = re.search('\d{4}-\d{2}-\d{2}_\d{4}', newest_config_file)
-                c_time = datetime.datetime.strptime(config_time_obj.group(0), "%Y-%m-%d_%H%M")
-                now_time = datetime.datetime.now()
-                diff = now_time - c_time
-                #print "\nDiff Days: {0}".format(diff.days)
-                # If the latest configuration is over a week old, create a new one
-                if diff.days > 2:
-                    try:
-                        save_config_file(current_config, record)
-                        message = "Refreshed latest configuration"
-                        stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: " + message + "\n")
-                        results.append(message)
-                        returncode = 1
-                    except Exception as err:
-                        message = "Unable to save new config"
-                        stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: ERROR: " + message + "\n")
-                        results.append(message)
-                        returncode = 3
+                # Record that the newest configuration is still current, no new file is needed
+                try:
+                    config_store(record['hostname']).refresh(get_now_time(), fingerprint, commit_marker)
+                except Exception as err:
+                    message = "Unable to refresh config history"
+                    stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: ERROR: " + message + "\n")
+                    results.append(message)
+                    returncode = 3
                 else:
                     message = "No configuration changes"
                     stdout.write(record['hostname'] + " (" + record['ip'] + ") | Config Check: " + message + "\n")
@@ -1370,33 +1448,33 @@ def config_check(record, chg_log, dev):
     compare_results = config_compare(record, dev)
     # Compare Results: 0 = Saving Error, 1 = No Changes, 2 = Changes Detected 3 = Update Error
     if compare_results[-1] == 2:  # If changes are detected
-        print_log("Report: Config Check\n", chg_log)
-        print_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), chg_log)
-        print_log("User: {0}\n".format(myuser), chg_log)
-        print_log("Checked: {0}\n".format(get_now_time()), chg_log)
+        change_log("Report: Config Check\n", chg_log)
+        change_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), chg_log)
+        change_log("User: {0}\n".format(myuser), chg_log)
+        change_log("Checked: {0}\n".format(get_now_time()), chg_log)
         # The "run_change_log" format is "IP,HOSTNAME,DATE"
         contentList = [record['ip'], record['hostname'], get_now_time()]
-        run_change_list.append(dict(zip(standard_key_list, contentList)))
+        get_list('run_change_list').append(dict(zip(standard_key_list, contentList)))
 
     # If compare results detect differences
     if compare_results[-1] == 2:
-        print_log("Config Check:\n", chg_log)
+        change_log("Config Check:\n", chg_log)
         for result in compare_results[:-1]:
-            print_log("\t> {0}".format(result), chg_log)
-        print_log("\n", chg_log)
-        config_change_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+            change_log("\t> {0}".format(result), chg_log)
+        change_log("\n", chg_log)
+        get_list('config_change_ips').append(record['hostname'] + " (" + record['ip'] + ")")
     # If compare results are save errors
     elif compare_results[-1] == 0:
         message = "Config compare, save errors."
         contentList = [record['ip'], message, compare_results[0], get_now_time()]
-        ops_error_list.append(dict(zip(error_key_list, contentList)))
-        config_save_error_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+        get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+        get_list('config_save_error_ips').append(record['hostname'] + " (" + record['ip'] + ")")
     # If compare results are update errors
     elif compare_results[-1] == 3:
         message = "Config compare, update errors."
         contentList = [record['ip'], message, compare_results[0], get_now_time()]
-        ops_error_list.append(dict(zip(error_key_list, contentList)))
-        config_update_error_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+        get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+        get_list('config_update_error_ips').append(record['hostname'] + " (" + record['ip'] + ")")
 
     return compare_results[-1]
 
@@ -1434,6 +1512,23 @@ def fetch_config(dev, ver):
     # Returns a text version of the configuration in "set" format
     return myconfig
 
+def fetch_commit_marker(dev):
+    """ Purpose: Get the newest entry of the device's commit history. If it hasn't moved since the last check, the
+    configuration hasn't changed and doesn't need to be fetched.
+
+    :param dev:         -   The device handle for gather info from device
+    :return:            -   String with the time and user of the last commit, empty string if it couldn't be read
+    """
+    try:
+        commit_response = jxmlease.parse_etree(dev.rpc.get_commit_information())
+        last_commit = commit_response['commit-information']['commit-history']
+        # The newest commit is listed first
+        if isinstance(last_commit, list):
+            last_commit = last_commit[0]
+        return "{0} {1}".format(last_commit['date-time'].encode('utf-8'), last_commit['user'].encode('utf-8'))
+    except Exception as err:
+        return ""
+
 #-----------------------------------------------------------------
 # TEMPLATE STUFF
 #-----------------------------------------------------------------
@@ -1444,42 +1539,44 @@ def template_check(record, force_refresh=False):
     :return: None
     """
     # Check if template option was specified
-    # Template Results: 0 = Error, 1 = No Deviations, 2 = Deviations, 3 = No New Template Needed
+    # Template Results: 0 = Error, 1 = No Deviations, 2 = Deviations
 
     # Check for OSPF configuration, see if this is a route point
     ospf_str = "set protocols ospf"
     is_mdf = False
     host_config = get_config_str(record['hostname'], True)
-    if ospf_str in host_config:
+    if host_config and ospf_str in host_config:
         is_mdf = True
 
     # Run template check
-    templ_results = template_results(template_regex(record['model'], is_mdf), record, force_refresh)
+    now = get_now_time()
+    temp_dev_name = "Template_Deviation_" + now + ".log"
+    templ_results, log_kept = template_results(template_regex(record['model'], is_mdf), record, host_config,
+                                               force_refresh, temp_dev_name)
 
     # Check to see if a template run was even needed.
     #print "Result Code: {0}".format(templ_results[-1])
     if templ_results[-1] != 0:
-        # Create the template deviation log
-        now = get_now_time()
+        # Create the template deviation log, unless the one from the reused results is still there
         device_dir = os.path.join(config_dir, getSiteCode(record['hostname']), record['hostname'])
-        temp_dev_name = "Template_Deviation_" + now + ".log"
         temp_dev_log = os.path.join(device_dir, temp_dev_name)
+        report = []
 
-        print_log("Report: Template Deviation Check\n", temp_dev_log)
-        print_log("Device: {0} ({1})\n".format(record['hostname'], record['ip']), temp_dev_log)
-        print_log("User: {0}\n".format(myuser), temp_dev_log)
-        print_log("Checked: {0}\n".format(get_now_time()), temp_dev_log)
+        report.append("Report: Template Deviation Check\n")
+        report.append("Device: {0} ({1})\n".format(record['hostname'], record['ip']))
+        report.append("User: {0}\n".format(myuser))
+        report.append("Checked: {0}\n".format(get_now_time()))
 
         # Run this if we have missing configuration components reported
         if templ_results[-1] == 1:
-            print_log("\t* Template Matches *\n", temp_dev_log)
+            report.append("\t* Template Matches *\n")
         # Run this if an error was reported
         elif templ_results[-1] == 0:
-            print_log("\t* Template Error: {0} *\n".format(templ_results[0]), temp_dev_log)
+            report.append("\t* Template Error: {0} *\n".format(templ_results[0]))
             message = "Error when running template function."
             contentList = [record['ip'], message, templ_results[0], get_now_time()]
-            ops_error_list.append(dict(zip(error_key_list, contentList)))
-            templ_error_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+            get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
+            get_list('templ_error_ips').append(record['hostname'] + " (" + record['ip'] + ")")
         # Run this for any other report codes
         else:
             missing_conf = []
@@ -1492,111 +1589,107 @@ def template_check(record, force_refresh=False):
                     extra_conf.append(result)
             # Assemble the template deviation check file
             if missing_conf:
-                print_log("\nMissing Configuration:\n", temp_dev_log)
+                report.append("\nMissing Configuration:\n")
                 for line in missing_conf:
-                    print_log("\t{0}\n".format(line), temp_dev_log)
+                    report.append("\t{0}\n".format(line))
             if extra_conf:
-                print_log("\nExtra Configuration:\n", temp_dev_log)
+                report.append("\nExtra Configuration:\n")
                 for line in extra_conf:
-                    print_log("\t{0}\n".format(line), temp_dev_log)
-            templ_change_ips.append(record['hostname'] + " (" + record['ip'] + ")")
+                    report.append("\t{0}\n".format(line))
+            get_list('templ_change_ips').append(record['hostname'] + " (" + record['ip'] + ")")
+        if not log_kept:
+            print_log("".join(report), temp_dev_log)
     # Return the result code of the template report
     return templ_results[-1]
 
-# Creates a dictionary of the variables and their corresponding regex
-def create_template_mapping():
-    regex_terms = csv_to_dict_twoterm(template_regex_csv, ";")    # CSV with regex strings
-    regex_mapping = csv_to_dict_twoterm(template_map_csv, ";")    # CSV with variable to regex string mappings
-
-    # Create the mapping translation
-    map_dict = {}
-    for key1, value1 in regex_mapping.iteritems():
-        for key2, value2 in regex_terms.iteritems():
-            if value1 == key2:
-                map_dict[key1] = value2
-                #print "\nName: {0} | Value: {1}".format(key1, value2)
-    #print "MAP DICT:"
-    #print map_dict
-    #exit()
-    return map_dict
-
-def template_results(regtmpl_list, record, force_refresh):
-    """ Purpose: Make sure a new template is needed. If it is, create deviation log, and return results.
-
-    :param regtmpl_list:    -   List of template set commands with regex
+def template_results(template_set, record, host_config, force_refresh, temp_dev_name):
+    """ Purpose: Make sure a new template scan is needed. The results of the last scan are kept with the digests of the
+    config and template set they came from, and are reused until either one changes.
+
+    :param template_set:    -   Compiled template (TemplateSet) for this device
     :param record:          -   A dictionary containing device attributes
-    :return results:        -   A list containing results of scan.
+    :param host_config:     -   The newest configuration of the device, False if there isn't one
+    :param force_refresh:   -   True/False, scan even if the cached results are current
+    :param temp_dev_name:   -   Name of the deviation log template_check writes the results to
+    :return:                -   Tuple of (list containing results of scan, True if the results were reused and their
+                                deviation log is still there, so template_check doesn't write it again)
     """
     results = []
 
-    # Template Results: 0 = Error, 1 = No Changes, 2 = Changes, 3 = No Template Needed
-    newest_config_file = get_config_filename(record['hostname'], record['hostname'], newest=True)
-    # Check if this is a forced refresh or just a standard scan
-    if force_refresh:
+    # Template Results: 0 = Error, 1 = No Changes, 2 = Changes
+    if not host_config:
+        message = "No Valid Configuration Available"
+        stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + "\n")
+        listDict.update_record(record, {'last_temp_check': get_now_time()})
+        results.append(message)
+        results.append(0)
+        return results, False
+
+    cache = load_template_cache(record['hostname'])
+    config_key = config_digest(host_config)
+    # Neither the config nor the template files have changed since the last scan
+    if not force_refresh and cache and cache['config_digest'] == config_key and \
+            cache['template_digest'] == template_set.digest:
+        message = "Config And Template Unchanged"
+        stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + " -> Reusing Template Results" + "\n")
+        listDict.update_record(record, {'last_temp_check': get_now_time()})
+        device_dir = os.path.join(config_dir, getSiteCode(record['hostname']), record['hostname'])
+        if cache.get('log_file') and os.path.exists(os.path.join(device_dir, cache['log_file'])):
+            return cache['results'], True
+        # The deviation log is gone, it is written again from the reused results
         remove_template_file(record['hostname'])
-        results = template_scan_opt(record, regtmpl_list)
-        record.update({'last_temp_refresh': get_now_time()})
-        record.update({'last_temp_check': get_now_time()})
+        cache['log_file'] = temp_dev_name
+        save_template_cache(record['hostname'], cache)
+        return cache['results'], False
+
+    if force_refresh:
         message = "Forced Refresh of Template"
-        stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + "\n")
-        return results
-    # Run this if this is a standard scan
+    elif not cache:
+        message = "No Template Found"
+    elif cache['config_digest'] != config_key:
+        message = "Configuration Changed"
     else:
-        if newest_config_file:
-
-            #print "Config Time: {0}".format(config_time_obj.group(0))
-            newest_template_file = get_config_filename(record['hostname'], 'Template_Deviation', newest=True)
-            #print "Template File: {0}".format(newest_template_file)
-            if newest_template_file:
-                template_time_obj = re.search('\d{4}-\d{2}-\d{2}_\d{4}', newest_template_file)
-                t_time = datetime.datetime.strptime(template_time_obj.group(0), "%Y-%m-%d_%H%M")
-                config_time_obj = re.search('\d{4}-\d{2}-\d{2}_\d{4}', newest_config_file)
-                c_time = datetime.datetime.strptime(config_time_obj.group(0), "%Y-%m-%d_%H%M")
-                # Compute the time difference between the config file and template file
-                diff = c_time - t_time
-                #print "\nC time: {0}".format(c_time)
-                #print "T time: {0}".format(t_time)
-                #print "Diff: {0}".format(diff)
-                # If the config file is newer than the template file...
-                if c_time > t_time:
-                    remove_template_file(record['hostname'])
-                    results = template_scan_opt(record, regtmpl_list)
-                    record.update({'last_temp_refresh': get_now_time()})
-                    record.update({'last_temp_check': get_now_time()})
-                    message = "Configuration File Newer Than Template"
-                    stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + " -> Successfully Refreshed Template" + "\n")
-                    return results
-                # The template file is current for the latest config file available, skip template function
-                else:
-                    message = "Template Newer Than Configuration File"
-                    stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + " -> No Template Refresh Needed" + "\n")
-                    results.append(message)
-                    returncode = 3
-            # There is no template file, but there is a config file, try to compare and create a template
-            else:
-                results = template_scan_opt(record, regtmpl_list)
-                record.update({'last_temp_refresh': get_now_time()})
-                record.update({'last_temp_check': get_now_time()})
-                message = "No Template Found"
-                stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + " -> Successfully Created Template" + "\n")
-                return results
-        # No config file, skip template function
-        else:
-            message = "No Valid Configuration Available"
-            stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + "\n")
-            results.append(message)
-            returncode = 0
-    # Update template check timestamp
-    record.update({'last_temp_check': get_now_time()})
-
-    results.append(returncode)
-    return results
-
+        message = "Template Files Changed"
+    remove_template_file(record['hostname'])
+    results = template_scan_opt(record, template_set, host_config.splitlines())
+    save_template_cache(record['hostname'], {'config_digest': config_key, 'template_digest': template_set.digest,
+                                             'checked': get_now_time(), 'log_file': temp_dev_name,
+                                             'results': results})
+    listDict.update_record(record, {'last_temp_refresh': get_now_time(), 'last_temp_check': get_now_time()})
+    stdout.write(record['hostname'] + " (" + record['ip'] + ") | Template Check: " + message + " -> Successfully Refreshed Template" + "\n")
+    return results, False
+
+def template_cache_file(hostname):
+    return os.path.join(config_dir, getSiteCode(hostname), hostname, "template_cache.json")
+
+def load_template_cache(hostname):
+    """ Purpose: Load the results of the last template scan of a device.
+
+    :param hostname:        -   Hostname of the device
+    :return:                -   Dictionary with the config digest, template digest and results, None if there is none
+    """
+    try:
+        with open(template_cache_file(hostname)) as fin:
+            cache = json.load(fin)
+    except (IOError, ValueError):
+        return None
+    # Keep the results as byte strings, like a fresh scan returns them
+    cache['results'] = [result.encode('utf-8') if isinstance(result, unicode) else result
+                        for result in cache['results']]
+    return cache
+
+def save_template_cache(hostname, cache):
+    try:
+        replace_file(template_cache_file(hostname), json.dumps(cache))
+    except Exception as err:
+        print "Failed Saving Template Cache -> ERROR: {0}".format(err)
 
-def template_scan_opt(record, regtmpl_list):
+def template_scan_opt(record, template_set, config_list):
     """ Purpose: Run the template against the record
 
     :param record:          -   A dictionary containing device attributes
+    :param template_set:    -   Compiled template (TemplateSet) for this device
+    :param config_list:     -   Lines of the configuration to scan
     :return results:        -   A list containing results of scan.
     """
     # Template Results: 0 = Error, 1 = No Changes, 2 = Changes
@@ -1604,27 +1697,9 @@ def template_scan_opt(record, regtmpl_list):
     results = []
     returncode = 1
 
-    # Print the regex template list
-    #print "Regex Template List:"
-    #pprint.pprint(regtmpl_list)
-    #exit()
-
-    # Try to get the latest config file
-    config_list = get_config_list(record['hostname'], newest=True)
-
-    # PUT THE MAPPING DICTIONARY IN THIS AREA #
-    map_dict = create_template_mapping()
-
-    # Create optional configuration list
-    regtmplopt_list = []
-    opt_tmpl_list = line_list(template_all_opt)
-    # Loop over each line of the template
-    if opt_tmpl_list:
-        # print "Printing TLINE"
-        for tline in opt_tmpl_list:
-            if tline != "":
-                # Correctly format the string for matching
-                regtmplopt_list.append(template_str_parse(tline).strip('\n\t'))
+    # The compiled template is shared, keep track of the template lines not matched yet by their position
+    map_dict = template_set.map_dict
+    regtmpl_remaining = set(range(len(template_set.patterns)))
 
     # Bool for determining if extra configuration was found
     extra_present = False
@@ -1642,34 +1717,27 @@ def template_scan_opt(record, regtmpl_list):
                     #print "-" * 50
                     #print "Test Line: {0}".format(compline)
                     # Loop over the template regex lines
-                    for regline in regtmpl_list:
-                        # If we find a match...
-                        if re.search(regline, compline):
-                            #print "Regex Match: {0}".format(regline)
-                            matched = True
-                            # Remove the matched element from the list
-                            regtmpl_list.remove(regline)
-                            break
+                    # Only the template lines that share a prefix with this line are tried
+                    index = template_set.first_match(compline, regtmpl_remaining)
+                    # If we find a match...
+                    if index is not None:
+                        matched = True
+                        # Remove the matched element from the list
+                        regtmpl_remaining.remove(index)
                     #print "-" * 50
             # If we didn't find a match for this config line in the regex, this is extra configuration...
             if not matched:
-                opt_matched = False
                 # Check if this line matches the optional configuration template
-                #########################
-                for optline in regtmplopt_list:
-                    if re.search(optline, compline):
-                        #print "Omitting Config: {0}".format(compline)
-                        opt_matched = True
-                        break
+                opt_matched = template_set.opt_match(compline)
                 if not opt_matched:
                     #print "Extra Config: {0}".format(compline)
                     results.append("(+) " + compline)
                     extra_present = True
-        #print "Regtmpl_list: {0}".format(regtmpl_list)
         # If there are regex configuration left in the list...
-        if regtmpl_list:
+        if regtmpl_remaining:
             # Loop over the remaining regex commands to create the missing list
-            for regline_matched in regtmpl_list:
+            for index in sorted(regtmpl_remaining):
+                regline_matched = template_set.regex_list[index]
                 nice_output = ""
                 nomatch = False
                 first_pass = True
@@ -1709,90 +1777,15 @@ def template_scan_opt(record, regtmpl_list):
     results.append(returncode)
     return results
 
-# This function scans the string and
-def template_str_parse(str):
-    tline = ""
-    openbracket = False
-    closebracket = False
-    onvar = False
-    varstr = ""
-    textstr = ""
-    # Put the template regex into a dictionary
-    map_dict = create_template_mapping()
-    # Loop over each character in the string
-    for char in str:
-        # If this character is an open bracket
-        if char == "{":
-            if openbracket:
-                onvar = True
-                openbracket = False
-            else:
-                openbracket = True
-                # Add any standard text (escaped)
-                tline += re.escape(textstr)
-                # Clear the textstr
-                textstr = ""
-        # If this character is a close bracket
-        elif char == "}":
-            if closebracket:
-                onvar = False
-                closebracket = False
-            else:
-                closebracket = True
-                # Add the corresponding regex expression
-                tline += map_dict[varstr]
-                # Clear the varstr
-                varstr = ""
-        # If this character if part of a regex variable
-        elif onvar:
-            # Append this character to the variable string
-            varstr += char
-        # If this character is a regular character
-        else:
-            # Append this character to the text string
-            textstr += char
-
-    # Add any remaining text, might happen if string ends on a close bracket
-    tline += re.escape(textstr)
-    #print "TLINE:{0}".format(tline)
-    return tline
-
 def template_regex(model, is_mdf):
-    """ Purpose: Creates the template regex using the template file and regex mapping document.
-    :param: None
-    :return regtmpl_list: A list containing regexs for template scanner. 
-    """
-    regtmpl_list = []
-    templ_list = line_list(template_all)
-    # Generate generic template content
-    # Loop over each line of the template
-    if templ_list:
-        #print "Printing TLINE"
-        for tline in templ_list:
-            if tline != "":
-                # Correctly format the string for matching
-                regtmpl_list.append(template_str_parse(tline).strip('\n\t'))
-
-    # Check for specific switch ELS type
-    addl_list = []
-    if "EX4300" in model:
-        addl_list = line_list(template_els)
-    # Otherwise, it is non-ELS
-    else:
-        addl_list = line_list(template_nonels)
-
-    # If OSPF configuration is present
-    if is_mdf:
-        addl_list = line_list(template_ospf)
+    """ Purpose: Get the compiled template for a device. The template files are only read and compiled again when
+    one of them changes.
 
-    # Loop over each line that contains text
-    for tline in addl_list:
-        if tline != "":
-            # Correctly format the string for matching
-            regtmpl_list.append(template_str_parse(tline).strip('\n\t'))
-
-    # Return the regex infused template list
-    return regtmpl_list
+    :param model:           -   Model of the device
+    :param is_mdf:          -   True/False, the device is a route point (OSPF template)
+    :return:                -   TemplateSet with the compiled template regex
+    """
+    return template_compiler.get(model, is_mdf)
 
 def clear_extra_escapes(escaped_str):
     new_str = ''
@@ -1841,7 +1834,7 @@ def add_new_device(ip, total_num, curr_num):
                     stdout.write("Added Successfully!")
                     message = "Successfully added to database."
                     contentList = [ip, message, get_now_time()]
-                    new_devices_list.append(dict(zip(standard_key_list, contentList)))
+                    get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
                 # If "add" fails
                 else:
                     stdout.write("Add Failed!")
@@ -1850,7 +1843,9 @@ def add_new_device(ip, total_num, curr_num):
                 stdout.write("Added to an existing device!")
                 message = "Adding IP to existing device in database."
                 contentList = [ip, message, get_now_time()]
-                new_devices_list.append(dict(zip(standard_key_list, contentList)))
+                get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
+            # Keep the session for the checks that follow
+            release_device(dev)
     else:
         print "Skipping device, already in database"
     sys.stdout.flush()
@@ -1862,6 +1857,20 @@ def add_record(ip, dev):
     :param dev:         -   The PyEZ connection object (SSH Netconf)
     :return:            -   Returns True/False
     """
+    mydict = new_record(ip, dev)
+    if not mydict:
+        return False
+    # Add entire record to database
+    listDict.append(mydict)
+    return True
+
+def new_record(ip, dev):
+    """ Purpose: Builds the database record of a device from its facts and inet interfaces.
+
+    :param ip:          -   The IP of the device
+    :param dev:         -   The PyEZ connection object (SSH Netconf)
+    :return:            -   The record (dictionary), or False if the facts couldn't be collected
+    """
     mydict = {}
     # Try to gather facts from device
     try:
@@ -1870,11 +1879,11 @@ def add_record(ip, dev):
             if key == 'vc':
                 mydict[key] = get_vc_fact(dev)
             else:
-                fact = dev.facts[key]
+                fact = device_fact(dev, key)
                 if fact is None:
                     message = "Add Failed - Unable to get critical parameter [" + key + "]"
                     contentList = [ip, message, get_now_time()]
-                    new_devices_list.append(dict(zip(standard_key_list, contentList)))
+                    get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
                     return False
                     #mydict[key]
                 else:
@@ -1882,7 +1891,7 @@ def add_record(ip, dev):
     except Exception as err:
         message = "Add Failed - Error accessing facts on device. ERROR:{0}".format(err)
         contentList = [ip, message, get_now_time()]
-        new_devices_list.append(dict(zip(standard_key_list, contentList)))
+        get_list('new_devices_list').append(dict(zip(standard_key_list, contentList)))
         return False
     else:
         now = get_now_time()
@@ -1912,10 +1921,8 @@ def add_record(ip, dev):
         mydict['last_temp_check'] = "UNDEFINED"
         mydict['last_temp_refresh'] = "UNDEFINED"
 
-        # Add entire record to database
         mydict['add_date'] = now
-        listDict.append(mydict)
-        return True
+        return mydict
 
 def change_record(ip, value, key):
     """ Purpose: Change an attribute of an existing record. Record is a dictionary.
@@ -1925,23 +1932,23 @@ def change_record(ip, value, key):
     :param key:         -   Key of the attribute
     :return:            -   True/False
     """
-    for myrecord in listDict:
+    for myrecord in listDict.find_all('ip', ip):
         # If we've found the correct record...
         if myrecord['ip'] == ip:
             try:
                 # Trying to update the record...
                 change_dict = {key: value}
-                myrecord.update(change_dict)
+                listDict.update_record(myrecord, change_dict)
             except Exception as err:
                 # Error checking...
                 print "ERROR: Unable to update record value: {0} | Device: {1}".format(err, ip)
                 message = "Error changing " + key + " to " + value + "."
                 contentList = [ ip, message, str(err), get_now_time() ]
-                ops_error_list.append(dict(zip(error_key_list, contentList)))
+                get_list('ops_error_list').append(dict(zip(error_key_list, contentList)))
                 return False
             # If the record change was successful...
             else:
-                myrecord.update({'last_param_change': get_now_time()})
+                listDict.update_record(myrecord, {'last_param_change': get_now_time()})
                 return True
 
 def delete_record_key(ip, key):
@@ -1951,12 +1958,12 @@ def delete_record_key(ip, key):
     :param key:         -   Key of the attribute
     :return:            -   True/False
     """
-    for myrecord in listDict:
+    for myrecord in listDict.find_all('ip', ip):
         # If we've found the correct record...
         if myrecord['ip'] == ip:
             try:
                 # Trying to update the record...
-                del myrecord[key]
+                listDict.delete_key(myrecord, key)
             except Exception as err:
                 # Error checking...
                 print "ERROR: Unable to delete key '{0}' : {1} | Device: {2}".format(key, err, ip)
@@ -1975,8 +1982,8 @@ def check_host_sn(ip, dev):
     :return:            -   True/False
     """
     try:
-        serialnumber = dev.facts['serialnumber']
-        hostname = dev.facts['hostname']
+        serialnumber = device_fact(dev, 'serialnumber')
+        hostname = device_fact(dev, 'hostname')
     except Exception as err:
         stdout.write("Problem collecting facts from device. ERROR: {0}".format(err))
         return False
@@ -1989,23 +1996,46 @@ def check_host_sn(ip, dev):
                 hostname = 'BLANK'
             #print "Serial Number: {0}".format(serialnumber)
             #print "Hostname: {0}".format(hostname)
-        # Search over database for a match
-        for record in listDict:
-            if record['hostname'] == hostname.upper() or record['serialnumber'] == serialnumber.upper():
-                # This IP belongs to a device that is already discovered.
-                # Get inet_intf info
-                inet_intf = get_inet_interfaces(ip, dev)
-                # Get preferred management ip address
-                man_ip = inet_intf[0]['ipaddr']
-                # Make changes
-                print "Check Host SN function"
-                if change_record(record['ip'], inet_intf, 'inet_intf') and change_record(record['ip'], man_ip, 'ip'):
-                    return True
-                else:
-                    return False
+        # Search the database for a match
+        record = listDict.find('hostname', hostname.upper()) or listDict.find('serialnumber', serialnumber.upper())
+        if record:
+            # This IP belongs to a device that is already discovered.
+            # Get inet_intf info
+            inet_intf = get_inet_interfaces(ip, dev)
+            # Get preferred management ip address
+            man_ip = inet_intf[0]['ipaddr']
+            # Make changes
+            print "Check Host SN function"
+            if change_record(record['ip'], inet_intf, 'inet_intf') and change_record(record['ip'], man_ip, 'ip'):
+                return True
+            else:
+                return False
         # No records matched
         return False
 
+def merge_discovered(ip, mydict):
+    """ Purpose: Adds a discovered device to the database, or adds the IP to the device already in the database
+    with the same hostname or serial number. Only called from the main thread.
+
+    :param ip:          -   The IP the device was discovered on
+    :param mydict:      -   The record built by new_record()
+    :return:            -   None
+    """
+    record = listDict.find('hostname', mydict['hostname']) or listDict.find('serialnumber', mydict['serialnumber'])
+    if record:
+        # Take the inet interfaces and preferred management ip of this session
+        if 'inet_intf' in mydict:
+            change_record(record['ip'], mydict['inet_intf'], 'inet_intf')
+            change_record(record['ip'], mydict['ip'], 'ip')
+        stdout.write("| " + ip + " | Added to an existing device! (" + record['hostname'] + ")\n")
+        message = "Adding IP to existing device in database."
+    else:
+        listDict.append(mydict)
+        stdout.write("| " + ip + " | Added Successfully! (" + mydict['hostname'] + ")\n")
+        message = "Successfully added to database."
+    contentList = [ip, message, get_now_time()]
+    new_devices_list.append(dict(zip(standard_key_list, contentList)))
+
 def explode_masked_list(iplist):
     """ Purpose: Extracts masked IPs from list and adds to a new list with individual IPs.
     
@@ -2025,6 +2055,382 @@ def explode_masked_list(iplist):
             exploded_list.append(myip)
     return exploded_list
 
+#-----------------------------------------------------------------
+# CONCURRENT CHECKS
+#-----------------------------------------------------------------
+class ThreadedOutput(object):
+    """ Purpose: Stand-in for stdout while check workers run. Output written from a worker thread is captured in that
+    device's result so it can be printed as one block, anything else goes straight to the real stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, statement):
+        result = getattr(thread_data, 'result', None)
+        if result is not None:
+            result['output'].append(statement)
+        else:
+            self.stream.write(statement)
+
+    def flush(self):
+        if getattr(thread_data, 'result', None) is None:
+            self.stream.flush()
+
+def set_output(stream):
+    """ Purpose: Point every reference to stdout used by the checks (print, this module and utility) at a stream.
+
+    :param stream:      -   The stream object to use
+    :return:            -   None
+    """
+    global stdout
+    sys.stdout = stream
+    stdout = stream
+    utility.stdout = stream
+
+def get_list(name):
+    """ Purpose: Returns the list a check should add its entries to. Inside a check worker this is the list in the
+    worker's own result, otherwise it is the module level list.
+
+    :param name:        -   Name of one of the lists in "result_list_names"
+    :return:            -   The list object
+    """
+    result = getattr(thread_data, 'result', None)
+    if result is not None:
+        return result[name]
+    return globals()[name]
+
+def change_log(statement, chg_log):
+    """ Purpose: Write to the shared change log. Check workers hold their entries until their result is merged.
+
+    :param statement:   -   String to write to the log
+    :param chg_log:     -   Filename/path for the change log
+    :return:            -   None
+    """
+    result = getattr(thread_data, 'result', None)
+    if result is not None:
+        result['logs'].append((statement, chg_log))
+    else:
+        print_log(statement, chg_log)
+
+def drop_record(ip):
+    """ Purpose: Remove a device from the database. Check workers queue the removal so that only the main thread
+    ever changes the size of listDict.
+
+    :param ip:          -   IP of the device
+    :return:            -   None
+    """
+    result = getattr(thread_data, 'result', None)
+    if result is not None:
+        result['removals'].append(ip)
+    else:
+        remove_record(listDict, 'ip', ip, config_dir, get_config_index())
+
+def new_check_result(record):
+    """ Purpose: Create an empty result for one device check.
+
+    :param record:      -   A dictionary containing the device information from main_db
+    :return:            -   Dictionary containing the captured output, logs, removals and result lists
+    """
+    result = {'ip': record['ip'], 'output': [], 'logs': [], 'removals': []}
+    for name in result_list_names:
+        result[name] = []
+    return result
+
+def check_worker(job):
+    """ Purpose: Runs check_main for one device inside a worker thread, capturing everything it produces.
+
+    :param job:         -   Tuple of (record, chg_log, total_num, curr_num)
+    :return:            -   The device check result
+    """
+    record, chg_log, total_num, curr_num = job
+    result = new_check_result(record)
+    thread_data.result = result
+    try:
+        check_main(record, chg_log, total_num, curr_num)
+    except Exception as err:
+        message = "Check process failed."
+        result['output'].append(record['hostname'] + " (" + record['ip'] + ") | ERROR: " + message + " " + str(err) + "\n")
+        contentList = [record['ip'], message, str(err), get_now_time()]
+        result['ops_error_list'].append(dict(zip(error_key_list, contentList)))
+    finally:
+        thread_data.result = None
+    return result
+
+def merge_check_result(result):
+    """ Purpose: Merge a device check result into the module lists and logs. Only called from the main thread.
+
+    :param result:      -   The device check result
+    :return removals:   -   List of IPs the check asked to remove from the database
+    """
+    stdout.write("".join(result['output']))
+    stdout.flush()
+    for name in result_list_names:
+        globals()[name].extend(result[name])
+    for statement, logfile in result['logs']:
+        print_log(statement, logfile)
+    return result['removals']
+
+def check_pool_loop(jobs):
+    """ Purpose: Runs the device checks over a bounded pool of worker threads. Results are merged in the same order
+    as the serial loop, so the logs and database are saved exactly as a serial run would save them.
+
+    :param jobs:        -   List of (record, chg_log, total_num, curr_num) tuples
+    :return:            -   None
+    """
+    removals = []
+    real_stdout = sys.stdout
+    set_output(ThreadedOutput(real_stdout))
+    pool = ThreadPool(num_workers)
+    try:
+        for result in pool.imap(check_worker, jobs):
+            removals += merge_check_result(result)
+            periodic_checkpoint()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        set_output(real_stdout)
+    # Records are only removed once no worker is reading listDict
+    for ip in removals:
+        remove_record(listDict, 'ip', ip, config_dir, get_config_index())
+
+def template_sweep_init(user):
+    """ Purpose: Sets up a template sweep worker process. The worker gets its own empty database so nothing it does
+    reaches the main process's database or journal, its record changes are sent back in its results instead. The
+    paths and the compiled templates are inherited from the main process with the fork.
+
+    :param user:        -   Username to show in the deviation logs
+    :return:            -   None
+    """
+    global listDict
+    global myuser
+    listDict = DeviceStore()
+    myuser = user
+    set_output(ThreadedOutput(sys.stdout))
+
+def template_sweep_worker(job):
+    """ Purpose: Runs the template check of one device from its saved configuration, inside a sweep worker process.
+
+    :param job:         -   Tuple of (record, total_num, curr_num)
+    :return:            -   The device check result, with the record keys that were changed under 'updates'
+    """
+    record, total_num, curr_num = job
+    result = new_check_result(record)
+    thread_data.result = result
+    before = dict(record)
+    try:
+        stdout.write("\n" + "| " + str(curr_num) + " of " + str(total_num) + " | ")
+        directory_check(record)
+        template_check(record)
+    except Exception as err:
+        message = "Template sweep failed."
+        result['output'].append(record['hostname'] + " (" + record['ip'] + ") | ERROR: " + message + " " + str(err) + "\n")
+        contentList = [record['ip'], message, str(err), get_now_time()]
+        result['ops_error_list'].append(dict(zip(error_key_list, contentList)))
+    finally:
+        thread_data.result = None
+        # Pool workers exit without running atexit, write this device's logs now
+        flush_logs()
+    result['updates'] = dict((key, value) for key, value in record.iteritems() if before.get(key) != value)
+    return result
+
+def template_sweep(subsetlist):
+    """ Purpose: Runs the template check of every device (or the subset list) against its saved configuration,
+    over a pool of worker processes. No devices are contacted. The template regex is compiled before the workers
+    start so they all share it. Results are merged in order by the main process.
+
+    :param subsetlist:  -   TXT file in the "iplists" directory with the IPs to check, empty to check the database
+    :return:            -   None
+    """
+    if subsetlist:
+        records = []
+        for ip_addr in line_list(os.path.join(iplist_dir, subsetlist)):
+            record = get_record(listDict, ip_addr.strip())
+            if record:
+                records.append(record)
+    else:
+        records = list(listDict)
+    jobs = []
+    for curr_num, record in enumerate(records, 1):
+        jobs.append((dict(record), len(records), curr_num))
+
+    # Compile every template set now, forked workers start with them in memory
+    for model in ["EX4300", ""]:
+        for is_mdf in [False, True]:
+            template_regex(model, is_mdf)
+
+    if num_workers > 1:
+        processes = num_workers
+    else:
+        processes = multiprocessing.cpu_count()
+    print "\nTemplate Sweep Begins: {0} ({1} Processes)".format(get_now_time(), processes)
+    print "=" * 80
+    pool = multiprocessing.Pool(processes, initializer=template_sweep_init, initargs=(myuser,))
+    try:
+        for result in pool.imap(template_sweep_worker, jobs, 4):
+            merge_check_result(result)
+            record = listDict.find('ip', result['ip'])
+            if record and result['updates']:
+                listDict.update_record(record, result['updates'])
+            periodic_checkpoint()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print "\n\n" + "=" * 80
+    print "Template Sweep Ends: {0}\n\n".format(get_now_time())
+
+def l2_snapshot_loop(subsetlist):
+    """ Purpose: Collects the ARP, Ethernet switching and LLDP tables of every device (or the subset list) into the
+    snapshot jmanage uses to locate IPs. Devices that can't be collected are logged as ops errors.
+
+    :param subsetlist:  -   TXT file in the "iplists" directory with the IPs to collect, empty to collect the database
+    :return:            -   None
+    """
+    if subsetlist:
+        records = []
+        for ip_addr in line_list(os.path.join(iplist_dir, subsetlist)):
+            record = get_record(listDict, ip_addr.strip())
+            if record:
+                records.append(record)
+    else:
+        records = list(listDict)
+    if num_workers > 1:
+        workers = num_workers
+    else:
+        workers = collect_workers
+    now = get_now_time()
+    print "\nSnapshot Collection Begins: {0} ({1} Workers)".format(now, workers)
+    print "=" * 80
+    snapshot = L2Snapshot(l2_snapshot_file(os.path.join(dir_path, "data")))
+    try:
+        failed = collect_snapshot(snapshot, records, myuser, mypwd, now, port=port, workers=workers)
+    finally:
+        snapshot.close()
+    for record, error in failed:
+        contentList = [record['ip'], "Snapshot collection failed.", error, get_now_time()]
+        ops_error_list.append(dict(zip(error_key_list, contentList)))
+    print "=" * 80
+    print "Snapshot Collection Ends: {0} ({1} of {2} Devices)\n\n".format(get_now_time(),
+                                                                          len(records) - len(failed), len(records))
+
+def reachable_worker(ip):
+    """ Purpose: Checks if an IP accepts connections on one of the discovery ports.
+
+    :param ip:          -   IP address to check
+    :return:            -   Tuple of (ip, True/False)
+    """
+    for probe_port in discovery_ports:
+        if tcp_port_open(ip, probe_port, probe_timeout):
+            return ip, True
+    return ip, False
+
+def reachability_sweep(ip_list):
+    """ Purpose: Stage one of discovery. Checks every IP for an open NETCONF (830) or SSH (22) port at the same time,
+    so addresses with nothing on them cost one short timeout instead of a NETCONF connect each. Unreachable IPs are
+    logged the same way a failed probe is.
+
+    :param ip_list:     -   List of IPs to check
+    :return:            -   List of the reachable IPs, in the order given
+    """
+    live = set()
+    if not ip_list:
+        return []
+    pool = ThreadPool(min(sweep_workers, len(ip_list)))
+    try:
+        for curr_num, (ip, is_open) in enumerate(pool.imap_unordered(reachable_worker, ip_list), 1):
+            if is_open:
+                live.add(ip)
+            else:
+                message = "Probe timeout, possible IP reachability issues."
+                contentList = [ip, message, get_now_time()]
+                new_devices_list.append(dict(zip(standard_key_list, contentList)))
+                no_ping_ips.append({'ip': ip, 'days': "0"})
+            stdout.write("\rSweep: {0} of {1} | Reachable: {2}".format(curr_num, len(ip_list), len(live)))
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    stdout.write("\n")
+    return [ip for ip in ip_list if ip in live]
+
+def discover_worker(job):
+    """ Purpose: Stage two of discovery. Connects to one reachable IP inside a worker thread and builds its record.
+    The record is added to the database by the main thread, so devices are matched by hostname/serial one at a time.
+
+    :param job:         -   Tuple of (ip, total_num, curr_num)
+    :return:            -   The check result, with the record under 'device' (None if it wasn't built)
+    """
+    ip, total_num, curr_num = job
+    result = new_check_result({'ip': ip})
+    result['device'] = None
+    thread_data.result = result
+    try:
+        stdout.write("| {0} of {1} | Adding... {2}  | ".format(curr_num, total_num, ip))
+        # An earlier device in this run may already have this IP
+        if get_record(listDict, ip):
+            stdout.write("Skipping device, already in database\n")
+        else:
+            dev = connect(ip, indbase=False)
+            if dev:
+                try:
+                    mydict = new_record(ip, dev)
+                    if mydict:
+                        result['device'] = mydict
+                    else:
+                        stdout.write("Add Failed!\n")
+                finally:
+                    # Keep the session for the checks that follow
+                    release_device(dev)
+    except Exception as err:
+        message = "Add Failed - Discovery process failed. ERROR:{0}".format(err)
+        result['output'].append(message + "\n")
+        contentList = [ip, message, get_now_time()]
+        result['new_devices_list'].append(dict(zip(standard_key_list, contentList)))
+    finally:
+        thread_data.result = None
+    return result
+
+def discover_loop(ip_list):
+    """ Purpose: Connects to the reachable IPs over a pool of worker threads. Each result is printed and added to the
+    database as soon as it completes.
+
+    :param ip_list:     -   List of reachable IPs
+    :return:            -   None
+    """
+    if not ip_list:
+        return
+    if num_workers > 1:
+        workers = num_workers
+    else:
+        workers = discover_workers
+    jobs = []
+    for curr_num, ip in enumerate(ip_list, 1):
+        jobs.append((ip, len(ip_list), curr_num))
+    real_stdout = sys.stdout
+    set_output(ThreadedOutput(real_stdout))
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        for result in pool.imap_unordered(discover_worker, jobs):
+            merge_check_result(result)
+            if result['device']:
+                merge_discovered(result['ip'], result['device'])
+            periodic_checkpoint()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        set_output(real_stdout)
+
 #-----------------------------------------------------------------
 # MAIN LOOPS
 #-----------------------------------------------------------------
@@ -2043,11 +2449,17 @@ def add_new_devices_loop(iplistfile):
     ip_list = line_list(os.path.join(iplist_dir, iplistfile))
     if ip_list:
         exploded_list = explode_masked_list(ip_list)
-        total_num = len(exploded_list)
-        curr_num = 0
+        # Only look for the addresses that aren't in the database
+        new_list = []
+        seen = set()
         for myip in exploded_list:
-            curr_num += 1
-            add_new_device(myip, total_num, curr_num)
+            if myip not in seen and not get_record(listDict, myip):
+                new_list.append(myip)
+            seen.add(myip)
+        print "IPs: {0} | Already in Database: {1}".format(len(seen), len(seen) - len(new_list))
+        live_list = reachability_sweep(new_list)
+        print "Reachable: {0} of {1}\n".format(len(live_list), len(new_list))
+        discover_loop(live_list)
         stdout.write("\n\n")
         sys.stdout.flush()
     else:
@@ -2081,7 +2493,8 @@ def check_loop(subsetlist):
         # Total number of IPs in this list
         total_num = len(temp_list)
 
-        # Loop over the ip addresses provided
+        # Loop over the ip addresses provided, with workers the checks are queued and run together afterwards
+        jobs = []
         for ip in temp_list:
             # Increase count by 1...
             curr_num += 1
@@ -2092,20 +2505,32 @@ def check_loop(subsetlist):
                 #print subHeading(ip, 15)
                 add_new_device(ip, total_num, curr_num)
                 record = get_record(listDict, ip)
-                if record:
-                    check_main(record, chg_log, total_num, curr_num)
-            # If the IP IS present, execute this...
+                if not record:
+                    continue
+            # Check the device now, or queue it for the workers
+            if num_workers > 1:
+                jobs.append((record, chg_log, total_num, curr_num))
             else:
-               check_main(record, chg_log, total_num, curr_num)
-
+                check_main(record, chg_log, total_num, curr_num)
+                periodic_checkpoint()
+        if jobs:
+            check_pool_loop(jobs)
 
     # Check the entire database
     else:
         # Record (ip, etc)
         total_num = len(listDict)
-        for record in listDict:
-            curr_num += 1
-            check_main(record, chg_log, total_num, curr_num)
+        if num_workers > 1:
+            jobs = []
+            for record in listDict:
+                curr_num += 1
+                jobs.append((record, chg_log, total_num, curr_num))
+            check_pool_loop(jobs)
+        else:
+            for record in listDict:
+                curr_num += 1
+                check_main(record, chg_log, total_num, curr_num)
+                periodic_checkpoint()
 
     #except KeyboardInterrupt:
     #    print "\n --- Process has been interrupted ---"
@@ -2117,11 +2542,11 @@ def check_loop(subsetlist):
 
 # Update a record inside a list dictionary
 def update_ld(key, value, ip):
-    for record in listDict:
+    for record in listDict.find_all('ip', ip):
         if record['ip'] == ip:
             print "BEFORE:"
             print record
-            record.update({key, value})
+            listDict.update_record(record, {key: value})
             print "AFTER:"
             print record
 
@@ -2141,13 +2566,13 @@ def check_main(record, chg_log="deflog.log", total_num=1, curr_num=1):
     stdout.write("\n" + "| " + str(curr_num) + " of " + str(total_num) + " | ")
     sys.stdout.flush()
     # Update the 'last_access_attempt'
-    record.update({'last_access_attempt': get_now_time()})
+    listDict.update_record(record, {'last_access_attempt': get_now_time()})
     # Try to connect to the device
     dev = connect(record['ip'], hostname=record['hostname'], indbase=True)
 
     # If the connection was successfull, start checking device
     if dev:
-        record.update({'last_access_success': get_now_time()})
+        listDict.update_record(record, {'last_access_success': get_now_time()})
         stdout.write("Checking: ")
         sys.stdout.flush()
         if addl_opt == "all":
@@ -2172,9 +2597,9 @@ def check_main(record, chg_log="deflog.log", total_num=1, curr_num=1):
             # Running Inet Check
             if run_inet: inet_check(record, chg_log, dev)
             # Running Template Check
-            if run_template: template_check(record, True)
+            if run_template: template_check(record)
         try:
-            dev.close()
+            release_device(dev)
         except:
             print "Caught dev.close() exception"
             pass
@@ -2188,13 +2613,13 @@ def check_main(record, chg_log="deflog.log", total_num=1, curr_num=1):
             # If last_temp_check is also not known, remove this record
             if tmp_chk == 'UNDEFINED':
                 #print "Both timestamps are Undefined"
-                remove_record(listDict, 'ip', record['ip'], config_dir)
+                drop_record(record['ip'])
             else:
                 # Check if this device hasn't been reached for a month, using last_temp_check timestamp
                 day_diffs = day_difference(record['last_temp_check'])
                 if day_diffs > 30:
                     #print "Access_Success is UNDEF, Temp_Check diff is GT 30: {0}".format(day_diffs)
-                    remove_record(listDict, 'ip', record['ip'], config_dir)
+                    drop_record(record['ip'])
                     #print "Record Removed!"
                 #else:
                 #    print "Access_Success is UNDEF, Temp_Check diff is LT 30: {0}".format(day_diffs)
@@ -2204,7 +2629,7 @@ def check_main(record, chg_log="deflog.log", total_num=1, curr_num=1):
             day_diffs = day_difference(record['last_access_success'])
             if day_diffs > 30:
                 #print "Access_Success diff is GT 30: {0}".format(day_diffs)
-                remove_record(listDict, 'ip', record['ip'], config_dir)
+                drop_record(record['ip'])
                 #print "Record Removed!"
             #else:
             #    print "Access_Success diff is LT 30: {0}".format(day_diffs)
@@ -2219,6 +2644,7 @@ def main(argv):
                         - "template" will run the Template Scan Function of existing devices
                         - "all" will run both of the above functions
             -i    -  (Optional) A TEXT file containing a list of ip addresses to add to the database.
+            -w    -  (Optional) The number of devices to check at the same time.
     """
     global credsCSV
     global iplistfile
@@ -2228,6 +2654,10 @@ def main(argv):
     global run_config
     global run_inet
     global run_template
+    global num_workers
+    global use_commit_marker
+    global run_template_sweep
+    global run_l2_snapshot
     # Set these params as not set, by default
     run_param = False
     run_config = False
@@ -2235,13 +2665,13 @@ def main(argv):
     run_template = False
 
     try:
-        opts, args = getopt.getopt(argv, "hl:a:s:pcitA",["login=","ipadd=","subset="])
+        opts, args = getopt.getopt(argv, "hl:a:s:w:pcitTLAm",["login=","ipadd=","subset=","workers="])
     except getopt.GetoptError:
-        print "device_refresh -l <loginfile> -s <subsetlist> -a <ipaddfile> -p -c -i -t -A"
+        print "device_refresh -l <loginfile> -s <subsetlist> -a <ipaddfile> -w <workers> -p -c -i -t -T -L -A -m"
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print 'SYNTAX: device_refresh -l <loginfile> -s <subsetlist> -a <iplistfile> -p -c -i -t -A'
+            print 'SYNTAX: device_refresh -l <loginfile> -s <subsetlist> -a <iplistfile> -w <workers> -p -c -i -t -T -L -A -m'
             print '  -l : (REQUIRED) A CSV file in the root of the jmanage folder. It contains the username or hashid and password.'
             print '  -s : (OPTIONAL) A TXT file in the "iplists" directory that contains a list of IP addresses to scan.'
             print '  -a : (OPTIONAL) A TXT file in the "iplists" directory that contains a list of IPs to add to the database.'
@@ -2249,7 +2679,11 @@ def main(argv):
             print '  -c : (OPTIONAL) Run the configuration check.'
             print '  -i : (OPTIONAL) Run the inet check.'
             print '  -t : (OPTIONAL) Run the template scan.'
+            print '  -T : (OPTIONAL) Run the template scan on the saved configs only, without connecting to devices.'
+            print '  -L : (OPTIONAL) Collect the ARP, MAC and LLDP tables jmanage uses to locate IPs. Schedule it to keep them current.'
             print '  -A : (OPTIONAL) Run all the scans'
+            print '  -w : (OPTIONAL) Number of devices to check at the same time. (Default is 1)'
+            print '  -m : (OPTIONAL) Config check skips fetching configs of devices with no commits since the last check.'
             sys.exit()
         elif opt in ("-l", "--login"):
             credsCSV = arg
@@ -2257,6 +2691,12 @@ def main(argv):
             subsetlist = arg
         elif opt in ("-a", "--ipadd"):
             iplistfile = arg
+        elif opt in ("-w", "--workers"):
+            try:
+                num_workers = max(1, int(arg))
+            except ValueError:
+                print "Invalid number of workers: {0}".format(arg)
+                sys.exit(2)
         elif opt in ("-p", "--param"):
             run_param = True
         elif opt in ("-c", "--config"):
@@ -2265,6 +2705,12 @@ def main(argv):
             run_inet = True
         elif opt in ("-t", "--template"):
             run_template = True
+        elif opt in ("-T", "--sweep"):
+            run_template_sweep = True
+        elif opt in ("-L", "--snapshot"):
+            run_l2_snapshot = True
+        elif opt in ("-m", "--commit"):
+            use_commit_marker = True
         elif opt in ("-A", "--all"):
             run_param = True
             run_config = True
@@ -2274,10 +2720,14 @@ def main(argv):
     print "Credentials file is: {0}".format(credsCSV)
     print "IP List file is: {0}".format(iplistfile)
     print "Subset List File is: {0}".format(subsetlist)
+    print "Check Workers: {0}".format(num_workers)
     if run_param: print "Param Flag is set."
     if run_config: print "Config Flag is set."
     if run_inet: print "Inet Flag is set."
     if run_template: print "Template Flag is set."
+    if run_template_sweep: print "Template Sweep Flag is set."
+    if run_l2_snapshot: print "Snapshot Flag is set."
+    if use_commit_marker: print "Commit Marker Flag is set."
 
 # Main execution loop
 if __name__ == "__main__":
@@ -2298,9 +2748,28 @@ if __name__ == "__main__":
         print "Error: No CSV credentials file specified!"
         exit()
 
+    # Share sessions between the add and check loops, each worker holds at most one session at a time. Facts are
+    # gathered only when a check reads them, so config and template runs skip the fact RPCs.
+    set_default_pool(ConnectionPool(myuser, mypwd, port=port, max_sessions=max(20, num_workers * 2),
+                                    gather_facts=False))
+
     # Load records from existing CSV
     #print "Loading records..."
-    listDict = json_to_listdict(main_list_dict)
+    # Only one run may own the journal, a second run would replay and empty it underneath the first
+    journal_lock = JournalLock(main_list_dict)
+    if not journal_lock.acquire():
+        print "Error: device_refresh is already running (pid {0})".format(journal_lock.owner())
+        exit()
+    listDict = load_device_db(main_list_dict, journal_owner=True)
+    # Never carry on from an empty database, the first save would replace the real one
+    if listDict is False:
+        print "Error: Unable to load the device database ({0})!".format(main_list_dict)
+        exit()
+    # Journal every change so a run that dies can be recovered on the next start
+    open_journal(listDict, main_list_dict)
+    last_checkpoint = time.time()
+    # Failing devices are tracked in memory and saved with the database
+    fail_tracker = FailTracker(failing_devices_csv, removed_devices_csv)
     #print "LIST DICT:"
     #print(json.dumps(listDict, indent=2))
 
@@ -2333,12 +2802,25 @@ if __name__ == "__main__":
             print "\n >> No devices to add.\n"
 
         # Check Params/Config/Template Function if records exist
-        if run_param or run_config or run_inet or run_template:
-            print " >> Running check_main..."
-            print subHeading("CHECK FUNCTIONS", 15)
-            # Run the check main process
-            check_loop(subsetlist)
-            print " >> Completed check_main"
+        if run_param or run_config or run_inet or run_template or run_template_sweep or run_l2_snapshot:
+            if run_param or run_config or run_inet or run_template:
+                print " >> Running check_main..."
+                print subHeading("CHECK FUNCTIONS", 15)
+                # Run the check main process
+                check_loop(subsetlist)
+                print " >> Completed check_main"
+            # Template scan of the saved configs, after any config check so it sees the newest ones
+            if run_template_sweep:
+                print " >> Running template_sweep..."
+                print subHeading("TEMPLATE SWEEP", 15)
+                template_sweep(subsetlist)
+                print " >> Completed template_sweep"
+            # Snapshot of the ARP, MAC and LLDP tables for jmanage's IP search
+            if run_l2_snapshot:
+                print " >> Running l2_snapshot_loop..."
+                print subHeading("SNAPSHOT COLLECTION", 15)
+                l2_snapshot_loop(subsetlist)
+                print " >> Completed l2_snapshot_loop"
 
             # Print the scan results (troubleshooting)
             print " >> Running scan_results..."
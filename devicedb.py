@@ -0,0 +1,756 @@
+# File: devicedb.py
+# Author: Tyler Jordan
+# Purpose: Indexed in-memory copy of the device database (main_db.json). Lookups by IP, hostname, serial number or
+# version are hash lookups instead of a scan of every record, which kept full runs of device_refresh at O(n^2).
+# The database can also be kept in SQLite, where a save only writes the records that changed.
+
+import os
+import sys
+import csv
+import json
+import getopt
+import socket
+import struct
+import sqlite3
+import datetime
+import threading
+
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Record keys that are indexed directly
+indexed_keys = ['ip', 'hostname', 'serialnumber', 'version']
+
+# Maps the get_record() arguments to record keys
+search_keys = {'hostname': 'hostname', 'sn': 'serialnumber', 'code': 'version'}
+
+
+class DeviceStore(list):
+    """ Purpose: A list of device records (dictionaries) that keeps hash indexes on the primary ip, every inet_intf
+    address, hostname, serial number and version.
+
+        - The store is still a list, so it can be looped over, sorted and written with write_to_json() to the same
+          main_db.json format as before.
+        - Records are added and removed with the list methods (append, extend, insert, remove, pop) so the indexes
+          stay current.
+        - Record keys must be changed with update_record() or delete_key(), so the indexes stay current and the
+          change is journaled and saved.
+        - Lookups return the first matching record in list order, the same record a scan of the list would find.
+        - With a journal attached, every append, insert, remove, pop, update_record() and delete_key() is written to
+          the journal as it happens.
+        - The records added, changed and removed since the last save are tracked, so a SQLite save only serializes
+          those records.
+    """
+    def __init__(self, records=None):
+        list.__init__(self, records or [])
+        self.lock = threading.RLock()
+        self.backend = None     # SqliteDeviceDB the store was loaded from, None for JSON
+        self.journal = None     # DeviceJournal that changes are written to, None to not journal
+        self.clear_changes()
+        self.rebuild()
+
+    #####################
+    # INDEX MAINTENANCE #
+    #####################
+
+    def rebuild(self):
+        """ Purpose: Rebuild every index from the records in the list. """
+        with self.lock:
+            self.indexes = {'address': {}}
+            for key in indexed_keys:
+                self.indexes[key] = {}
+            self.entries = {}       # id(record) -> [(index name, value), ...]
+            for record in self:
+                self.add_index(record)
+
+    def add_index(self, record):
+        entries = []
+        for key in indexed_keys:
+            if key in record:
+                entries.append((key, record[key]))
+        # Match the get_record() rules, devices with inet_intf info are found by their interface addresses
+        if 'inet_intf' in record:
+            for inet_intf in record['inet_intf']:
+                if 'ipaddr' in inet_intf:
+                    entries.append(('address', inet_intf['ipaddr']))
+        elif 'ip' in record:
+            entries.append(('address', record['ip']))
+        for name, value in entries:
+            matches = self.indexes[name].setdefault(value, [])
+            if not any(match is record for match in matches):
+                matches.append(record)
+        self.entries[id(record)] = entries
+
+    def drop_index(self, record):
+        for name, value in self.entries.pop(id(record), []):
+            matches = self.indexes[name].get(value, [])
+            for index, match in enumerate(matches):
+                if match is record:
+                    del matches[index]
+                    break
+            if not matches:
+                self.indexes[name].pop(value, None)
+
+    ###################
+    # CHANGE TRACKING #
+    ###################
+
+    def clear_changes(self):
+        """ Purpose: Forget the tracked changes, once they are saved. """
+        self.changed = {}       # id(record) -> record added or changed since the last save
+        self.removed = {}       # id(record) -> record removed since the last save
+        self.reordered = False  # True if the list was changed by position, every record must be compared
+
+    def mark_changed(self, record):
+        self.removed.pop(id(record), None)
+        self.changed[id(record)] = record
+
+    def mark_removed(self, record):
+        self.changed.pop(id(record), None)
+        self.removed[id(record)] = record
+
+    def reindex(self, record):
+        """ Purpose: Refresh the index entries of one record after its indexed values changed. """
+        with self.lock:
+            self.drop_index(record)
+            self.add_index(record)
+
+    ################
+    # LIST METHODS #
+    ################
+
+    def append(self, record):
+        with self.lock:
+            list.append(self, record)
+            self.add_index(record)
+            self.mark_changed(record)
+            if self.journal:
+                self.journal.write('add', record.get('ip'), record)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def insert(self, position, record):
+        with self.lock:
+            list.insert(self, position, record)
+            # Lookups must still return the first record in list order
+            self.rebuild()
+            self.mark_changed(record)
+            if self.journal:
+                self.journal.write('add', record.get('ip'), record)
+
+    def remove(self, record):
+        with self.lock:
+            for index, match in enumerate(self):
+                if match is record:
+                    list.__delitem__(self, index)
+                    break
+            else:
+                list.remove(self, record)
+            self.drop_index(record)
+            self.mark_removed(record)
+            if self.journal:
+                self.journal.write('remove', record.get('ip'))
+
+    def pop(self, position=-1):
+        with self.lock:
+            record = list.pop(self, position)
+            self.drop_index(record)
+            self.mark_removed(record)
+            if self.journal:
+                self.journal.write('remove', record.get('ip'))
+            return record
+
+    def __setitem__(self, position, value):
+        with self.lock:
+            list.__setitem__(self, position, value)
+            self.rebuild()
+            self.reordered = True
+
+    def __delitem__(self, position):
+        with self.lock:
+            list.__delitem__(self, position)
+            self.rebuild()
+            self.reordered = True
+
+    def __setslice__(self, start, stop, value):
+        self.__setitem__(slice(start, stop), value)
+
+    def __delslice__(self, start, stop):
+        self.__delitem__(slice(start, stop))
+
+    ###########
+    # LOOKUPS #
+    ###########
+
+    def find_all(self, key, value):
+        """ Purpose: Return every record with the value. The 'address' key matches any inet_intf address.
+
+            :param key:         -   Record key to search on (ip, address, hostname, serialnumber, version)
+            :param value:       -   Value to search for
+            :return:            -   List of matching records, empty if none match
+        """
+        if key in self.indexes:
+            return list(self.indexes[key].get(value, []))
+        return [record for record in self if record.get(key) == value]
+
+    def find(self, key, value):
+        """ Purpose: Return the first record with the value, or None. """
+        matches = self.find_all(key, value)
+        if matches:
+            return matches[0]
+        return None
+
+    def get_record(self, ip='', hostname='', sn='', code=''):
+        """ Purpose: Indexed version of utility.get_record(), same arguments and results. """
+        if ip:
+            return self.find('address', ip)
+        for arg, value in (('hostname', hostname), ('sn', sn), ('code', code)):
+            if value:
+                return self.find(search_keys[arg], value)
+        return False
+
+    ###########
+    # CHANGES #
+    ###########
+
+    def update_record(self, record, changes):
+        """ Purpose: Update keys on a record and refresh its index entries.
+
+            :param record:      -   The record (dictionary) in this store
+            :param changes:     -   Dictionary of keys and new values
+            :return:            -   None
+        """
+        with self.lock:
+            if self.journal:
+                self.journal.write('update', record.get('ip'), changes)
+            record.update(changes)
+            self.mark_changed(record)
+            # Timestamp changes don't move the record in the indexes
+            if 'inet_intf' in changes or any(key in changes for key in indexed_keys):
+                self.drop_index(record)
+                self.add_index(record)
+
+    def delete_key(self, record, key):
+        """ Purpose: Delete a key from a record and refresh its index entries. Raises KeyError if it isn't there. """
+        with self.lock:
+            if self.journal:
+                self.journal.write('delete_key', record.get('ip'), key)
+            del record[key]
+            self.mark_changed(record)
+            self.drop_index(record)
+            self.add_index(record)
+
+
+################
+# SUBNET INDEX #
+################
+
+# IPv4 address as an integer
+def ip_to_int(ipaddr):
+    return struct.unpack('!I', socket.inet_aton(ipaddr))[0]
+
+# Prefix length of a mask given as a length ("24") or dotted ("255.255.255.0")
+def mask_to_prefixlen(ipmask):
+    if '.' in ipmask:
+        mask = ip_to_int(ipmask)
+        prefixlen = bin(mask).count('1')
+        if mask != (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF:
+            raise ValueError("Invalid mask: {0}".format(ipmask))
+        return prefixlen
+    prefixlen = int(ipmask)
+    if not 0 <= prefixlen <= 32:
+        raise ValueError("Invalid mask: {0}".format(ipmask))
+    return prefixlen
+
+
+class SubnetIndex(object):
+    """ Purpose: Binary trie of the IPv4 networks in every record's inet_intf list. Finding the devices with a
+    network that contains an address walks at most 32 nodes, however many devices and interfaces there are.
+
+    Each node is [zero child, one child, entries], entries are the (record, inet_intf entry) of the networks that end
+    at that node, in database order. Entries that aren't valid IPv4 networks are skipped.
+    """
+    def __init__(self, records=None):
+        self.root = [None, None, None]
+        self.networks = 0
+        for record in records or []:
+            self.add_record(record)
+
+    def add_record(self, record):
+        """ Purpose: Add the networks of a record's inet_intf entries. """
+        for inet_intf in record.get('inet_intf', []):
+            try:
+                network = ip_to_int(inet_intf['ipaddr'])
+                prefixlen = mask_to_prefixlen(inet_intf['ipmask'])
+            except (KeyError, TypeError, ValueError, socket.error):
+                continue
+            node = self.root
+            for bit in range(prefixlen):
+                branch = (network >> (31 - bit)) & 1
+                if node[branch] is None:
+                    node[branch] = [None, None, None]
+                node = node[branch]
+            if node[2] is None:
+                node[2] = []
+            node[2].append((record, inet_intf))
+            self.networks += 1
+
+    def matches(self, ipaddr):
+        """ Purpose: Return every network containing the address, most specific first.
+
+            :param ipaddr:      -   IPv4 address string
+            :return:            -   List of (prefix length, record, inet_intf entry)
+        """
+        found = []
+        address = ip_to_int(ipaddr)
+        node = self.root
+        prefixlen = 0
+        while node is not None:
+            if node[2]:
+                found.extend((prefixlen, record, inet_intf) for record, inet_intf in node[2])
+            if prefixlen == 32:
+                break
+            node = node[(address >> (31 - prefixlen)) & 1]
+            prefixlen += 1
+        # Most specific first, database order is kept between networks of the same length
+        found.sort(key=lambda match: -match[0])
+        return found
+
+    def longest(self, ipaddr):
+        """ Purpose: Return the longest prefix matches of the address, empty list if no network contains it. """
+        deepest = []
+        address = ip_to_int(ipaddr)
+        node = self.root
+        prefixlen = 0
+        while node is not None:
+            if node[2]:
+                deepest = [(prefixlen, record, inet_intf) for record, inet_intf in node[2]]
+            if prefixlen == 32:
+                break
+            node = node[(address >> (31 - prefixlen)) & 1]
+            prefixlen += 1
+        return deepest
+
+    def lookup_many(self, ipaddrs):
+        """ Purpose: Return the longest prefix matches of each address in a list, in the order given. Invalid
+        addresses get an empty list.
+
+            :param ipaddrs:     -   List of IPv4 address strings
+            :return:            -   List of (ipaddr, matches)
+        """
+        results = []
+        for ipaddr in ipaddrs:
+            try:
+                results.append((ipaddr, self.longest(ipaddr)))
+            except (ValueError, socket.error):
+                results.append((ipaddr, []))
+        return results
+
+
+###########
+# JOURNAL #
+###########
+
+# The journal file kept next to a database file
+def journal_file(db_file):
+    return os.path.splitext(db_file)[0] + ".journal"
+
+
+class DeviceJournal(object):
+    """ Purpose: Append-only log of the changes made to a DeviceStore, one JSON object per line. Each line is flushed as
+    it is written, so if a run dies the changes made since the last save can be replayed onto the database.
+
+    Entries name the record by its primary ip at the time of the change:
+        {"op": "add", "ip": ..., "data": <record>}
+        {"op": "update", "ip": ..., "data": <changed keys>}
+        {"op": "delete_key", "ip": ..., "data": <key>}
+        {"op": "remove", "ip": ...}
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fout = open(path, 'a')
+
+    def write(self, op, ip, data=None):
+        entry = {'op': op, 'ip': ip}
+        if data is not None:
+            entry['data'] = data
+        self.fout.write(json.dumps(entry) + "\n")
+        self.fout.flush()
+
+    def truncate(self):
+        """ Purpose: Empty the journal once its changes are in the saved database. """
+        self.fout.close()
+        self.fout = open(self.path, 'w')
+
+    def close(self):
+        self.fout.close()
+
+
+def lock_file(db_file):
+    return os.path.splitext(db_file)[0] + ".lock"
+
+
+class JournalLock(object):
+    """ Purpose: Marks the one process that writes the journal (device_refresh). Only the owner may fold the journal
+    into the database and empty it, other tools replay it in memory and leave the files alone. The lock is an flock
+    on the lock file, so it is released if the owner dies, and the file holds the owner's pid.
+    """
+    def __init__(self, db_file):
+        self.path = lock_file(db_file)
+        self.fout = None
+
+    def acquire(self):
+        """ Purpose: Take the lock without waiting. Returns True/False. """
+        fout = open(self.path, 'a+')
+        if fcntl:
+            try:
+                fcntl.flock(fout.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fout.close()
+                return False
+        fout.truncate(0)
+        fout.write(str(os.getpid()) + "\n")
+        fout.flush()
+        self.fout = fout
+        return True
+
+    def owner(self):
+        """ Purpose: Pid of the process holding the lock, from the lock file. """
+        try:
+            with open(self.path) as fin:
+                return fin.read().strip()
+        except IOError:
+            return ''
+
+    def release(self):
+        if self.fout:
+            self.fout.close()
+            self.fout = None
+
+
+def replay_journal(list_dict, path):
+    """ Purpose: Apply the changes in a journal file to a freshly loaded DeviceStore. A partly written last line, from
+    a run that died mid-write, is ignored.
+
+        :param list_dict:   -   The DeviceStore loaded from the database the journal belongs to
+        :param path:        -   Path of the journal file
+        :return:            -   Number of changes applied
+    """
+    applied = 0
+    if not os.path.exists(path):
+        return applied
+    with open(path) as fin:
+        for line in fin:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            record = list_dict.find('ip', entry['ip'])
+            if entry['op'] == 'add':
+                # The database may have been saved after this entry was written
+                if record is None:
+                    list_dict.append(entry['data'])
+            elif record is None:
+                continue
+            elif entry['op'] == 'update':
+                list_dict.update_record(record, entry['data'])
+            elif entry['op'] == 'delete_key':
+                if entry['data'] in record:
+                    list_dict.delete_key(record, entry['data'])
+            elif entry['op'] == 'remove':
+                list_dict.remove(record)
+            applied += 1
+    return applied
+
+
+###################
+# FAILING DEVICES #
+###################
+
+# Days a device may stay unreachable before it is removed from the database
+fail_attempt_limit = 10
+
+# Columns of the failing and removed devices CSVs
+fail_columns = ['ip', 'consec_days', 'last_attempt', 'date_added']
+removed_columns = ['ip', 'consec_days', 'date_removed']
+
+
+class FailTracker(object):
+    """ Purpose: The failing devices CSV held in memory, indexed by IP. It is read once when the run starts and only
+    written by save(), instead of reading and rewriting the CSV for every unreachable device.
+
+        - A device that fails for the first time is added with consec_days "1".
+        - Each later failure sets consec_days to the days since it was added and moves it to the end of the CSV.
+        - A device failing for more than attempt_limit days is taken out of the CSV and listed in the removed
+          devices CSV, the caller removes it from the database.
+
+    Safe to share between check worker threads.
+    """
+    def __init__(self, fail_file, removed_file, attempt_limit=fail_attempt_limit):
+        self.fail_file = fail_file
+        self.removed_file = removed_file
+        self.attempt_limit = attempt_limit
+        self.lock = threading.Lock()
+        self.records = OrderedDict()
+        self.removed = []
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.fail_file):
+            return
+        try:
+            with open(self.fail_file) as fin:
+                for record in csv.DictReader(fin):
+                    if record.get('ip'):
+                        self.records[record['ip']] = record
+        except Exception as err:
+            print "Failure loading {0} - ERROR: {1}".format(self.fail_file, err)
+
+    def failed(self, ip, now):
+        """ Purpose: Record a failed attempt to reach a device.
+
+            :param ip:          -   IP of the device
+            :param now:         -   Timestamp of the attempt (get_now_time() format)
+            :return:            -   Tuple of (days failing as a string, True if this is its first failure, True if it
+                                    exceeded the limit and should be removed)
+        """
+        with self.lock:
+            self.changed = True
+            record = self.records.pop(ip, None)
+            if record is None:
+                self.records[ip] = {'ip': ip, 'consec_days': "1", 'last_attempt': now, 'date_added': now}
+                return "1", True, False
+            # Determine calculate how long device has been unreachable
+            past_time = datetime.datetime.strptime(record['date_added'], "%Y-%m-%d_%H%M")
+            days_exp = str((datetime.datetime.now() - past_time).days)
+            if int(days_exp) > self.attempt_limit:
+                self.removed.append({'ip': ip, 'consec_days': days_exp, 'date_removed': now})
+                return days_exp, False, True
+            record['last_attempt'] = now
+            record['consec_days'] = days_exp
+            self.records[ip] = record
+            return days_exp, False, False
+
+    def save(self):
+        """ Purpose: Write the failing devices CSV, and the devices removed this run, if anything changed.
+
+            :return:            -   True if the files were written or nothing changed, False if a write failed
+        """
+        with self.lock:
+            if not self.changed:
+                return True
+            try:
+                with open(self.fail_file, 'wb') as fout:
+                    writer = csv.DictWriter(fout, fieldnames=fail_columns)
+                    writer.writeheader()
+                    writer.writerows(self.records.values())
+                if self.removed:
+                    with open(self.removed_file, 'wb') as fout:
+                        writer = csv.DictWriter(fout, fieldnames=removed_columns)
+                        writer.writeheader()
+                        writer.writerows(self.removed)
+            except Exception as err:
+                print "ERROR: Problem writing failing devices: {0}".format(err)
+                return False
+            self.changed = False
+            return True
+
+
+##################
+# SQLITE BACKEND #
+##################
+
+# Columns of the devices table that are copied out of the record for indexing
+device_columns = ['ip', 'hostname', 'serialnumber', 'version']
+
+# Columns of the inet table, one row for each inet_intf entry
+inet_columns = ['interface', 'ipaddr', 'ipmask', 'status', 'updated']
+
+
+# The SQLite file used in place of a JSON database file
+def sqlite_db_file(json_file):
+    return os.path.splitext(json_file)[0] + ".sqlite"
+
+
+class SqliteDeviceDB(object):
+    """ Purpose: SQLite storage for the device database. Each record is one row of the devices table, with the full
+    record kept as JSON and the searched values copied into indexed columns. Each inet_intf entry is a row of the inet
+    table.
+
+    save() only serializes and writes the records the DeviceStore tracked as added, changed or removed, so a run that
+    touches 50 devices writes 50 rows.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.create_tables()
+        self.rows = {}          # id(record) -> (row id, record)
+
+    def create_tables(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS devices (
+                id INTEGER PRIMARY KEY,
+                ip TEXT,
+                hostname TEXT,
+                serialnumber TEXT,
+                version TEXT,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS devices_ip ON devices (ip);
+            CREATE INDEX IF NOT EXISTS devices_hostname ON devices (hostname);
+            CREATE INDEX IF NOT EXISTS devices_serialnumber ON devices (serialnumber);
+            CREATE TABLE IF NOT EXISTS inet (
+                device_id INTEGER NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+                interface TEXT,
+                ipaddr TEXT,
+                ipmask TEXT,
+                status TEXT,
+                updated TEXT
+            );
+            CREATE INDEX IF NOT EXISTS inet_ipaddr ON inet (ipaddr);
+            CREATE INDEX IF NOT EXISTS inet_device_id ON inet (device_id);
+        """)
+        self.conn.commit()
+
+    def load(self):
+        """ Purpose: Read every record into a DeviceStore that saves back to this database.
+
+            :return:            -   DeviceStore of the records, in the order they were added
+        """
+        records = []
+        self.rows = {}
+        for row_id, text in self.conn.execute("SELECT id, record FROM devices ORDER BY id"):
+            record = json.loads(text)
+            records.append(record)
+            self.rows[id(record)] = (row_id, record)
+        store = DeviceStore(records)
+        store.backend = self
+        return store
+
+    def save(self, list_dict):
+        """ Purpose: Write the records that changed since the last load or save, in one transaction.
+
+            :param list_dict:   -   The DeviceStore to save. A plain list, or a store changed by position, has every
+                                    record written.
+            :return:            -   Number of rows written or deleted
+        """
+        lock = getattr(list_dict, 'lock', None) or threading.RLock()
+        with lock:
+            if isinstance(list_dict, DeviceStore) and not list_dict.reordered:
+                changed = list_dict.changed.values()
+                removed = list_dict.removed.values()
+            else:
+                changed = list(list_dict)
+                current = set(id(record) for record in changed)
+                removed = [record for row_id, record in self.rows.values() if id(record) not in current]
+            rows = dict(self.rows)
+            with self.conn:
+                for record in removed:
+                    row_id, saved_record = rows.get(id(record), (None, None))
+                    if saved_record is record:
+                        self.conn.execute("DELETE FROM devices WHERE id = ?", (row_id,))
+                        del rows[id(record)]
+                for record in changed:
+                    row_id, saved_record = rows.get(id(record), (None, None))
+                    if saved_record is not record:
+                        row_id = None
+                    rows[id(record)] = (self.upsert(row_id, record, json.dumps(record, sort_keys=True)), record)
+            # Only forget the changes once they are committed
+            self.rows = rows
+            if isinstance(list_dict, DeviceStore):
+                list_dict.clear_changes()
+        return len(changed) + len(removed)
+
+    def upsert(self, row_id, record, text):
+        """ Purpose: Insert or update the row of one record and replace its inet rows. Returns the row id. """
+        values = [record.get(key) for key in device_columns]
+        if row_id is None:
+            cursor = self.conn.execute("INSERT INTO devices (ip, hostname, serialnumber, version, record) "
+                                       "VALUES (?, ?, ?, ?, ?)", values + [text])
+            row_id = cursor.lastrowid
+        else:
+            self.conn.execute("UPDATE devices SET ip = ?, hostname = ?, serialnumber = ?, version = ?, record = ? "
+                              "WHERE id = ?", values + [text, row_id])
+            self.conn.execute("DELETE FROM inet WHERE device_id = ?", (row_id,))
+        for inet_intf in record.get('inet_intf', []):
+            self.conn.execute("INSERT INTO inet (device_id, interface, ipaddr, ipmask, status, updated) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", [row_id] + [inet_intf.get(key) for key in inet_columns])
+        return row_id
+
+    def find_by_address(self, ipaddr):
+        """ Purpose: Return the records with an inet interface (or primary ip) matching the address. """
+        rows = self.conn.execute("SELECT record FROM devices WHERE ip = ? OR id IN "
+                                 "(SELECT device_id FROM inet WHERE ipaddr = ?) ORDER BY id", (ipaddr, ipaddr))
+        return [json.loads(row[0]) for row in rows]
+
+    def import_json(self, json_file):
+        """ Purpose: Replace the contents of this database with the records of a JSON database file.
+
+            :param json_file:   -   Path of the JSON file (ie. main_db.json)
+            :return:            -   Number of records imported
+        """
+        with open(json_file) as fin:
+            records = json.load(fin)
+        with self.conn:
+            self.conn.execute("DELETE FROM inet")
+            self.conn.execute("DELETE FROM devices")
+        self.rows = {}
+        self.save(records)
+        return len(records)
+
+    def export_json(self, json_file):
+        """ Purpose: Write every record to a JSON file in the main_db.json layout.
+
+            :param json_file:   -   Path of the JSON file to write
+            :return:            -   Number of records exported
+        """
+        records = [json.loads(row[0]) for row in self.conn.execute("SELECT record FROM devices ORDER BY id")]
+        with open(json_file, 'w') as fout:
+            json.dump(records, fout)
+        return len(records)
+
+    def close(self):
+        self.conn.close()
+
+
+# Import or export the JSON database
+def main(argv):
+    """ Purpose: Command line access to the SQLite import and export.
+
+        devicedb.py -i <json file>      Import the JSON database into <json name>.sqlite, the tools use it from then on
+        devicedb.py -e <json file>      Export <json name>.sqlite to the JSON file
+    """
+    try:
+        opts, args = getopt.getopt(argv, "hi:e:", ["import=", "export="])
+    except getopt.GetoptError:
+        print "devicedb -i <json file> | -e <json file>"
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print 'SYNTAX: devicedb -i <json file> | -e <json file>'
+            print '  -i : Import the JSON database into SQLite. The tools use the SQLite file once it exists.'
+            print '  -e : Export the SQLite database back to the JSON file.'
+            sys.exit()
+        elif opt in ("-i", "--import"):
+            db = SqliteDeviceDB(sqlite_db_file(arg))
+            print "Imported {0} records into {1}".format(db.import_json(arg), db.db_file)
+            db.close()
+        elif opt in ("-e", "--export"):
+            db_file = sqlite_db_file(arg)
+            if not os.path.exists(db_file):
+                print "No SQLite database found: {0}".format(db_file)
+                sys.exit(2)
+            db = SqliteDeviceDB(db_file)
+            print "Exported {0} records to {1}".format(db.export_json(arg), arg)
+            db.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
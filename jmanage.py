@@ -9,10 +9,16 @@ import os
 import netaddr
 import jxmlease
 import glob
+import threading
+import Queue
 
 from jnpr.junos import *
 from jnpr.junos.exception import *
 from utility import *
+from sessions import ConnectionPool, set_default_pool, borrow_device, release_device
+from configindex import ConfigIndex, config_index_file
+from devicedb import SubnetIndex, JournalLock
+from l2snapshot import L2Snapshot, l2_snapshot_file, snapshot_max_age
 
 from ncclient import manager  # https://github.com/ncclient/ncclient
 from ncclient.transport import errors
@@ -39,9 +45,14 @@ template_csv = ''
 
 # Params
 listDict = []
+subnet_index = None
+l2_snapshot = None
+config_index = None
 mypwd = ''
 myuser = ''
 port = 22
+mac_hunt_workers = 10
+mac_hunt_timeout = 600
 
 # Key Lists
 dbase_order = [ 'hostname', 'ip', 'vc', 'version', 'model', 'serialnumber', 'last_access_attempt',
@@ -166,22 +177,37 @@ def search_menu():
     show_devices(sorted(filtered_list_dict, key=itemgetter(search_sort_on), reverse=sort_type))
 
 def pyez_connect(ip):
-    dev = Device(host=ip, passwd=mypwd, user=myuser)
     try:
-        dev.open()
+        dev = borrow_device(ip, myuser, mypwd, port=port)
     except Exception as err:
         stdout.write("Error connecting using PyEZ: {0}".format(err))
         return False
     else:
         return dev
 
+# Returns the jxmlease node as a list, a single element isn't wrapped in a list
+def as_list(node):
+    if isinstance(node, list):
+        return node
+    return [node]
+
 # Returns an interface name if MAC is found, empty string if not
 def find_mac_return_intf(dev, mac_addr, vlan_tag):
     interface = ""
-    ethsw_response = jxmlease.parse_etree(dev.rpc.get_ethernet_switching_table_information())
-    for myethtable in ethsw_response['l2ng-l2ald-rtb-macdb']['l2ng-l2ald-mac-entry-vlan']:
+    try:
+        # Only ask for this MAC in this VLAN, not the whole switching table
+        ethsw_response = jxmlease.parse_etree(dev.rpc.get_ethernet_switching_table_information(address=mac_addr,
+                                                                                               vlan_id=vlan_tag))
+    except RpcError:
+        # Releases without the filter options
+        ethsw_response = jxmlease.parse_etree(dev.rpc.get_ethernet_switching_table_information())
+    try:
+        mac_vlans = ethsw_response['l2ng-l2ald-rtb-macdb']['l2ng-l2ald-mac-entry-vlan']
+    except KeyError:
+        return interface
+    for myethtable in as_list(mac_vlans):
         if myethtable['l2ng-l2-vlan-id'].encode('utf-8') == vlan_tag:
-            for mymacentry in myethtable['l2ng-mac-entry']:
+            for mymacentry in as_list(myethtable.get('l2ng-mac-entry', [])):
                 #print "mymacentry:{0}".format(mymacentry['l2ng-l2-mac-address'].encode('utf-8'))
                 #print "MAC:{0}".format(mac_addr)
                 if mymacentry['l2ng-l2-mac-address'].encode('utf-8') == mac_addr:
@@ -190,6 +216,143 @@ def find_mac_return_intf(dev, mac_addr, vlan_tag):
                     return mymacentry['l2ng-l2-mac-logical-interface'].encode('utf-8')
     return interface
 
+def mac_hunt_worker(host_name, host_record, mac_addr, vlan_tag, found, slots, results):
+    """ Purpose: Checks one downstream switch for the MAC, unless another switch has already found it.
+        Returns: Nothing, puts (host_name, host_record, interface, status) on the results queue
+    """
+    interface = ""
+    with slots:
+        if found.is_set():
+            results.put((host_name, host_record, interface, "Skipped."))
+            return
+        host_dev = pyez_connect(host_record['ip'])
+        if not host_dev:
+            results.put((host_name, host_record, interface, "Unable to connect."))
+            return
+        status = "Not Here."
+        try:
+            if found.is_set():
+                status = "Skipped."
+            else:
+                interface = find_mac_return_intf(host_dev, mac_addr, vlan_tag)
+        except Exception as err:
+            status = "ERROR: {0}".format(err)
+        finally:
+            release_device(host_dev)
+        results.put((host_name, host_record, interface, status))
+
+def hunt_mac(list_dict, poss_hosts, mac_addr, vlan_tag):
+    """ Purpose: Checks the downstream switches for the MAC at the same time, at most mac_hunt_workers at once. The
+        first switch with the MAC ends the hunt, switches that haven't been checked yet are skipped.
+        Returns: (host_name, host_record, interface) of the switch with the MAC, or None
+    """
+    found = threading.Event()
+    slots = threading.BoundedSemaphore(mac_hunt_workers)
+    results = Queue.Queue()
+    started = 0
+    for host_name in poss_hosts:
+        host_record = get_record(list_dict, hostname=host_name)
+        if not host_record:
+            print "\t{0} -> Not in the database.".format(host_name)
+            continue
+        stdout.write("\n\tConnecting to {0}({1})".format(host_name, host_record['ip']))
+        worker = threading.Thread(target=mac_hunt_worker, args=(host_name, host_record, mac_addr, vlan_tag, found,
+                                                                slots, results))
+        worker.daemon = True
+        worker.start()
+        started += 1
+    for num in range(started):
+        try:
+            host_name, host_record, interface, status = results.get(True, mac_hunt_timeout)
+        except Queue.Empty:
+            print "\n\tTimed out waiting for the downstream switches."
+            break
+        if interface:
+            found.set()
+            stdout.write("\n\t{0}({1}) -> Interface Located!\n".format(host_name, host_record['ip']))
+            return host_name, host_record, interface
+        stdout.write("\n\t{0}({1}) -> {2}".format(host_name, host_record['ip'], status))
+    return None
+
+def get_subnet_index(list_dict):
+    """ Purpose: Returns the subnet index of the database, built the first time it is needed.
+        Returns: SubnetIndex
+    """
+    global subnet_index
+    if subnet_index is None:
+        subnet_index = SubnetIndex(list_dict)
+    return subnet_index
+
+def get_config_index():
+    """ Purpose: Returns the config search index, opened the first time it is needed.
+        Returns: ConfigIndex
+    """
+    global config_index
+    if config_index is None:
+        config_index = ConfigIndex(config_index_file(config_dir))
+    return config_index
+
+def get_l2_snapshot():
+    """ Purpose: Returns the ARP/MAC/LLDP snapshot collected by device_refresh (-L), opened the first time it is
+        needed. None if it hasn't been collected.
+        Returns: L2Snapshot or None
+    """
+    global l2_snapshot
+    if l2_snapshot is None:
+        snapshot_file = l2_snapshot_file(os.path.join(dir_path, "data"))
+        if os.path.exists(snapshot_file):
+            l2_snapshot = L2Snapshot(snapshot_file)
+    return l2_snapshot
+
+def snapshot_locate(ip_addr):
+    """ Purpose: Locates an IP from the snapshot, without connecting to any device.
+        Returns: True if the snapshot placed the IP, False if the devices need to be asked
+    """
+    snapshot = get_l2_snapshot()
+    if not snapshot:
+        return False
+    location = snapshot.locate(ip_addr, snapshot_max_age)
+    if not location:
+        print "Snapshot has no current location for {0}, checking the devices...".format(ip_addr)
+        return False
+    print "\n***** Location Of {0} *****".format(ip_addr)
+    print "Device: ........ {0}".format(location['hostname'])
+    print "MAC Address: ... {0}".format(location['mac'])
+    print "Interface: ..... {0}".format(location['interface'])
+    print "VLAN: .......... {0}".format(location['vlan'])
+    print "ARP Record: .... {0} ({1})".format(location['arp_host'], location['arp_interface'])
+    print "Collected: ..... {0}".format(location['collected'])
+    return True
+
+def ip_list_locate_menu(list_dict):
+    """
+        Purpose: Finds the devices with the most specific network for every IP in a file, and writes them to a CSV
+        in the logs folder.
+        Returns: Nothing
+    """
+    ip_file = getOptionAnswer("Choose a file with the IPs to locate", getFileList(iplist_dir, 'txt'))
+    if not ip_file:
+        return
+    ip_list = txt_to_list(os.path.join(iplist_dir, ip_file))
+    if not ip_list:
+        print "No IPs found in {0}".format(ip_file)
+        return
+    ip_list = [ip_addr.strip() for ip_addr in ip_list]
+    results = []
+    not_found = 0
+    for ip_addr, matches in get_subnet_index(list_dict).lookup_many(ip_list):
+        if not matches:
+            not_found += 1
+            results.append({'target_ip': ip_addr, 'hostname': '', 'ip': '', 'interface': '', 'network': ''})
+        for prefixlen, device, my_intf in matches:
+            results.append({'target_ip': ip_addr, 'hostname': device['hostname'], 'ip': device['ip'],
+                            'interface': my_intf.get('interface', ''),
+                            'network': my_intf['ipaddr'] + '/' + my_intf['ipmask']})
+    csv_name = os.path.join(log_dir, "IP_Locate_" + get_now_time() + ".csv")
+    listdict_to_csv(results, csv_name, ";", ['target_ip', 'hostname', 'ip', 'interface', 'network'])
+    print "Located {0} of {1} IPs".format(len(ip_list) - not_found, len(ip_list))
+    print "Results: {0}".format(csv_name)
+
 def ip_search_menu(list_dict):
     """ 
         Purpose: Identifies exact location of a single IP address
@@ -203,138 +366,120 @@ def ip_search_menu(list_dict):
         #stdout.write("Checking Database For Network...")
         match_found = False
         print "Looking for ... {0}".format(user_input)
-        for device in list_dict:
-            is_target = False
-            stdout.write(".")
-            if 'inet_intf' in device:
-                # Loop over route points on this device, checking for matching network
-                for my_intf in device['inet_intf']:
-                    if IPAddress(user_input) in IPNetwork(my_intf['ipaddr'] + '/' + my_intf['ipmask']):
-                        print "\nFound Possible Match:"
-                        print "\tDevice: ............ {0} ({1})".format(device['hostname'], device['ip'])
-                        print "\tTarget IP: ......... {0}".format(user_input)
-                        print "\tMatched IP: ........ {0}".format(my_intf['ipaddr'] + '/' + my_intf['ipmask'])
-                        is_target = True
-                        # Break out of this loop
-                        break
-                # If we found a device with a network match...
-                if is_target:
-                    # Connect to device
-                    dev = pyez_connect(device['ip'])
-                    # If I can connect to the device...
-                    if dev:
-
-                        # Device Variables
-                        mac_addr = ''
-                        intf_name = ''
-
-                        # Collect ARP information from the route-point for target IP
-                        try:
-                            arp_response = jxmlease.parse_etree(dev.rpc.get_arp_table_information())
-                        except RpcTimeoutError as err:
-                            print "RPC Timeout Error: {0}".format(err)
-                        except Exception as err:
-                            print "Exception Caught: {0}".format(err)
-                        else:
-                            # Loop over ARP data to find a match
-                            is_match = False
-                            for myarp in arp_response['arp-table-information']['arp-table-entry']:
-                                # Loop over ARP entries and check for target IP
-                                if myarp['ip-address'].encode('utf-8') == user_input:
-                                    intf_name = myarp['interface-name'].encode('utf-8')
-                                    mac_addr = myarp['mac-address'].encode('utf-8')
-                                    print "\n\tExact ARP Record Found!"
-                                    print "\t\tARP IP: ........... {0}".format(myarp['ip-address'].encode('utf-8'))
-                                    print "\t\tARP Mac Address: .. {0}".format(mac_addr)
-                                    print "\t\tARP Interface: .... {0}".format(intf_name)
-                                    is_match = True
-                                    # Get out of loop after we find an exact match
-                                    break
-                            # If we got an exact match...
-                            if is_match:
-                                # If the interface is a VLAN or IRB, ie. vlan.XXX, then user port is on a different switch
-                                if 'vlan' in intf_name or 'irb' in intf_name:
-                                    print "\n\tPhysical Interface is on a downstream switch."
-                                    intf_list = []
-                                    vlan_tag = intf_name.rsplit('.',1)[1]
-                                    #print "VLAN Tag: {0}".format(vlan_tag)
-
-                                    # Get VLAN information to determine the possible interfaces this IP could exist on
-                                    vlan_response = jxmlease.parse_etree(dev.rpc.get_vlan_information())
-                                    # If the device is a NON-ELS switch (EX4550,EX4200,EX6200)
-                                    if 'vlan' in intf_name:
-                                        for myvlan in vlan_response['vlan-information']['vlan']:
-                                            if myvlan['vlan-tag'] == vlan_tag:
-                                                for vlan_intf in myvlan['vlan-detail']['vlan-member-list']['vlan-member']:
-                                                    if "*" in vlan_intf['vlan-member-interface']:
-                                                        myintf = vlan_intf['vlan-member-interface'].encode('utf-8').rsplit('*',1)[0]
-                                                        #print "VLAN INTERFACE: {0}".format(myintf)
-                                                        intf_list.append(myintf)
-                                    # If the device is an ELS switch (EX4300)
-                                    else:
-                                        for myvlan in vlan_response['l2ng-l2ald-vlan-instance-information']['l2ng-l2ald-vlan-instance-group']:
-                                            if myvlan['l2ng-l2rtb-vlan-tag'] == vlan_tag:
-                                                for vlan_intf in myvlan['l2ng-l2rtb-vlan-member']:
-                                                    if "*" in vlan_intf['l2ng-l2rtb-vlan-member-interface']:
-                                                        myintf = vlan_intf['l2ng-l2rtb-vlan-member-interface'].encode('utf-8').rsplit('*',1)[0]
-                                                        #print "VLAN INTEFACE: {0}".format(myintf)
-                                                        intf_list.append(myintf)
-
-                                    # Use LLDP info to get possible hosts
-                                    lldp_response = jxmlease.parse_etree(dev.rpc.get_lldp_neighbors_information())
-                                    poss_hosts = []
-                                    for mylldp in lldp_response['lldp-neighbors-information'][
-                                        'lldp-neighbor-information']:
-                                        for myintf in intf_list:
-                                            if myintf == mylldp['lldp-local-interface'].encode(
-                                                    'utf-8') or myintf == mylldp[
-                                                'lldp-local-parent-interface-name'].encode('utf-8'):
-                                                host_name = mylldp['lldp-remote-system-name'].encode(
-                                                    'utf-8')
-                                                if host_name not in poss_hosts:
-                                                    poss_hosts.append(host_name)
-                                                    break
-                                    print "\tPossible Switches: {0}".format(poss_hosts)
-
-                                    # Search downstream devices for MAC
-                                    for host_name in poss_hosts:
-                                        host_record = get_record(list_dict, hostname=host_name)
-                                        stdout.write("\n\tConnecting to {0}({1}) -> ".format(host_name, host_record['ip']))
-                                        host_dev = pyez_connect(host_record['ip'])
-                                        if host_dev:
-                                            stdout.write("Connected! -> ")
-                                            interface = find_mac_return_intf(host_dev, mac_addr, vlan_tag)
-                                            if interface:
-                                                print "Interface Located!"
-                                                print "\n***** Location Of {0} *****".format(user_input)
-                                                print "Device: ........ {0}({1})".format(host_name, host_record['ip'])
-                                                print "MAC Address: ... {0}".format(mac_addr)
-                                                print "Interface: ..... {0}".format(interface)
-                                                print "VLAN: .......... {0}".format(vlan_tag)
-                                                match_found = True
-                                                break
-                                            else:
-                                                stdout.write("Not Here.")
-                                # Otherwise, the interface is local, let's get the local interface
-                                else:
-                                    print "\n\tPhysical Interface is on this switch."
-                                    pass
-                            # If no exact match is found...
+        # Answer from the snapshot if it's current, otherwise ask the devices
+        if snapshot_locate(user_input):
+            return
+        # Devices with a network containing the IP, most specific network first
+        tried = []
+        for prefixlen, device, my_intf in get_subnet_index(list_dict).matches(user_input):
+            # Each device is only tried once, on its most specific network
+            if device['ip'] in tried:
+                continue
+            tried.append(device['ip'])
+            print "\nFound Possible Match:"
+            print "\tDevice: ............ {0} ({1})".format(device['hostname'], device['ip'])
+            print "\tTarget IP: ......... {0}".format(user_input)
+            print "\tMatched IP: ........ {0}".format(my_intf['ipaddr'] + '/' + my_intf['ipmask'])
+            # Connect to device
+            dev = pyez_connect(device['ip'])
+            # If I can connect to the device...
+            if dev:
+
+                # Device Variables
+                mac_addr = ''
+                intf_name = ''
+
+                # Collect ARP information from the route-point for target IP
+                try:
+                    arp_response = jxmlease.parse_etree(dev.rpc.get_arp_table_information())
+                except RpcTimeoutError as err:
+                    print "RPC Timeout Error: {0}".format(err)
+                except Exception as err:
+                    print "Exception Caught: {0}".format(err)
+                else:
+                    # Loop over ARP data to find a match
+                    is_match = False
+                    for myarp in arp_response['arp-table-information']['arp-table-entry']:
+                        # Loop over ARP entries and check for target IP
+                        if myarp['ip-address'].encode('utf-8') == user_input:
+                            intf_name = myarp['interface-name'].encode('utf-8')
+                            mac_addr = myarp['mac-address'].encode('utf-8')
+                            print "\n\tExact ARP Record Found!"
+                            print "\t\tARP IP: ........... {0}".format(myarp['ip-address'].encode('utf-8'))
+                            print "\t\tARP Mac Address: .. {0}".format(mac_addr)
+                            print "\t\tARP Interface: .... {0}".format(intf_name)
+                            is_match = True
+                            # Get out of loop after we find an exact match
+                            break
+                    # If we got an exact match...
+                    if is_match:
+                        # If the interface is a VLAN or IRB, ie. vlan.XXX, then user port is on a different switch
+                        if 'vlan' in intf_name or 'irb' in intf_name:
+                            print "\n\tPhysical Interface is on a downstream switch."
+                            intf_list = []
+                            vlan_tag = intf_name.rsplit('.',1)[1]
+                            #print "VLAN Tag: {0}".format(vlan_tag)
+
+                            # Get VLAN information to determine the possible interfaces this IP could exist on
+                            vlan_response = jxmlease.parse_etree(dev.rpc.get_vlan_information())
+                            # If the device is a NON-ELS switch (EX4550,EX4200,EX6200)
+                            if 'vlan' in intf_name:
+                                for myvlan in vlan_response['vlan-information']['vlan']:
+                                    if myvlan['vlan-tag'] == vlan_tag:
+                                        for vlan_intf in myvlan['vlan-detail']['vlan-member-list']['vlan-member']:
+                                            if "*" in vlan_intf['vlan-member-interface']:
+                                                myintf = vlan_intf['vlan-member-interface'].encode('utf-8').rsplit('*',1)[0]
+                                                #print "VLAN INTERFACE: {0}".format(myintf)
+                                                intf_list.append(myintf)
+                            # If the device is an ELS switch (EX4300)
                             else:
-                                print "\tNo Exact Matches in this Device!"
-                    # Unable to connect to device
+                                for myvlan in vlan_response['l2ng-l2ald-vlan-instance-information']['l2ng-l2ald-vlan-instance-group']:
+                                    if myvlan['l2ng-l2rtb-vlan-tag'] == vlan_tag:
+                                        for vlan_intf in myvlan['l2ng-l2rtb-vlan-member']:
+                                            if "*" in vlan_intf['l2ng-l2rtb-vlan-member-interface']:
+                                                myintf = vlan_intf['l2ng-l2rtb-vlan-member-interface'].encode('utf-8').rsplit('*',1)[0]
+                                                #print "VLAN INTEFACE: {0}".format(myintf)
+                                                intf_list.append(myintf)
+
+                            # Use LLDP info to get possible hosts
+                            lldp_response = jxmlease.parse_etree(dev.rpc.get_lldp_neighbors_information())
+                            poss_hosts = []
+                            for mylldp in lldp_response['lldp-neighbors-information'][
+                                'lldp-neighbor-information']:
+                                for myintf in intf_list:
+                                    if myintf == mylldp['lldp-local-interface'].encode(
+                                            'utf-8') or myintf == mylldp[
+                                        'lldp-local-parent-interface-name'].encode('utf-8'):
+                                        host_name = mylldp['lldp-remote-system-name'].encode(
+                                            'utf-8')
+                                        if host_name not in poss_hosts:
+                                            poss_hosts.append(host_name)
+                                            break
+                            print "\tPossible Switches: {0}".format(poss_hosts)
+
+                            # Search downstream devices for MAC
+                            located = hunt_mac(list_dict, poss_hosts, mac_addr, vlan_tag)
+                            if located:
+                                host_name, host_record, interface = located
+                                print "\n***** Location Of {0} *****".format(user_input)
+                                print "Device: ........ {0}({1})".format(host_name, host_record['ip'])
+                                print "MAC Address: ... {0}".format(mac_addr)
+                                print "Interface: ..... {0}".format(interface)
+                                print "VLAN: .......... {0}".format(vlan_tag)
+                                match_found = True
+                        # Otherwise, the interface is local, let's get the local interface
+                        else:
+                            print "\n\tPhysical Interface is on this switch."
+                            pass
+                    # If no exact match is found...
                     else:
-                        #print "\tUnable to connect!"
-                        stdout.write("C")
-                        pass
-                # Device without a network match
-                else:
-                    stdout.write("_")
-                    pass
-            # If 'inet_intf' info isn't in this device
+                        print "\tNo Exact Matches in this Device!"
+                # Keep the session for the next search
+                release_device(dev)
+            # Unable to connect to device
             else:
-                #print "Incomplete information - Skipping Device"
-                stdout.write("I")
+                #print "\tUnable to connect!"
+                stdout.write("C")
                 pass
             if match_found:
                 break
@@ -368,12 +513,18 @@ def show_devices(list_dict):
     print "Device Total: {0}".format(len(list_dict))
 
 # 1. User provides a configuration statement in the "set" format.
-# 2. Function scans all configurations for the provided statement
-# 3. Regex Options: ANY,
+# 2. Function searches the config index for the provided statement
+# 3. Search Options: Contains, Starts With, Regex
 def search_configs(list_dict):
     # Capture commands to search for
     set_command_list = getMultiInputAnswer("Enter a command to search for")
 
+    # Ask user how the commands should be matched
+    search_types = {'Contains': 'contains', 'Starts With': 'prefix', 'Regex': 'regex'}
+    search_type = getOptionAnswer("How should the commands match", ['Contains', 'Starts With', 'Regex'])
+    if not search_type:
+        return
+
     # Ask user if all commands must be matched (if more than one command is provided)
     and_tf = False
     if len(set_command_list) > 1:
@@ -383,70 +534,41 @@ def search_configs(list_dict):
     dev_count = 0
     ip_list = []
 
-    # Search configs directory recursively for content
-    for folder, dirs, files in os.walk(config_dir):
-        firstpass = True
-        best_timestamp = ""
-        best_filepath = ""
-        best_filename = ""
-        hostname = ""
-
-        # Loop over files and get the newest configuration file
-        for file in files:
-            #print "File: {0}".format(file)
-            if re.match(".*\d{4}-\d{2}-\d{2}_\d{4}.conf", file):
-                file_time = re.search("\d{4}-\d{2}-\d{2}_\d{4}", file)
-                text_ext = file[file_time.start():file_time.end()]
-                hostname = os.path.split(folder)[1]
-
-                #print "Time: {0}".format(text_ext)
-                curr_timestamp = datetime.datetime.strptime(text_ext, "%Y-%m-%d_%H%M")
-                if firstpass:
-                    best_timestamp = curr_timestamp
-                    best_filepath = os.path.join(folder, file)
-                    best_filename = file
-                    firstpass = False
-                else:
-                    if curr_timestamp > best_timestamp:
-                        best_filepath = os.path.join(folder, file)
-                        best_filename = file
-                        best_timestamp = curr_timestamp
-        #print "Best File: {0} Timestamp: {1}".format(best_filepath, best_timestamp)
-        if best_filepath:
-            cap_list = []
-            # Loop over the commands we are looking for
-            for set_command in set_command_list:
-                # Open the configuration file
-                with open(best_filepath, 'r') as file:
-                    matched = False
-                    # Assign a line to the 'line' variable
-                    for line in file:
-                        # Check if the command is in this line
-                        if set_command in line:
-                            matched = True
-                            cap_list.append("\t\t- " + line.rstrip())
-                            #break   # Leave the for loop, we've found a match
-                # Check if we need to clear this (assuming this is an AND)
-                if and_tf and not matched:
-                    cap_list = []
-                    matched = False
-                    break
-
-            # If we matched something, print to the screen
-            if cap_list:
-                dev_count += 1
-                dev_rec = get_record(list_dict, hostname=hostname)
-                if dev_rec:
-                    print "Hostname: {0} {1}".format(hostname, dev_rec['ip'])
-                    ip_list.append(dev_rec['ip'])
-                else:
-                    print "Hostname: {0} (IP Unknown)".format(hostname)
-                print "\tBest File: {0}".format(best_filename)
-                print "\tExtracted Time: {0}".format(best_timestamp)
-                for cap in cap_list:
-                    print cap
-                print ""
-                # print "HOST: {0}".format(hostname)
+    # Build the config index the first time. After that device_refresh keeps it current as configs are saved and
+    # devices removed, "configindex.py -s <configs dir>" catches it up with changes made any other way.
+    index = get_config_index()
+    if not index.host_count():
+        print "Building the configuration index..."
+        print "Indexed {0} devices".format(index.sync(config_dir))
+
+    # Search the index for each command
+    host_matches = {}
+    for set_command in set_command_list:
+        try:
+            results = index.search(set_command, search_types[search_type])
+        except re.error as err:
+            print "Invalid regex: {0} ERROR: {1}".format(set_command, err)
+            return
+        for hostname, lines in results.iteritems():
+            host_matches.setdefault(hostname, []).append(lines)
+
+    for hostname in sorted(host_matches):
+        # Check if we need to skip this (assuming this is an AND)
+        if and_tf and len(host_matches[hostname]) < len(set_command_list):
+            continue
+        dev_count += 1
+        dev_rec = get_record(list_dict, hostname=hostname)
+        if dev_rec:
+            print "Hostname: {0} {1}".format(hostname, dev_rec['ip'])
+            ip_list.append(dev_rec['ip'])
+        else:
+            print "Hostname: {0} (IP Unknown)".format(hostname)
+        print "\tConfig Saved: {0}".format(index.config_info(hostname).get('saved'))
+        for lines in host_matches[hostname]:
+            for line in lines:
+                print "\t\t- " + line
+        print ""
+
     # IP list from these devices
     ip_list_name = os.path.join(iplist_dir, "search_ip_list.txt")
     if not list_to_txt(ip_list_name, ip_list):
@@ -460,6 +582,7 @@ def delete_menu():
     """ Purpose: Menu for selecting a record to delete.
         Returns: T/F
     """
+    global subnet_index
     search_key = "placeholder"
     search_dict = {}
 
@@ -486,16 +609,36 @@ def delete_menu():
     if host_list:
         host_answer_list = getOptionMultiAnswer("Which devices would you like to delete", host_list)
         if host_answer_list:
-            for hostname in host_answer_list:
-                if remove_record(listDict, 'hostname', hostname, config_dir):
-                    print "Removed: {0}".format(hostname)
+            # The database and its journal belong to device_refresh while it runs
+            journal_lock = JournalLock(main_list_dict)
+            if not journal_lock.acquire():
+                print "device_refresh is running (pid {0}), delete once it completes.".format(journal_lock.owner())
+                return
+            try:
+                # Change the database as it is saved now, with its journal folded in and emptied, rather than the
+                # copy loaded when jmanage started
+                saved_db = load_device_db(main_list_dict, journal_owner=True)
+                if saved_db is False:
+                    print "Removal Failed: Unable to load the device database!"
+                    return
+                # The subnet index is rebuilt on the next IP search
+                subnet_index = None
+                for hostname in host_answer_list:
+                    if remove_record(saved_db, 'hostname', hostname, config_dir, get_config_index()):
+                        for record in listDict.find_all('hostname', hostname):
+                            listDict.remove(record)
+                        if get_l2_snapshot():
+                            get_l2_snapshot().remove(hostname)
+                        print "Removed: {0}".format(hostname)
+                    else:
+                        print "Removal Failed: {0}".format(hostname)
+                stdout.write("Applying database changes (" + main_list_dict + "): ")
+                if save_device_db(saved_db, main_list_dict):
+                    print "Successful!"
                 else:
-                    print "Removal Failed: {0}".format(hostname)
-            stdout.write("Applying database changes (" + main_list_dict + "): ")
-            if write_to_json(listDict, main_list_dict):
-                print "Successful!"
-            else:
-                print "Failed!"
+                    print "Failed!"
+            finally:
+                journal_lock.release()
     else:
         print "No hosts in the defined criteria!"
 
@@ -582,11 +725,18 @@ if __name__ == '__main__':
     mypwd = creds['password']
     print "User: {0} | Pass: {1}".format(myuser, mypwd)
 
+    # Keep sessions open between searches, route-points and access switches are hit repeatedly
+    set_default_pool(ConnectionPool(myuser, mypwd, port=port, idle_timeout=900))
+
     # Load Main Database
-    listDict = json_to_listdict(main_list_dict)
+    listDict = load_device_db(main_list_dict)
+    if listDict is False:
+        print "Unable to load the device database ({0})!".format(main_list_dict)
+        quit()
 
     # Main Program Loop
-    my_options = ['Display Database', 'Search Database', 'Search Configurations', 'Display Device', 'IP Search', 'Delete Record', 'Quit']
+    my_options = ['Display Database', 'Search Database', 'Search Configurations', 'Display Device', 'IP Search',
+                  'IP List Locate', 'Delete Record', 'Quit']
 
     try:
         while True:
@@ -619,9 +769,12 @@ if __name__ == '__main__':
                 print "Run -> IP Search"
                 ip_search_menu(listDict)
             elif answer == "6":
+                print "Run -> IP List Locate"
+                ip_list_locate_menu(listDict)
+            elif answer == "7":
                 print "Run -> Delete Record"
                 delete_menu()
-            elif answer == "7":
+            elif answer == "8":
                 print "Goodbye!"
                 quit()
             else:
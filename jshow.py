@@ -21,14 +21,20 @@ from jnpr.junos.utils.sw import SW
 from jnpr.junos.exception import *
 from ncclient.operations.errors import TimeoutExpiredError
 from utility import *
+from sessions import SessionManager, ConnectionPool, set_default_pool, borrow_device, release_device
 from getpass import getpass
 from prettytable import PrettyTable
 from sys import stdout
 from shutil import copyfile
-from multiprocessing import Pool
+from deployexec import DeployExecutor, site_key
 
 # Global Variables
 ssh_port = 22
+deploy_workers = 5               # Devices pushed at once when a deployment starts
+deploy_max_workers = 20          # Most devices pushed at once, the executor adapts between 1 and this
+deploy_site_limit = 5            # Most devices of one building pushed at once
+summary_keys = ['HOSTNAME', 'IP', 'MODEL', 'JUNOS', 'REACHABLE', 'LOAD_SUCCESS', 'ERROR']
+single_keys = ['HOSTNAME', 'IP', 'MODEL', 'JUNOS', 'CONNECTED', 'LOAD_SUCCESS', 'ERROR']
 username = ''
 password = ''
 
@@ -123,17 +129,37 @@ def detect_env():
 # Handles arguments provided at the command line
 def getargs(argv):
     # Interprets and handles the command line arguments
+    global deploy_workers
+    global deploy_max_workers
+    global deploy_site_limit
+    user = ''
     try:
-        opts, args = getopt.getopt(argv, "hu:", ["user="])
+        opts, args = getopt.getopt(argv, "hu:w:x:b:", ["user=", "workers=", "max-workers=", "building-limit="])
     except getopt.GetoptError:
-        print("jscan.py -u <username>")
+        print("jscan.py -u <username> -w <workers> -x <max workers> -b <building limit>")
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print("jscan.py -u <username>")
+            print("jscan.py -u <username> -w <workers> -x <max workers> -b <building limit>")
+            print("  -w : (OPTIONAL) Devices pushed at once when a deployment starts. (Default is 5)")
+            print("  -x : (OPTIONAL) Most devices pushed at once, it adapts to errors and latency. (Default is 20)")
+            print("  -b : (OPTIONAL) Most devices of one building pushed at once. (Default is 5)")
             sys.exit()
         elif opt in ("-u", "--user"):
-            return arg
+            user = arg
+        elif opt in ("-w", "--workers", "-x", "--max-workers", "-b", "--building-limit"):
+            try:
+                value = max(1, int(arg))
+            except ValueError:
+                print("Invalid number for {0}: {1}".format(opt, arg))
+                sys.exit(2)
+            if opt in ("-w", "--workers"):
+                deploy_workers = value
+            elif opt in ("-x", "--max-workers"):
+                deploy_max_workers = value
+            else:
+                deploy_site_limit = value
+    return user
 
 # Function to exit program
 def quit():
@@ -543,18 +569,22 @@ def template_push(host_list):
     output_log = create_timestamped_log("template_output_", "log")
     summary_csv_name = "results_summary_" + get_now_time() + ".csv"
     summary_csv_file = os.path.join(log_dir, summary_csv_name)
-    loop = 0
+    jobs = []
     for host in host_list:
-        loop += 1
         host_template_file = getFilename(temp_config_dir, host['HOSTNAME'], ext_filter="conf")
-        stdout.write("[{0} of {1}]: Connected to {2}!\n".format(loop, len(host_list), host['MGMT_IP']))
-        dev_dict = push_commands_single(host_template_file, output_log, host['MGMT_IP'])
+        jobs.append((site_key(host['MGMT_IP'], host['HOSTNAME']), (host_template_file, output_log, host['MGMT_IP'])))
+
+    # Results are written as each device finishes
+    def on_result(job, dev_dict, error):
+        dev_dict = push_result(dev_dict, job[2], error, 'CONNECTED')
+        stdout.write("[{0} of {1}]: {2} Finished\n".format(len(results_list) + 1, len(jobs), job[2]))
         screen_and_log("\n" + ("-" * 110) + "\n", output_log)
         # Print to a CSV file
-        keys = ['HOSTNAME', 'IP', 'MODEL', 'JUNOS', 'CONNECTED', 'LOAD_SUCCESS', 'ERROR']
-        dict_to_csv(dev_dict, summary_csv_file, keys)
+        dict_to_csv(dev_dict, summary_csv_file, single_keys)
         results_list.append(dev_dict)
 
+    deploy_executor().run(push_commands_job, jobs, on_result, failed=push_failed, initializer=push_init,
+                          initargs=(username, password))
     return results_list
 
 # Template function for bulk set command deployment
@@ -715,7 +745,6 @@ def deploy_template_config(template_file, dev_vars_ld, output_log, summary_csv):
 
     ##### MULTIPROCESSING #####
     # Create Tuple of Devices
-    queue_num = 5                   # The max number of devices that can be connected to at one time
     list_seq = 1                    # Starting sequence of devices
     list_len = len(dev_vars_ld)     # Total number of devices
     ip_pool = ()                    # List for storing process specific parameters
@@ -749,18 +778,23 @@ def deploy_template_config(template_file, dev_vars_ld, output_log, summary_csv):
     #pp = pprint.PrettyPrinter(indent=4)
     #print "IP Pool:"
     #pp.pprint(ip_pool)
-    p = Pool(queue_num)
+    jobs = []
+    for device, device_vars in zip(dev_vars_ld, ip_pool):
+        jobs.append((site_key(device['MGMT_IP'], device.get('HOSTNAME', '')), device_vars))
+
+    # The summary is written as each device finishes, the workers' log output comes back with their results
+    results = []
+    def on_result(attr, dev_dict, error):
+        dev_dict = push_result(dev_dict, attr[2], error, 'REACHABLE')
+        write_push_result(summary_csv, dev_dict)
+        results.append(dev_dict)
+
     try:
-        results = p.map(push_commands_multi, ip_pool)
-    except TypeError as err:
-        print "Map Command Failed: {0}".format(err)
-        return False
+        deploy_executor().run(push_commands_multi, jobs, on_result, failed=push_failed, initializer=push_init,
+                              initargs=(username, password))
     except Exception as err:
         print "Unknown Error: {0}".format(err)
         return False
-    else:
-        p.close()
-        p.join()
 
     return results
     
@@ -795,16 +829,15 @@ def connect(ip, username, password):
     """ Purpose: Attempt to connect to the device
 
     :param ip:          -   IP of the device
-    :param indbase:     -   Boolean if this device is in the database or not, defaults to False if not specified
-    :return dev:        -   Returns the device handle if its successfully opened.
+    :param username:    -   Username to login with
+    :param password:    -   Password to login with
+    :return dev:        -   Returns the device handle if its successfully opened. Return it with release_device().
     """
-    dev = Device(host=ip, user=username, password=password)
     message = ""
 
     # Try to open a connection to the device
     try:
-        dev.open()
-        dev.timeout = 700
+        dev = borrow_device(ip, username, password, port=ssh_port, timeout=700)
     # If there is an error when opening the connection, display error and exit upgrade process
     except ConnectRefusedError as err:
         message = "Host Reachable - but NETCONF not configured."
@@ -828,6 +861,48 @@ def connect(ip, username, password):
     else:
         return dev, message
 
+def push_init(user, pwd):
+    """ Purpose: Sets up a push worker process with the credentials and a session pool of its own. The sessions the
+    parent had open are left to the parent.
+
+    :param user:        -   Username to login with
+    :param pwd:         -   Password to login with
+    :return:            -   None
+    """
+    global username
+    global password
+    username = user
+    password = pwd
+    set_default_pool(ConnectionPool(username, password, port=ssh_port, idle_timeout=1800, timeout=700))
+
+def deploy_executor():
+    """ Purpose: The executor the deployment paths share, sized by the command line options. """
+    return DeployExecutor(workers=deploy_workers, max_workers=deploy_max_workers, site_limit=deploy_site_limit)
+
+def push_result(dev_dict, ip, error, connect_key):
+    """ Purpose: Returns the summary of a device, or a failed summary if its push raised an exception.
+
+    :param dev_dict:    -   Summary returned by the push, None if it raised
+    :param ip:          -   IP of the device
+    :param error:       -   Error message of the exception
+    :param connect_key: -   Summary key that says if the device was reached (REACHABLE or CONNECTED)
+    :return:            -   Summary dictionary
+    """
+    if dev_dict is None:
+        dev_dict = {'IP': ip, 'HOSTNAME': 'Unknown', 'MODEL': 'Unknown', 'JUNOS': 'Unknown', connect_key: False,
+                    'LOAD_SUCCESS': False, 'ERROR': "Push Failed: {0}".format(error)}
+    return dev_dict
+
+# A push counts against the executor's error rate if the configuration didn't load
+def push_failed(dev_dict):
+    return not dev_dict['LOAD_SUCCESS']
+
+def write_push_result(summary_csv, dev_dict):
+    # Save content to the CSV summary file
+    dict_to_csv(dev_dict, summary_csv, summary_keys)
+    # Same summary as a JSON-lines record
+    write_json_log(dev_dict, os.path.splitext(summary_csv)[0] + ".jsonl")
+
 # Function to push commands using multiple processing streams
 def push_commands_multi(attr):
     dev_dict = {'IP': attr[2], 'HOSTNAME': 'Unknown', 'MODEL': 'Unknown', 'JUNOS': 'Unknown', 'REACHABLE': False,
@@ -862,21 +937,18 @@ def push_commands_multi(attr):
         else:
             #screen_and_log("Moving to next device...\n", attr[1])
             dev_dict['ERROR'] = "Issue Loading Configuration: " + results
+        # This runs in a worker process, so don't keep the session around
+        release_device(dev, discard=True)
     # If there were errors connecting to device...
     else:
         dev_dict['ERROR'] = "Unable to Connect! : {0}".format(message)
         screen_and_log("{0} [{1} of {2}]: {3}\n".format(attr[2], attr[4], attr[3], dev_dict['ERROR']), attr[1])
 
-    # Print results to a CSV file
-    keys = ['HOSTNAME', 'IP', 'MODEL', 'JUNOS', 'REACHABLE', 'LOAD_SUCCESS', 'ERROR']
-    # Save content to the CSV summary file
-    dict_to_csv(dev_dict, attr[5], keys)
-
     # Return this to the calling function
     return dev_dict
 
 # Function to push commands, via file, to one device at a time
-def push_commands_single(commands_fp, output_log, ip):
+def push_commands_single(commands_fp, output_log, ip, discard=False):
     dev_dict = {'IP': ip, 'HOSTNAME': 'Unknown', 'MODEL': 'Unknown', 'JUNOS': 'Unknown', 'CONNECTED': False,
                 'LOAD_SUCCESS': False, 'ERROR': ''}
     dev, message = connect(ip, username, password)
@@ -899,8 +971,8 @@ def push_commands_single(commands_fp, output_log, ip):
             dev_dict['LOAD_SUCCESS'] = True
         else:
             dev_dict['ERROR'] = "Issue Loading Configuration: " + results
-        # Close connection to the device
-        dev.close()
+        # Return the connection to the pool
+        release_device(dev, discard)
     # If there were errors connecting to device...
     else:
         dev_dict['ERROR'] = "Unable to Connect! : {0}\n".format(message)
@@ -909,24 +981,36 @@ def push_commands_single(commands_fp, output_log, ip):
     # Return this to the calling function
     return dev_dict
 
+# Push worker for the deploy executor, the job is (commands_fp, output_log, ip)
+def push_commands_job(job):
+    # This runs in a worker process, so don't keep the session around
+    return push_commands_single(job[0], job[1], job[2], discard=True)
+
 # Function for capturing output and initiaing push function
 def deploy_config(commands_fp, my_ips, output_log, summary_csv):
     # Lists
     dict_of_lists = {'devs_connected': [], 'devs_successful': []}
 
-    # Loop over all devices in my_ips list
-    loop = 0
+    # Push to the devices in my_ips, results are written as each device finishes
+    jobs = []
     for ip in my_ips:
-        loop += 1
-        stdout.write("[{0} of {1}] - Connecting to {2} ... ".format(loop, len(my_ips), ip))
-        results = push_commands_single(commands_fp, output_log, ip)
+        jobs.append((site_key(ip), (commands_fp, output_log, ip)))
+    finished = []
+
+    def on_result(job, results, error):
+        ip = job[2]
+        results = push_result(results, ip, error, 'CONNECTED')
+        finished.append(ip)
+        stdout.write("[{0} of {1}] - {2} Finished\n".format(len(finished), len(my_ips), ip))
         screen_and_log("\n" + ("-" * 110) + "\n", output_log)
         if results['CONNECTED']: dict_of_lists['devs_connected'].append(ip)
         if results['LOAD_SUCCESS']: dict_of_lists['devs_successful'].append(ip)
 
         # Print to a CSV file
-        keys = ['HOSTNAME', 'IP', 'MODEL', 'JUNOS', 'CONNECTED', 'LOAD_SUCCESS', 'ERROR']
-        dict_to_csv(results, summary_csv, keys)
+        dict_to_csv(results, summary_csv, single_keys)
+
+    deploy_executor().run(push_commands_job, jobs, on_result, failed=push_failed, initializer=push_init,
+                          initargs=(username, password))
 
     # Return the dicts of lists with results
     return dict_of_lists
@@ -1082,6 +1166,36 @@ def get_chassis_inventory(dev, hostname):
         listdict_to_csv(inventory_listdict, inv_csv, columnNames=item_key)
         print "Added Device Inventory to {0}!".format(inv_csv)
 
+# Runs the operational commands on one device, called from a session worker
+def run_oper_commands(dev, command_list):
+    """ Purpose: Execute the operational commands on an open device. Output and errors are returned instead of
+        printed so the caller can write each device's output as one block.
+
+        :param dev:             -   The PyEZ connection object (SSH Netconf)
+        :param command_list:    -   List of commands to run, an empty list captures the chassis inventory instead
+        :return:                -   Dictionary with the hostname, output, got_output flag and error messages
+    """
+    ip = dev.hostname
+    hostname = dev.facts['hostname']
+    if not hostname:
+        hostname = "Unknown"
+    results = {'hostname': hostname, 'output': '', 'got_output': False, 'errors': []}
+    if command_list:
+        for command in command_list:
+            results['output'] += "\n" + hostname + " (" + ip + "): Executing -> {0}\n".format(command)
+            try:
+                output = dev.cli(command, warning=False)
+            except Exception as err:
+                results['errors'].append("{0}: Error executing '{1}'. ERROR: {2}\n".format(ip, command, err))
+            else:
+                if output:
+                    results['output'] += output
+                    results['got_output'] = True
+    # If no commands are provided, run the get_chassis_inventory on devices
+    else:
+        get_chassis_inventory(dev, hostname)
+    return results
+
 # Function for running operational commands to multiple devices
 def oper_commands(my_ips):
     print "*" * 50 + "\n" + " " * 10 + "OPERATIONAL COMMANDS\n" + "*" * 50
@@ -1113,60 +1227,40 @@ def oper_commands(my_ips):
             devs_no_output = []
             devs_with_output = []
             loop = 0
+            # Run the devices in parallel, each response is handled as soon as its device finishes
+            manager = SessionManager(username, password, port=ssh_port, timeout=700, gather_facts=True)
             try:
                 screen_and_log("-" * 110 + "\n", output_log)
-                for ip in my_ips:
-                    command_output = ""
+                for response in manager.sweep(my_ips, run_oper_commands, command_list):
                     loop += 1
-                    stdout.write("-> Connecting to " + ip + " ... ")
-                    dev, message = connect(ip, username, password)
+                    ip = response['host']
+                    stdout.write("[{0} of {1}] -> {2} ... ".format(loop, len(my_ips), ip))
                     # If the connection is successful...
-                    if dev:
+                    if response['connected']:
+                        results = response['output']
+                        if results is None:
+                            print "Failed!"
+                            screen_and_log("{0}: {1}\n".format(ip, response['error']), err_log)
+                            devs_no_output.append(ip)
+                            continue
                         print "Connected!"
-                        hostname = dev.facts['hostname']
-                        if not hostname:
-                            hostname = "Unknown"
-                        got_output = False
+                        for err_message in results['errors']:
+                            screen_and_log(err_message, err_log)
                         # Loop over the commands provided
                         if command_list:
-                            stdout.write(hostname + ": Executing commands ")
-                            for command in command_list:
-                                command_output += "\n" + hostname + " (" + ip + "): Executing -> {0}\n".format(command)
-                                #com = dev.cli_to_rpc_string(command)
-                                #print "Command: {0}\nRPC: {1}\n".format(command, com)
-                                #if com is None:
-                                try:
-                                    results = dev.cli(command, warning=False)
-                                except Exception as err:
-                                    stdout.write("\n")
-                                    screen_and_log("{0}: Error executing '{1}'. ERROR: {2}\n".format(ip, command, err), err_log)
-                                    stdout.write("\n")
-                                else:
-                                    if results:
-                                        command_output += results
-                                        got_output = True
-                                    stdout.write(".")
-                                    stdout.flush()
-                            if got_output:
+                            if results['got_output']:
                                 devs_with_output.append(ip)
-                                screen_and_log(command_output, output_log)
+                                screen_and_log(results['output'], output_log)
                                 stdout.write("\n")
                             else:
                                 devs_no_output.append(ip)
-                                stdout.write(" No Output!\n")
-                        # If no commands are provided, run the get_chassis_inventory on devices
-                        else:
-                            get_chassis_inventory(dev, hostname)
-                        # Close connection to device
-                        try:
-                            dev.close()
-                        except TimeoutExpiredError as err:
-                            print "Error: {0}".format(err)
-                            break
+                                stdout.write(results['hostname'] + ": No Output!\n")
                     # If the connection is not successful, provide the connection failure information
                     else:
-                        screen_and_log("{0}: Unable to connect : {1}\n".format(ip, message), err_log)
+                        print "Unable to connect!"
+                        screen_and_log("{0}: Unable to connect : {1}\n".format(ip, response['error']), err_log)
                         devs_unreachable.append(ip)
+                manager.close()
                 screen_and_log("-" * 110 + "\n", output_log)
                 screen_and_log(starHeading("COMMANDS COMPLETED", 110), output_log)
                 # Results of commands
@@ -1355,9 +1449,8 @@ def upgrade_device(host, package, logging, reboot, remote_path='/var/tmp', valid
         logging.error(msg)
         sys.exit()
 
-    dev = Device(host=host, user=username, passwd=password)
     try:
-        dev.open()
+        dev = borrow_device(host, username, password, port=ssh_port)
     except ConnectError as err:
         logging.error('Cannot connect to device: {0}\n'.format(err))
         return False
@@ -1371,7 +1464,7 @@ def upgrade_device(host, package, logging, reboot, remote_path='/var/tmp', valid
     except Exception as err:
         logging.error('Unable to install software, {0}'.format(err))
         ok = False
-        dev.close()
+        release_device(dev, discard=True)
         logging.shutdown()
         return False
 
@@ -1395,11 +1488,11 @@ def upgrade_device(host, package, logging, reboot, remote_path='/var/tmp', valid
     else:
         logging.error('Issue installing software')
         logging.shutdown()
-        dev.close()
+        release_device(dev, discard=True)
         return False
 
-    # End the NDTCONF session and close the connection
-    dev.close()
+    # End the NETCONF session, the device may be rebooting so it can't be reused
+    release_device(dev, discard=(reboot == "doReboot"))
     return True
 
 # Log the upgrade progress
@@ -1411,7 +1504,7 @@ def update_progress(dev, report):
 def get_chassis_info(ip, targ_code):
     chassis_dict = {}
     stdout.write("Connecting to {0} ... ".format(ip))
-    dev, message = connect(ip)
+    dev, message = connect(ip, username, password)
     if dev:
         try:
             chassis_dict['ip'] = ip
@@ -1423,7 +1516,8 @@ def get_chassis_info(ip, targ_code):
             print " Error detected: {0}".format(err)
         else:
             print " Information Successfully Collected!"
-        dev.close()
+        # Keep the session for the upgrade
+        release_device(dev)
     else:
         print "{0}: Unable to connect : {1}\n".format(ip, message)
     return chassis_dict
@@ -1554,6 +1648,9 @@ if __name__ == "__main__":
         exit()
     password = getpass(prompt="\nEnter your password: ")
 
+    # Sessions are kept between menu selections, so the upgrade can reuse the session from the chassis check
+    set_default_pool(ConnectionPool(username, password, port=ssh_port, idle_timeout=1800, timeout=700))
+
     # Define menu options
     my_options = ['Execute Operational Commands', 'Execute Set Commands', 'Execute Template Commands', 'Deviation Template', 'Upgrade Junipers', 'Quit']
     my_ips = []
@@ -1570,9 +1667,9 @@ if __name__ == "__main__":
             elif answer == "2":
                 standard_commands()
             elif answer == "3":
-                template_commands(json_to_listdict(main_list_dict))
+                template_commands(load_device_db(main_list_dict))
             elif answer == "4":
-                host_list = deviation_search(json_to_listdict(main_list_dict))
+                host_list = deviation_search(load_device_db(main_list_dict))
                 if host_list:
                         if getTFAnswer("Would you like to push the changes"):
                             template_push(host_list)
@@ -1586,6 +1683,7 @@ if __name__ == "__main__":
                 quit()
     except KeyboardInterrupt:
         print 'Exiting...'
+        flush_logs()
         try:
             sys.exit(0)
         except SystemExit:
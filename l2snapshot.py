@@ -0,0 +1,352 @@
+# File: l2snapshot.py
+# Author: Tyler Jordan
+# Purpose: Snapshot of the ARP, Ethernet switching and LLDP tables of every device. Collected in the background, so
+# an IP can be located (route point ARP -> MAC -> access switch port) without connecting to any device.
+
+import os
+import time
+import sqlite3
+import threading
+import jxmlease
+
+from multiprocessing.pool import ThreadPool
+from jnpr.junos.exception import RpcError, RpcTimeoutError
+from sessions import borrow_device, release_device
+
+# Seconds a device's tables are trusted for, older tables are ignored and the search goes to the devices
+snapshot_max_age = 3600
+
+# Devices collected at the same time
+collect_workers = 10
+
+
+# The snapshot file kept in the data folder
+def l2_snapshot_file(data_dir):
+    return os.path.join(data_dir, "l2_snapshot.sqlite")
+
+# Returns the jxmlease node as a list, a single element isn't wrapped in a list
+def as_list(node):
+    if node is None:
+        return []
+    if isinstance(node, list):
+        return node
+    return [node]
+
+# Text of a jxmlease node as a plain string, empty string if it's missing
+def node_text(node, key):
+    value = node.get(key)
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8').strip()
+
+# Physical interface of a logical interface (ie. ge-0/0/1.0 -> ge-0/0/1)
+def physical_intf(intf):
+    return intf.split('.', 1)[0]
+
+# Hostname without its domain, the way LLDP neighbors are matched to the database
+def short_hostname(hostname):
+    return hostname.split('.', 1)[0].upper()
+
+# Entries of "show arp": (ip, mac, interface)
+def parse_arp(response):
+    entries = []
+    try:
+        arp_entries = response['arp-table-information']['arp-table-entry']
+    except KeyError:
+        return entries
+    for myarp in as_list(arp_entries):
+        entries.append((node_text(myarp, 'ip-address'), node_text(myarp, 'mac-address').lower(),
+                        node_text(myarp, 'interface-name')))
+    return entries
+
+# Entries of "show ethernet-switching table" on ELS and non-ELS switches: (mac, vlan, interface)
+def parse_ethernet_switching(response):
+    entries = []
+    # ELS switch (EX4300)
+    if 'l2ng-l2ald-rtb-macdb' in response:
+        try:
+            mac_vlans = response['l2ng-l2ald-rtb-macdb']['l2ng-l2ald-mac-entry-vlan']
+        except KeyError:
+            return entries
+        for myethtable in as_list(mac_vlans):
+            vlan_tag = node_text(myethtable, 'l2ng-l2-vlan-id')
+            for mymacentry in as_list(myethtable.get('l2ng-mac-entry')):
+                entries.append((node_text(mymacentry, 'l2ng-l2-mac-address').lower(), vlan_tag,
+                                node_text(mymacentry, 'l2ng-l2-mac-logical-interface')))
+    # NON-ELS switch (EX4550,EX4200,EX6200)
+    else:
+        try:
+            mac_tables = response['ethernet-switching-table-information']['ethernet-switching-table']
+        except KeyError:
+            return entries
+        for mytable in as_list(mac_tables):
+            for mymacentry in as_list(mytable.get('mac-table-entry')):
+                mac_addr = node_text(mymacentry, 'mac-address').lower()
+                # Skip the flood entries ("*")
+                if ':' not in mac_addr:
+                    continue
+                vlan_tag = node_text(mymacentry, 'mac-vlan-tag') or node_text(mymacentry, 'mac-vlan')
+                intf_list = mymacentry.get('mac-interfaces-list')
+                if intf_list is None:
+                    continue
+                for myintf in as_list(intf_list.get('mac-interfaces')):
+                    entries.append((mac_addr, vlan_tag, unicode(myintf).encode('utf-8').strip()))
+    return entries
+
+# Entries of "show lldp neighbors": (local interface, local parent interface, remote system name)
+def parse_lldp(response):
+    entries = []
+    try:
+        neighbors = response['lldp-neighbors-information']['lldp-neighbor-information']
+    except KeyError:
+        return entries
+    for mylldp in as_list(neighbors):
+        entries.append((node_text(mylldp, 'lldp-local-interface') or node_text(mylldp, 'lldp-local-port-id'),
+                        node_text(mylldp, 'lldp-local-parent-interface-name'),
+                        node_text(mylldp, 'lldp-remote-system-name')))
+    return entries
+
+def collect_tables(dev):
+    """ Purpose: Pull the ARP, Ethernet switching and LLDP tables of a device. A table the device doesn't support
+    (ie. no switching table on a router) is left empty, any other error is raised.
+
+        :param dev:         -   The PyEZ connection object (SSH Netconf)
+        :return:            -   Dictionary of 'arp', 'macs' and 'lldp' entry lists
+    """
+    tables = {'arp': [], 'macs': [], 'lldp': []}
+    for name, rpc, parser in [('arp', dev.rpc.get_arp_table_information, parse_arp),
+                              ('macs', dev.rpc.get_ethernet_switching_table_information, parse_ethernet_switching),
+                              ('lldp', dev.rpc.get_lldp_neighbors_information, parse_lldp)]:
+        try:
+            tables[name] = parser(jxmlease.parse_etree(rpc()))
+        except RpcTimeoutError:
+            raise
+        except RpcError:
+            pass
+    return tables
+
+
+class L2Snapshot(object):
+    """ Purpose: SQLite store of the ARP, Ethernet switching and LLDP tables of each device.
+
+        - devices: when the tables of each device were collected
+        - arp: IP -> MAC and interface on the device that routes it
+        - macs: MAC -> VLAN and interface on each switch that learned it
+        - lldp: the neighbor seen on each interface of each device
+
+    Each device's tables are replaced whole when it is collected. Lookups only use devices collected within the
+    max age they are given. Safe to share between threads.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.text_factory = str
+        self.create_tables()
+
+    def create_tables(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS devices (
+                hostname TEXT PRIMARY KEY,
+                ip TEXT,
+                collected TEXT,
+                collected_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS arp (
+                ip TEXT NOT NULL,
+                mac TEXT NOT NULL,
+                hostname TEXT NOT NULL,
+                interface TEXT
+            );
+            CREATE INDEX IF NOT EXISTS arp_ip ON arp (ip);
+            CREATE INDEX IF NOT EXISTS arp_hostname ON arp (hostname);
+            CREATE TABLE IF NOT EXISTS macs (
+                mac TEXT NOT NULL,
+                vlan TEXT,
+                hostname TEXT NOT NULL,
+                interface TEXT
+            );
+            CREATE INDEX IF NOT EXISTS macs_mac ON macs (mac);
+            CREATE INDEX IF NOT EXISTS macs_hostname ON macs (hostname);
+            CREATE TABLE IF NOT EXISTS lldp (
+                hostname TEXT NOT NULL,
+                interface TEXT,
+                parent TEXT,
+                remote TEXT
+            );
+            CREATE INDEX IF NOT EXISTS lldp_hostname ON lldp (hostname);
+        """)
+        self.conn.commit()
+
+    ###########
+    # CHANGES #
+    ###########
+
+    def store(self, hostname, ip, tables, now):
+        """ Purpose: Replace the tables of a device with a new collection.
+
+            :param hostname:    -   Hostname of the device
+            :param ip:          -   Management IP of the device
+            :param tables:      -   Dictionary from collect_tables()
+            :param now:         -   Timestamp of the collection (get_now_time() format)
+            :return:            -   None
+        """
+        with self.lock:
+            with self.conn:
+                self.delete_tables(hostname)
+                self.conn.execute("INSERT OR REPLACE INTO devices (hostname, ip, collected, collected_at) "
+                                  "VALUES (?, ?, ?, ?)", (hostname, ip, now, time.time()))
+                self.conn.executemany("INSERT INTO arp (ip, mac, hostname, interface) VALUES (?, ?, ?, ?)",
+                                      [(ip_addr, mac, hostname, intf) for ip_addr, mac, intf in tables['arp']])
+                self.conn.executemany("INSERT INTO macs (mac, vlan, hostname, interface) VALUES (?, ?, ?, ?)",
+                                      [(mac, vlan, hostname, intf) for mac, vlan, intf in tables['macs']])
+                self.conn.executemany("INSERT INTO lldp (hostname, interface, parent, remote) VALUES (?, ?, ?, ?)",
+                                      [(hostname, intf, parent, remote) for intf, parent, remote in tables['lldp']])
+
+    def delete_tables(self, hostname):
+        for table in ['arp', 'macs', 'lldp']:
+            self.conn.execute("DELETE FROM {0} WHERE hostname = ?".format(table), (hostname,))
+
+    def remove(self, hostname):
+        """ Purpose: Remove a device and its tables from the snapshot. """
+        with self.lock:
+            with self.conn:
+                self.delete_tables(hostname)
+                self.conn.execute("DELETE FROM devices WHERE hostname = ?", (hostname,))
+
+    ###########
+    # LOOKUPS #
+    ###########
+
+    def device_count(self, max_age=snapshot_max_age):
+        """ Purpose: Return the number of devices collected within max_age seconds. """
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM devices WHERE collected_at >= ?",
+                                     (time.time() - max_age,)).fetchone()[0]
+
+    def arp_entries(self, ip_addr, max_age=snapshot_max_age):
+        """ Purpose: Return the current ARP entries of an IP as (hostname, mac, interface, collected). """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT arp.hostname, arp.mac, arp.interface, devices.collected FROM arp "
+                "JOIN devices ON arp.hostname = devices.hostname "
+                "WHERE arp.ip = ? AND devices.collected_at >= ? ORDER BY arp.hostname",
+                (ip_addr, time.time() - max_age)).fetchall()
+
+    def uplinks(self, hostname, known_hosts):
+        """ Purpose: Return the physical interfaces of a device that face another device in the snapshot. An LLDP
+        neighbor that isn't a known device (ie. a phone) doesn't make the port an uplink.
+        """
+        ports = set()
+        for intf, parent, remote in self.conn.execute("SELECT interface, parent, remote FROM lldp WHERE hostname = ?",
+                                                      (hostname,)):
+            if short_hostname(remote) in known_hosts:
+                for port in [intf, parent]:
+                    if port:
+                        ports.add(physical_intf(port))
+        return ports
+
+    def edge_ports(self, mac_addr, max_age=snapshot_max_age):
+        """ Purpose: Return the access ports a MAC was learned on, as (hostname, vlan, interface, collected). Entries
+        learned over an uplink to another switch are left out.
+        """
+        with self.lock:
+            known_hosts = set(short_hostname(row[0]) for row in self.conn.execute("SELECT hostname FROM devices"))
+            rows = self.conn.execute(
+                "SELECT macs.hostname, macs.vlan, macs.interface, devices.collected FROM macs "
+                "JOIN devices ON macs.hostname = devices.hostname "
+                "WHERE macs.mac = ? AND devices.collected_at >= ? ORDER BY macs.hostname",
+                (mac_addr.lower(), time.time() - max_age)).fetchall()
+            ports = []
+            uplinks = {}
+            for hostname, vlan, intf, collected in rows:
+                if hostname not in uplinks:
+                    uplinks[hostname] = self.uplinks(hostname, known_hosts)
+                if physical_intf(intf) not in uplinks[hostname]:
+                    ports.append((hostname, vlan, intf, collected))
+            return ports
+
+    def locate(self, ip_addr, max_age=snapshot_max_age):
+        """ Purpose: Find where an IP is plugged in from the snapshot.
+
+            :param ip_addr:     -   IP address to locate
+            :param max_age:     -   Seconds since collection that a device's tables are trusted for
+            :return:            -   Dictionary of 'ip', 'mac', 'arp_host', 'arp_interface', 'hostname', 'interface',
+                                    'vlan' and 'collected', or None if the current snapshot can't place the IP
+        """
+        arp_rows = self.arp_entries(ip_addr, max_age)
+        if not arp_rows:
+            return None
+        arp_host, mac_addr, arp_intf, collected = arp_rows[0]
+        location = {'ip': ip_addr, 'mac': mac_addr, 'arp_host': arp_host, 'arp_interface': arp_intf,
+                    'hostname': arp_host, 'interface': arp_intf, 'vlan': '', 'collected': collected}
+        # If the interface is a VLAN or IRB, ie. vlan.XXX, then user port is on a different switch
+        if 'vlan' in arp_intf or 'irb' in arp_intf:
+            vlan_tag = arp_intf.rsplit('.', 1)[-1]
+            ports = self.edge_ports(mac_addr, max_age)
+            if not ports:
+                return None
+            # Prefer the port learned in the VLAN the route point has the IP in
+            for port in ports:
+                if port[1] == vlan_tag:
+                    break
+            else:
+                port = ports[0]
+            location['hostname'], location['vlan'], location['interface'], location['collected'] = port
+        return location
+
+    def close(self):
+        self.conn.close()
+
+
+def collect_worker(job):
+    """ Purpose: Collect the tables of one device inside a collector thread.
+
+        :param job:         -   Tuple of (record, username, password, port)
+        :return:            -   Tuple of (record, tables, error), tables is None if the collection failed
+    """
+    record, username, password, port = job
+    try:
+        dev = borrow_device(record['ip'], username, password, port=port)
+    except Exception as err:
+        return record, None, "Unable to connect: {0}".format(err)
+    try:
+        return record, collect_tables(dev), ''
+    except Exception as err:
+        return record, None, str(err)
+    finally:
+        release_device(dev)
+
+def collect_snapshot(snapshot, records, username, password, now, port=22, workers=collect_workers):
+    """ Purpose: Collect the tables of the devices over a pool of threads and store them in the snapshot.
+
+        :param snapshot:    -   L2Snapshot to store the tables in
+        :param records:     -   Device records from the database
+        :param username:    -   Username for the devices
+        :param password:    -   Password for the devices
+        :param now:         -   Timestamp of the collection (get_now_time() format)
+        :param port:        -   NETCONF port
+        :param workers:     -   Devices collected at the same time
+        :return:            -   List of (record, error) of the devices that couldn't be collected
+    """
+    failed = []
+    jobs = [(record, username, password, port) for record in records]
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        for curr_num, (record, tables, error) in enumerate(pool.imap_unordered(collect_worker, jobs), 1):
+            status = "| " + str(curr_num) + " of " + str(len(jobs)) + " | " + record['hostname'] + " (" + \
+                     record['ip'] + ") | "
+            if tables is None:
+                print status + "ERROR: " + error
+                failed.append((record, error))
+            else:
+                snapshot.store(record['hostname'], record['ip'], tables, now)
+                print status + "ARP: {0} | MAC: {1} | LLDP: {2}".format(len(tables['arp']), len(tables['macs']),
+                                                                         len(tables['lldp']))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed
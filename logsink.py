@@ -0,0 +1,179 @@
+# File: logsink.py
+# Author: Tyler Jordan
+# Purpose: Buffered writes to the log files. Each log keeps its pending text in memory and is written in one append
+# when the buffer fills, when it has waited long enough, or when the process exits, instead of opening the file for
+# every fragment. Only whole lines are written, so processes sharing a log don't split each other's lines.
+
+import os
+import json
+import time
+import atexit
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Pending bytes across all logs before they are written
+buffer_size = 65536
+
+# Seconds pending text may wait before it is written
+flush_interval = 2.0
+
+
+class LogSink(object):
+    """ Purpose: Holds the pending text of each log file.
+
+        - write() adds to a log's buffer. Once buffer_size bytes are pending the complete lines of every log are
+          written. A timer thread writes them every flush_interval seconds, and once no log has been written to for
+          a whole interval it writes the partial lines too (ie. a prompt in an interactive menu).
+        - Each log is written with one O_APPEND write (under flock where available), so worker processes appending
+          to the same log never interleave partial lines. Text after the last newline waits for the rest of its
+          line, or for flush(complete=True).
+        - A forked worker drops the buffers it inherited, the parent still owns that text and writes it.
+
+    Safe to share between threads.
+    """
+    def __init__(self, buffer_size=buffer_size, flush_interval=flush_interval):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.buffers = {}       # logfile -> list of pending strings
+        self.pending = 0
+        self.last_flush = time.time()
+        self.last_write = time.time()
+        self.pid = os.getpid()
+        self.timer = None
+
+    def check_fork(self):
+        # The child gets a new lock and timer, the parent's threads don't exist in it
+        if os.getpid() != self.pid:
+            self.lock = threading.RLock()
+            self.buffers = {}
+            self.pending = 0
+            self.last_flush = time.time()
+            self.pid = os.getpid()
+            self.timer = None
+
+    def start_timer(self):
+        """ Purpose: Start the thread that writes pending text within flush_interval. Call with the lock held. """
+        if self.timer is None and self.flush_interval != float('inf'):
+            self.timer = threading.Thread(target=self.timer_loop)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def timer_loop(self):
+        try:
+            while True:
+                time.sleep(self.flush_interval)
+                with self.lock:
+                    if self.pending and time.time() - self.last_flush >= self.flush_interval:
+                        self.flush(complete=time.time() - self.last_write >= self.flush_interval)
+        except Exception:
+            # Only happens as the interpreter shuts down, flush_logs() runs at exit
+            pass
+
+    def write(self, statement, logfile):
+        """ Purpose: Add text to a log.
+
+            :param statement:   -   Text to append
+            :param logfile:     -   Path of the log file
+            :return:            -   None
+        """
+        if isinstance(statement, unicode):
+            statement = statement.encode('utf-8')
+        self.check_fork()
+        with self.lock:
+            self.buffers.setdefault(logfile, []).append(statement)
+            self.pending += len(statement)
+            self.last_write = time.time()
+            self.start_timer()
+            if self.pending >= self.buffer_size or time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self, logfile=None, complete=False):
+        """ Purpose: Write the pending text of one log, or of every log.
+
+            :param logfile:     -   Path of the log file, None for every log
+            :param complete:    -   True to also write text that doesn't end in a newline yet
+            :return:            -   None
+        """
+        self.check_fork()
+        with self.lock:
+            if logfile is None:
+                logfiles = self.buffers.keys()
+            else:
+                logfiles = [logfile]
+            for path in logfiles:
+                text = "".join(self.buffers.pop(path, []))
+                # A partial line waits for the rest of it, unless it's grown past the buffer size
+                if not complete and len(text) - text.rfind("\n") - 1 < self.buffer_size:
+                    end = text.rfind("\n") + 1
+                    if end < len(text):
+                        self.buffers[path] = [text[end:]]
+                    text = text[:end]
+                if text:
+                    self.append(path, text)
+            self.pending = sum(len(part) for parts in self.buffers.values() for part in parts)
+            self.last_flush = time.time()
+
+    def append(self, logfile, text):
+        try:
+            fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        except Exception as err:
+            print "Error opening log file {0}".format(err)
+            return
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            while text:
+                text = text[os.write(fd, text):]
+        except Exception as err:
+            print "Error writing log file {0}".format(err)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """ Purpose: Write everything that is pending. """
+        self.flush(complete=True)
+
+
+class CaptureSink(LogSink):
+    """ Purpose: A sink that keeps what would be written instead of writing it, so a worker process can hand its
+    log output to the process that owns the logs. take() returns the (logfile, text) pairs written so far.
+    """
+    def __init__(self):
+        LogSink.__init__(self, buffer_size=float('inf'), flush_interval=float('inf'))
+        self.captured = []
+
+    def append(self, logfile, text):
+        self.captured.append((logfile, text))
+
+    def take(self):
+        self.flush(complete=True)
+        captured = self.captured
+        self.captured = []
+        return captured
+
+
+# The sink used by the utility log functions
+default_sink = LogSink()
+
+def set_sink(sink):
+    """ Purpose: Send the utility log functions to another sink, ie. a CaptureSink in a worker process. """
+    global default_sink
+    default_sink = sink
+
+def write_log(statement, logfile):
+    default_sink.write(statement, logfile)
+
+def write_json_log(record, logfile):
+    """ Purpose: Append a record to a JSON-lines log, one JSON object per line. """
+    write_log(json.dumps(record, sort_keys=True) + "\n", logfile)
+
+def flush_logs(logfile=None):
+    """ Purpose: Write everything pending, ie. before a log is read back or a worker process returns. """
+    default_sink.flush(logfile, complete=True)
+
+atexit.register(flush_logs)
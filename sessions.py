@@ -0,0 +1,416 @@
+# File: sessions.py
+# Author: Tyler Jordan
+# Purpose: Shared NETCONF session handling for the jmanage tools. Runs PyEZ sessions against many devices at once
+# so a sweep of the fleet is bounded by the slowest devices instead of the sum of every device.
+
+import os
+import atexit
+import threading
+import time
+import Queue
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from jnpr.junos import Device
+from jnpr.junos.exception import ConnectError
+
+
+##########################
+# SESSION OPEN FUNCTIONS #
+##########################
+
+# Open a PyEZ session to a device
+def open_device(host, username, password, port=22, connect_timeout=30, timeout=300, gather_facts=True, probe=0):
+    """ Purpose: Open a PyEZ NETCONF session to a device. Exceptions from the open are passed to the caller.
+
+        :param host:            -   IP or hostname of the device
+        :param username:        -   Username used to log into the device
+        :param password:        -   Password used to log into the device
+        :param port:            -   NETCONF port (22 or 830, or the port of a local NETCONF stub server)
+        :param connect_timeout: -   Seconds to wait for the SSH/NETCONF session to open
+        :param timeout:         -   Seconds to wait for each RPC reply once the session is open
+        :param gather_facts:    -   True/False, gather the PyEZ facts when the session opens
+        :param probe:           -   Seconds to probe the port before opening, 0 disables the probe
+        :return dev:            -   The opened device handle
+    """
+    dev = Device(host=host, user=username, passwd=password, port=port, gather_facts=gather_facts,
+                 auto_probe=probe, conn_open_timeout=connect_timeout)
+    dev.open()
+    dev.timeout = timeout
+    return dev
+
+# Close a PyEZ session, ignoring a session that has already dropped
+def close_device(dev):
+    try:
+        dev.close()
+    except Exception:
+        return False
+    else:
+        return True
+
+# Get one fact from an open session
+def device_fact(dev, key):
+    """ Purpose: Get a single fact without gathering the full set. With gather_facts off, PyEZ 2.x runs only the RPCs
+        behind the requested fact, the first time it is read, and keeps it for the life of the session. Older PyEZ
+        releases can only gather every fact at once, which is done here the first time any fact is asked for.
+
+        :param dev:             -   The opened device handle
+        :param key:             -   Name of the fact (ie. hostname, serialnumber, model, version, junos_info)
+        :return:                -   The fact value, None if the device didn't supply it
+    """
+    if not dev.facts:
+        dev.facts_refresh()
+    return dev.facts.get(key)
+
+
+###################
+# CONNECTION POOL #
+###################
+
+# The pool used by borrow_device/release_device, set by each tool once its credentials are known
+default_pool = None
+
+class ConnectionPool(object):
+    """ Purpose: Keeps opened sessions so later operations against the same device skip the SSH and NETCONF
+    handshake. Sessions are keyed by (host, username).
+
+        - A borrowed session is checked before it is handed out. Sessions idle longer than "health_interval" are
+          probed with a light RPC, and a dead session is closed and replaced with a new one.
+        - Sessions idle longer than "idle_timeout" are closed.
+        - No more than "max_sessions" sessions are open at once. At the cap, the longest idle session is closed to
+          make room, or the caller waits for a session to be returned.
+        - A forked worker process starts with an empty pool. The sessions it inherited belong to the parent, their
+          transport threads don't exist in the child, so they are dropped without being used or closed.
+
+    The pool is safe to share between threads.
+    """
+    def __init__(self, username, password, port=22, max_sessions=100, idle_timeout=300, health_interval=60,
+                 connect_timeout=30, timeout=300, gather_facts=True):
+        self.username = username
+        self.password = password
+        self.port = port
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.gather_facts = gather_facts
+        self.idle = {}          # (host, username) -> list of [dev, last_used]
+        self.in_use = {}        # id(dev) -> (host, username)
+        self.count = 0          # Sessions open or being opened, idle and in use
+        self.cond = threading.Condition()
+        self.pid = os.getpid()
+
+    def check_fork(self):
+        """ Purpose: Forget the inherited sessions after a fork, see the class notes. """
+        if os.getpid() != self.pid:
+            self.cond = threading.Condition()
+            self.idle = {}
+            self.in_use = {}
+            self.count = 0
+            self.pid = os.getpid()
+
+    def borrow(self, host, username=None, password=None, probe=0, timeout=None):
+        """ Purpose: Get an open session to a host, reusing an idle one if it is still healthy.
+
+            :param host:        -   IP or hostname of the device
+            :param username:    -   Username to use instead of the pool's username
+            :param password:    -   Password to use instead of the pool's password
+            :param probe:       -   Seconds to probe the port before opening a new session
+            :param timeout:     -   Seconds to wait for each RPC reply, defaults to the pool's timeout
+            :return dev:        -   The device handle, connection exceptions are passed to the caller
+        """
+        if not username:
+            username = self.username
+            password = self.password
+        if timeout is None:
+            timeout = self.timeout
+        key = (host, username)
+        dev = None
+        last_used = 0
+        self.check_fork()
+        with self.cond:
+            stale = self.evict_idle()
+            while True:
+                sessions = self.idle.get(key)
+                if sessions:
+                    dev, last_used = sessions.pop()
+                    if not sessions:
+                        del self.idle[key]
+                    break
+                if self.count < self.max_sessions:
+                    self.count += 1
+                    break
+                # Make room by closing the longest idle session, otherwise wait for a session to be returned
+                oldest = self.pop_oldest_idle()
+                if oldest:
+                    stale.append(oldest)
+                    self.count -= 1
+                else:
+                    self.cond.wait(1)
+        for old_dev in stale:
+            close_device(old_dev)
+
+        # Check an idle session before handing it out
+        if dev is not None:
+            if self.healthy(dev, last_used):
+                dev.timeout = timeout
+                with self.cond:
+                    self.in_use[id(dev)] = key
+                return dev
+            close_device(dev)
+
+        # Open a new session, this takes the place reserved above
+        try:
+            dev = open_device(host, username, password, port=self.port, connect_timeout=self.connect_timeout,
+                              timeout=timeout, gather_facts=self.gather_facts, probe=probe)
+        except Exception:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.in_use[id(dev)] = key
+        return dev
+
+    def release(self, dev, discard=False):
+        """ Purpose: Return a borrowed session to the pool.
+
+            :param dev:         -   The device handle
+            :param discard:     -   True/False, close the session instead of keeping it (ie. device is rebooting)
+            :return:            -   None
+        """
+        self.check_fork()
+        with self.cond:
+            key = self.in_use.pop(id(dev), None)
+            if key is not None:
+                if discard or not getattr(dev, 'connected', True):
+                    self.count -= 1
+                else:
+                    self.idle.setdefault(key, []).append([dev, time.time()])
+                    dev = None
+                self.cond.notify()
+        # Sessions that didn't come from the pool, or aren't being kept, are closed
+        if dev is not None:
+            close_device(dev)
+
+    @contextmanager
+    def session(self, host, **kwargs):
+        """ Purpose: Borrow a session for a "with" block. A session that raised an exception isn't reused. """
+        dev = self.borrow(host, **kwargs)
+        try:
+            yield dev
+        except Exception:
+            self.release(dev, discard=True)
+            raise
+        else:
+            self.release(dev)
+
+    def healthy(self, dev, last_used):
+        """ Purpose: Check that an idle session can still be used. """
+        if not getattr(dev, 'connected', True):
+            return False
+        if time.time() - last_used < self.health_interval:
+            return True
+        try:
+            dev.rpc.get_system_uptime_information()
+        except Exception:
+            return False
+        else:
+            return True
+
+    def evict_idle(self):
+        """ Purpose: Remove sessions idle longer than idle_timeout. Call with the lock held, then close the returned
+            sessions after releasing it.
+        """
+        stale = []
+        cutoff = time.time() - self.idle_timeout
+        for key in self.idle.keys():
+            keep = []
+            for entry in self.idle[key]:
+                if entry[1] < cutoff:
+                    stale.append(entry[0])
+                    self.count -= 1
+                else:
+                    keep.append(entry)
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+        return stale
+
+    def pop_oldest_idle(self):
+        """ Purpose: Remove and return the longest idle session, None if there are no idle sessions. Call with the
+            lock held.
+        """
+        oldest_key = None
+        oldest_index = 0
+        for key, sessions in self.idle.iteritems():
+            for index, entry in enumerate(sessions):
+                if oldest_key is None or entry[1] < self.idle[oldest_key][oldest_index][1]:
+                    oldest_key = key
+                    oldest_index = index
+        if oldest_key is None:
+            return None
+        dev = self.idle[oldest_key].pop(oldest_index)[0]
+        if not self.idle[oldest_key]:
+            del self.idle[oldest_key]
+        return dev
+
+    def close_all(self):
+        """ Purpose: Close every idle session. Sessions still borrowed are closed when they are released. """
+        self.check_fork()
+        with self.cond:
+            stale = []
+            for sessions in self.idle.values():
+                for entry in sessions:
+                    stale.append(entry[0])
+                    self.count -= 1
+            self.idle = {}
+        for dev in stale:
+            close_device(dev)
+
+# Set the pool used by borrow_device/release_device
+def set_default_pool(pool):
+    global default_pool
+    if default_pool is None:
+        atexit.register(close_default_pool)
+    default_pool = pool
+    return pool
+
+# Close the idle sessions of the default pool
+def close_default_pool():
+    if default_pool is not None:
+        default_pool.close_all()
+
+# Get a session from the default pool, or open a new session if no pool is set
+def borrow_device(host, username, password, port=22, timeout=300, probe=0):
+    if default_pool is not None:
+        return default_pool.borrow(host, username=username, password=password, probe=probe, timeout=timeout)
+    return open_device(host, username, password, port=port, timeout=timeout, probe=probe)
+
+# Return a session to the default pool, or close it if no pool is set
+def release_device(dev, discard=False):
+    if default_pool is not None:
+        default_pool.release(dev, discard)
+    else:
+        close_device(dev)
+
+
+###################
+# SESSION MANAGER #
+###################
+
+class SessionManager(object):
+    """ Purpose: Runs RPCs against many devices at the same time. Every request is queued to a bounded pool of
+    session workers, and the number of SSH/NETCONF handshakes in progress at once is capped separately so a sweep
+    doesn't open hundreds of sessions in the same second.
+
+    Sessions are borrowed from the default connection pool when one is set.
+
+    Each request returns an AsyncResult. Calling get() on it returns a dictionary:
+        host ......... The device the request ran against
+        connected .... True/False, if the session opened
+        output ....... The RPC reply (or CLI text), None if the request failed
+        error ........ An error message, empty if the request succeeded
+    """
+    def __init__(self, username, password, port=22, max_sessions=50, max_connects=20, connect_timeout=30,
+                 timeout=300, gather_facts=False):
+        self.username = username
+        self.password = password
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.gather_facts = gather_facts
+        self.connect_sem = threading.BoundedSemaphore(max_connects)
+        self.pool = ThreadPool(max_sessions)
+
+    def open(self, host):
+        """ Purpose: Open a session to a host, waiting for a free handshake slot first. """
+        with self.connect_sem:
+            if default_pool is not None:
+                return default_pool.borrow(host, username=self.username, password=self.password,
+                                           timeout=self.timeout)
+            return open_device(host, self.username, self.password, port=self.port,
+                               connect_timeout=self.connect_timeout, timeout=self.timeout,
+                               gather_facts=self.gather_facts)
+
+    def run(self, host, func, *args, **kwargs):
+        """ Purpose: Open a session, call func(dev, *args, **kwargs) and release the session. Blocks the caller. """
+        response = {'host': host, 'connected': False, 'output': None, 'error': ''}
+        try:
+            dev = self.open(host)
+        except ConnectError as err:
+            response['error'] = "Unable to connect: {0}".format(err)
+            return response
+        except Exception as err:
+            response['error'] = "Undefined exception: {0}".format(err)
+            return response
+        response['connected'] = True
+        try:
+            response['output'] = func(dev, *args, **kwargs)
+        except Exception as err:
+            response['error'] = "Request failed: {0}".format(err)
+            release_device(dev, discard=True)
+        else:
+            release_device(dev)
+        return response
+
+    def submit(self, host, func, *args, **kwargs):
+        """ Purpose: Queue func(dev, *args, **kwargs) to run against a host. Returns an AsyncResult. """
+        return self.pool.apply_async(self.run, (host, func) + args, kwargs)
+
+    # RPCs used by the tools
+    def get_config(self, host, options=None):
+        if options is None:
+            options = {'format': 'set'}
+        return self.submit(host, rpc_get_config, options)
+
+    def get_interface_information(self, host, **kwargs):
+        return self.submit(host, rpc_get_interface_information, **kwargs)
+
+    def get_chassis_inventory(self, host):
+        return self.submit(host, rpc_get_chassis_inventory)
+
+    def cli(self, host, command):
+        return self.submit(host, rpc_cli, command)
+
+    def sweep(self, hosts, func, *args, **kwargs):
+        """ Purpose: Run func against every host, yielding each response as soon as it completes.
+
+            :param hosts:       -   List of IPs or hostnames
+            :param func:        -   Function that accepts the device handle as its first argument
+            :return:            -   Generator of response dictionaries, in completion order
+        """
+        done = Queue.Queue()
+        for host in hosts:
+            self.pool.apply_async(self.run, (host, func) + args, kwargs, callback=done.put)
+        for _ in hosts:
+            # A timeout on get() keeps the wait interruptible with Ctrl-C
+            while True:
+                try:
+                    response = done.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                else:
+                    break
+            yield response
+
+    def close(self):
+        """ Purpose: Stop accepting requests and wait for the running ones to finish. """
+        self.pool.close()
+        self.pool.join()
+
+
+# RPC helpers, these take an open device handle as the first argument
+def rpc_get_config(dev, options):
+    return dev.rpc.get_config(options=options)
+
+def rpc_get_interface_information(dev, **kwargs):
+    return dev.rpc.get_interface_information(**kwargs)
+
+def rpc_get_chassis_inventory(dev):
+    return dev.rpc.get_chassis_inventory()
+
+def rpc_cli(dev, command):
+    return dev.cli(command, warning=False)
@@ -0,0 +1,279 @@
+# File: template_engine.py
+# Author: Tyler Jordan
+# Purpose: Compiles the device_refresh template files into regex patterns once per process. A compiled template set
+# is kept for each (model family, is_mdf) and rebuilt only when one of its files changes.
+
+import os
+import re
+import csv
+import hashlib
+import threading
+
+
+# Reads a file into a list of lines without line endings, empty list if it can't be read
+def read_lines(path):
+    try:
+        with open(path, 'r') as fin:
+            return [line.replace('\n', '').replace('\r', '') for line in fin.readlines()]
+    except IOError:
+        return []
+
+# Converts a two term CSV file into a dictionary of key, value pairs
+def read_two_term_csv(path, delim=";"):
+    try:
+        with open(path) as fin:
+            return dict(filter(None, csv.reader(fin, delimiter=delim)))
+    except Exception as err:
+        print "Error converting file to dictionary: ERROR: {0}".format(err)
+        return {}
+
+# Modification time of a file, None if it doesn't exist
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+# Model family used to pick the model specific template
+def model_family(model):
+    if "EX4300" in model:
+        return "els"
+    return "nonels"
+
+# Creates a dictionary of the template variables and their corresponding regex
+def template_mapping(regex_terms, regex_mapping):
+    map_dict = {}
+    for key1, value1 in regex_mapping.iteritems():
+        if value1 in regex_terms:
+            map_dict[key1] = regex_terms[value1]
+    return map_dict
+
+# Converts a template line into a regex, variables ({{NAME}}) become the mapped regex and the rest is escaped
+def template_str_parse(str, map_dict):
+    tline = ""
+    openbracket = False
+    closebracket = False
+    onvar = False
+    varstr = ""
+    textstr = ""
+    # Loop over each character in the string
+    for char in str:
+        # If this character is an open bracket
+        if char == "{":
+            if openbracket:
+                onvar = True
+                openbracket = False
+            else:
+                openbracket = True
+                # Add any standard text (escaped)
+                tline += re.escape(textstr)
+                # Clear the textstr
+                textstr = ""
+        # If this character is a close bracket
+        elif char == "}":
+            if closebracket:
+                onvar = False
+                closebracket = False
+            else:
+                closebracket = True
+                # Add the corresponding regex expression
+                tline += map_dict[varstr]
+                # Clear the varstr
+                varstr = ""
+        # If this character if part of a regex variable
+        elif onvar:
+            # Append this character to the variable string
+            varstr += char
+        # If this character is a regular character
+        else:
+            # Append this character to the text string
+            textstr += char
+
+    # Add any remaining text, might happen if string ends on a close bracket
+    tline += re.escape(textstr)
+    return tline
+
+# Literal text a template line starts with, any match of its regex has to contain this text
+def literal_prefix(tline, regex):
+    prefix = tline.split("{", 1)[0]
+    # Only trust it if the regex really starts with the escaped text (ie. stripped whitespace)
+    if regex.startswith(re.escape(prefix)):
+        return prefix
+    return ""
+
+# Regex matching any of the words, built as a trie so each position is tried against one branch per character
+def trie_regex(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+    return trie_node_regex(trie)
+
+def trie_node_regex(node):
+    branches = []
+    for char in sorted(node.keys()):
+        if char:
+            branches.append(re.escape(char) + trie_node_regex(node[char]))
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    regex = "(?:" + "|".join(branches) + ")"
+    # The longer words are tried before ending here
+    if "" in node:
+        regex += "?"
+    return regex
+
+
+class TemplateSet(object):
+    """ Purpose: The compiled template for one (model family, is_mdf).
+
+        regex_list          -   Regex strings of the required template lines, in template order
+        patterns            -   Compiled regex_list
+        matcher             -   PrefixMatcher over regex_list
+        opt_regex_list      -   Regex strings of the optional template lines
+        opt_patterns        -   Compiled opt_regex_list
+        opt_matcher         -   PrefixMatcher over opt_regex_list
+        map_dict            -   Template variable to regex mapping
+        digest              -   SHA-256 of every file the set was built from
+    """
+    def __init__(self, lines, opt_lines, map_dict, digest):
+        self.map_dict = map_dict
+        self.digest = digest
+        self.regex_list, self.patterns, self.matcher = self.compile_lines(lines)
+        self.opt_regex_list, self.opt_patterns, self.opt_matcher = self.compile_lines(opt_lines)
+
+    def compile_lines(self, lines):
+        regex_list = []
+        prefixes = []
+        for line in lines:
+            if line != "":
+                regex = template_str_parse(line, self.map_dict).strip('\n\t')
+                regex_list.append(regex)
+                prefixes.append(literal_prefix(line, regex))
+        return regex_list, [re.compile(regex) for regex in regex_list], PrefixMatcher(prefixes)
+
+    def first_match(self, line, remaining):
+        """ Purpose: Return the position of the first template regex in "remaining" that matches the line, None if
+        none of them do.
+        """
+        for index in self.matcher.candidates(line):
+            if index in remaining and self.patterns[index].search(line):
+                return index
+        return None
+
+    def opt_match(self, line):
+        """ Purpose: Return True if the line matches any of the optional template regex. """
+        for index in self.opt_matcher.candidates(line):
+            if self.opt_patterns[index].search(line):
+                return True
+        return False
+
+
+class PrefixMatcher(object):
+    """ Purpose: Narrows a config line down to the template regex that can match it. Each regex is indexed by its
+    literal prefix (ie. "set snmp community "), a regex can't match a line that doesn't contain its prefix.
+
+        - One pass of a trie regex over the line finds the longest prefix at each position. Every shorter prefix
+          found at that position is a prefix of it, so they are looked up ahead of time.
+        - Regex with no literal prefix (the template line starts with a variable) are candidates for every line.
+
+    candidates() returns the regex positions in template order, so the first one that matches is the same one a
+    search of the whole list finds.
+    """
+    def __init__(self, prefixes):
+        self.always = []
+        by_prefix = {}
+        for index, prefix in enumerate(prefixes):
+            if prefix:
+                by_prefix.setdefault(prefix, []).append(index)
+            else:
+                self.always.append(index)
+        # Positions of every regex whose prefix is found along with this one
+        self.closure = {}
+        for prefix in by_prefix:
+            indexes = list(self.always)
+            for end in range(1, len(prefix) + 1):
+                indexes += by_prefix.get(prefix[:end], [])
+            self.closure[prefix] = sorted(indexes)
+        self.finder = None
+        if by_prefix:
+            self.finder = re.compile("(?=(" + trie_regex(by_prefix.keys()) + "))")
+
+    def candidates(self, line):
+        """ Purpose: Return the positions of the regex that might match the line, in template order. """
+        found = []
+        if self.finder:
+            for match in self.finder.finditer(line):
+                if match.group(1) not in found:
+                    found.append(match.group(1))
+        if not found:
+            return self.always
+        if len(found) == 1:
+            return self.closure[found[0]]
+        indexes = set()
+        for prefix in found:
+            indexes.update(self.closure[prefix])
+        return sorted(indexes)
+
+
+class TemplateCompiler(object):
+    """ Purpose: Builds and caches the TemplateSet of each (model family, is_mdf). A cached set is reused until the
+    modification time of one of its files changes. Safe to share between check worker threads.
+
+    files is a dictionary with the paths of the template files:
+        'all', 'els', 'nonels', 'ospf', 'opt', 'regex_csv', 'map_csv'
+    """
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()
+        self.sets = {}          # (family, is_mdf) -> (mtimes, TemplateSet)
+        self.map_cache = None   # (mtimes, map_dict)
+
+    def set_files(self, model, is_mdf):
+        """ Purpose: Return the template files used for a model, in the order they are added. """
+        # The OSPF template replaces the model template on route points
+        if is_mdf:
+            addl_file = self.files['ospf']
+        else:
+            addl_file = self.files[model_family(model)]
+        return [self.files['all'], addl_file]
+
+    def mapping(self):
+        """ Purpose: Return the template variable to regex mapping. """
+        csv_files = [self.files['regex_csv'], self.files['map_csv']]
+        mtimes = [file_mtime(path) for path in csv_files]
+        with self.lock:
+            if self.map_cache is None or self.map_cache[0] != mtimes:
+                map_dict = template_mapping(read_two_term_csv(csv_files[0]), read_two_term_csv(csv_files[1]))
+                self.map_cache = (mtimes, map_dict)
+            return self.map_cache[1]
+
+    def get(self, model, is_mdf):
+        """ Purpose: Return the compiled template for a device.
+
+            :param model:       -   Model of the device (ie. EX4300-48P)
+            :param is_mdf:      -   True/False, the device runs OSPF (route point)
+            :return:            -   TemplateSet
+        """
+        key = (model_family(model), bool(is_mdf))
+        template_files = self.set_files(model, is_mdf)
+        all_files = template_files + [self.files['opt'], self.files['regex_csv'], self.files['map_csv']]
+        mtimes = [file_mtime(path) for path in all_files]
+        with self.lock:
+            cached = self.sets.get(key)
+            if cached and cached[0] == mtimes:
+                return cached[1]
+        map_dict = self.mapping()
+        lines = []
+        for path in template_files:
+            lines += read_lines(path)
+        digest = hashlib.sha256()
+        for path in all_files:
+            digest.update(path + "\0" + "\n".join(read_lines(path)) + "\0")
+        template_set = TemplateSet(lines, read_lines(self.files['opt']), map_dict, digest.hexdigest())
+        with self.lock:
+            self.sets[key] = (mtimes, template_set)
+        return template_set
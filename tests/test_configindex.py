@@ -0,0 +1,68 @@
+# File: test_configindex.py
+# Author: Tyler Jordan
+# Purpose: Tests for the config search index.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from configindex import ConfigIndex
+from configstore import ConfigStore
+
+
+configs = {
+    'abc-sw1': "set system host-name abc-sw1\nset snmp community public authorization read-only\n"
+               "set interfaces ge-0/0/1 description uplink\n",
+    'abc-sw2': "set system host-name abc-sw2\nset snmp community private authorization read-write\n"
+               "set interfaces ge-0/0/1 description printer\n",
+}
+
+
+class ConfigIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index = ConfigIndex(os.path.join(self.temp_dir, "config_index.sqlite"))
+        for hostname, config in configs.items():
+            self.index.update(hostname, config, saved="2026-01-01_0000")
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_contains(self):
+        results = self.index.search("community p")
+        self.assertEqual(sorted(results), ['abc-sw1', 'abc-sw2'])
+        self.assertEqual(self.index.search("description upl"),
+                         {'abc-sw1': ["set interfaces ge-0/0/1 description uplink"]})
+        self.assertEqual(self.index.search("nothing like this"), {})
+
+    def test_prefix_and_regex(self):
+        self.assertEqual(sorted(self.index.search("set snmp community", 'prefix')), ['abc-sw1', 'abc-sw2'])
+        self.assertEqual(self.index.search("snmp community", 'prefix'), {})
+        self.assertEqual(sorted(self.index.search("read-(only|write)$", 'regex')), ['abc-sw1', 'abc-sw2'])
+
+    def test_update_replaces_config(self):
+        self.assertFalse(self.index.update('abc-sw1', configs['abc-sw1']))
+        self.assertTrue(self.index.update('abc-sw1', "set system host-name abc-sw1\n", saved="2026-01-02_0000"))
+        self.assertEqual(sorted(self.index.search("community")), ['abc-sw2'])
+        self.assertEqual(self.index.config_info('abc-sw1')['saved'], "2026-01-02_0000")
+
+    def test_remove(self):
+        self.index.remove('abc-sw2')
+        self.index.prune()
+        self.assertEqual(sorted(self.index.search("community")), ['abc-sw1'])
+        self.assertEqual(self.index.hostnames(), ['abc-sw1'])
+
+    def test_sync_adds_and_drops_devices(self):
+        config_dir = os.path.join(self.temp_dir, "configs")
+        device_dir = os.path.join(config_dir, "ABC", "abc-sw3")
+        os.makedirs(device_dir)
+        ConfigStore(device_dir).add(u"set system host-name abc-sw3\nset snmp community public\n", "2026-01-03_0000")
+        self.assertEqual(self.index.sync(config_dir), 1)
+        self.assertEqual(sorted(self.index.search("community public")), ['abc-sw3'])
+        self.assertEqual(self.index.sync(config_dir), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# File: test_configstore.py
+# Author: Tyler Jordan
+# Purpose: Tests for the config history store and the config diff.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import configstore
+from configstore import ConfigStore, ConfigDiff, make_delta, apply_delta, config_digest
+
+
+def make_config(num, changed=()):
+    lines = []
+    for index in range(num):
+        description = "changed" if index in changed else "port"
+        lines.append("set interfaces ge-0/0/{0} description {1}\n".format(index, description))
+    return u"".join(lines)
+
+
+class DeltaTest(unittest.TestCase):
+    def test_round_trip(self):
+        new = make_config(50, changed=[3, 40]).splitlines(True)
+        old = make_config(45).splitlines(True) + [u"set system host-name old\n"]
+        self.assertEqual(apply_delta(new, make_delta(new, old)), old)
+
+    def test_round_trip_empty(self):
+        old = make_config(5).splitlines(True)
+        self.assertEqual(apply_delta([], make_delta([], old)), old)
+        self.assertEqual(apply_delta(old, make_delta(old, [])), [])
+
+
+class ConfigStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.device_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.device_dir)
+
+    def test_every_revision_readable(self):
+        store = ConfigStore(self.device_dir)
+        configs = [make_config(30, changed=[num]) for num in range(6)]
+        for num, config in enumerate(configs):
+            self.assertTrue(store.add(config, "2026-01-0{0}_0000".format(num + 1)))
+        store = ConfigStore(self.device_dir)
+        self.assertEqual(store.newest(), configs[-1])
+        for config in configs:
+            self.assertEqual(store.get(config_digest(config)), config)
+        # Only the newest is kept whole, each other revision is one delta file
+        files = sorted(os.listdir(store.snapshot_dir))
+        self.assertEqual(len([name for name in files if name.endswith(".delta.z")]), 5)
+        self.assertEqual(len([name for name in files if not name.endswith(".delta.z") and name.endswith(".z")]), 1)
+
+    def test_unchanged_config_only_refreshes(self):
+        store = ConfigStore(self.device_dir)
+        config = make_config(10)
+        store.add(config, "2026-01-01_0000")
+        self.assertFalse(store.add(config, "2026-01-02_0000"))
+        self.assertEqual(len(store.revisions()), 1)
+        self.assertEqual(store.newest_revision()['refreshed'], "2026-01-02_0000")
+
+    def test_revert_to_earlier_config(self):
+        store = ConfigStore(self.device_dir)
+        first = make_config(20)
+        second = make_config(20, changed=[5])
+        store.add(first, "2026-01-01_0000")
+        store.add(second, "2026-01-02_0000")
+        store.add(first, "2026-01-03_0000")
+        store = ConfigStore(self.device_dir)
+        self.assertEqual(store.newest(), first)
+        self.assertEqual(store.get(config_digest(second)), second)
+        self.assertFalse(os.path.exists(store.object_file(config_digest(first), delta=True)))
+
+    def test_prune(self):
+        saved = configstore.max_revisions
+        configstore.max_revisions = 3
+        try:
+            store = ConfigStore(self.device_dir)
+            configs = [make_config(10, changed=[num]) for num in range(6)]
+            for num, config in enumerate(configs):
+                store.add(config, "2026-01-0{0}_0000".format(num + 1))
+        finally:
+            configstore.max_revisions = saved
+        store = ConfigStore(self.device_dir)
+        self.assertEqual([revision['digest'] for revision in store.revisions()],
+                         [config_digest(config) for config in configs[-3:]])
+        for config in configs[-3:]:
+            self.assertEqual(store.get(config_digest(config)), config)
+        self.assertEqual(len(os.listdir(store.snapshot_dir)), 4)
+
+    def test_crash_before_index_saved(self):
+        store = ConfigStore(self.device_dir)
+        first = make_config(20)
+        store.add(first, "2026-01-01_0000")
+
+        def crash():
+            raise IOError("crash")
+        store.save_index = crash
+        self.assertRaises(IOError, store.add, make_config(20, changed=[1]), "2026-01-02_0000")
+        store = ConfigStore(self.device_dir)
+        self.assertEqual(store.newest(), first)
+        self.assertEqual(len(store.revisions()), 1)
+        # The next save picks up from the saved index
+        second = make_config(20, changed=[2])
+        store.add(second, "2026-01-03_0000")
+        store = ConfigStore(self.device_dir)
+        self.assertEqual(store.get(config_digest(first)), first)
+        self.assertEqual(store.newest(), second)
+
+    def test_reads_deltas_stored_under_the_old_name(self):
+        store = ConfigStore(self.device_dir)
+        first = make_config(20)
+        second = make_config(20, changed=[4])
+        store.add(first, "2026-01-01_0000")
+        store.add(second, "2026-01-02_0000")
+        digest = config_digest(first)
+        os.rename(store.object_file(digest, delta=True), store.object_file(digest))
+        self.assertEqual(ConfigStore(self.device_dir).get(digest), first)
+
+
+class ConfigDiffTest(unittest.TestCase):
+    def test_set_config_changes(self):
+        old = "set a 1\nset b 2\nset c 3\n"
+        new = "set a 1\nset c 3\nset d 4\n"
+        diff = ConfigDiff(old, new)
+        self.assertEqual(list(diff), ["- set b 2\n", "+ set d 4\n"])
+        self.assertEqual((diff.added, diff.removed), (1, 1))
+
+    def test_reordered_statements(self):
+        diff = ConfigDiff("set a 1\nset b 2\n", "set b 2\nset a 1\n")
+        self.assertEqual(diff.count(), (1, 1))
+
+    def test_identical_configs(self):
+        config = make_config(10)
+        self.assertEqual(list(ConfigDiff(config, config)), [])
+
+    def test_hierarchical_configs(self):
+        old = "system {\n    host-name a;\n}\n"
+        new = "system {\n    host-name b;\n}\n"
+        self.assertEqual(list(ConfigDiff(old, new)), ["-     host-name a;\n", "+     host-name b;\n"])
+
+
+if __name__ == '__main__':
+    unittest.main()
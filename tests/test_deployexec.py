@@ -0,0 +1,117 @@
+# File: test_deployexec.py
+# Author: Tyler Jordan
+# Purpose: Tests for the deploy executor. Run from the repository root with "python -m unittest discover -s tests -t ."
+
+import os
+import time
+import threading
+import unittest
+
+import deployexec
+from deployexec import DeployExecutor, site_key
+
+
+# Jobs run in the worker processes, so they are module level
+def push_ok(arg):
+    time.sleep(0.05)
+    return {'ip': arg, 'ok': True}
+
+def push_exit(arg):
+    if arg == 'die':
+        os._exit(1)
+    return push_ok(arg)
+
+def push_raise(arg):
+    if arg == 'raise':
+        raise ValueError(u'caf\xe9')
+    return push_ok(arg)
+
+def push_unpicklable(arg):
+    if arg == 'lock':
+        return threading.Lock()
+    return push_ok(arg)
+
+def push_hang(arg):
+    if arg == 'hang':
+        time.sleep(60)
+    return push_ok(arg)
+
+
+class DeployExecutorRunTest(unittest.TestCase):
+    def run_jobs(self, func, args, **kwargs):
+        """ Runs the jobs in a thread, so a hang fails the test instead of blocking it. """
+        completed = []
+        outcome = {}
+        def target():
+            outcome['results'] = DeployExecutor(3, 5, **kwargs).run(
+                func, [(str(index), arg) for index, arg in enumerate(args)],
+                lambda arg, result, error: completed.append((arg, result, error)))
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "DeployExecutor.run() hung")
+        return outcome['results'], dict((arg, (result, error)) for arg, result, error in completed)
+
+    def test_results_in_job_order(self):
+        args = ['10.0.0.%d' % num for num in range(12)]
+        results, completed = self.run_jobs(push_ok, args)
+        self.assertEqual([result['ip'] for result in results], args)
+        self.assertEqual(len(completed), len(args))
+
+    def test_worker_killed(self):
+        results, completed = self.run_jobs(push_exit, ['a', 'die', 'b', 'c'])
+        self.assertEqual(completed['die'], (None, "Worker Process Died"))
+        self.assertEqual([result and result['ip'] for result in results], ['a', None, 'b', 'c'])
+
+    def test_exception_with_non_ascii_message(self):
+        results, completed = self.run_jobs(push_raise, ['a', 'raise', 'b'])
+        self.assertIsNone(results[1])
+        self.assertIn('caf', completed['raise'][1])
+
+    def test_unpicklable_result(self):
+        results, completed = self.run_jobs(push_unpicklable, ['a', 'lock', 'b'])
+        self.assertIsNone(results[1])
+        self.assertTrue(completed['lock'][1].startswith("Result Failed"))
+        self.assertEqual(results[2]['ip'], 'b')
+
+    def test_timed_out_job(self):
+        saved = deployexec.job_timeout
+        deployexec.job_timeout = 1
+        try:
+            results, completed = self.run_jobs(push_hang, ['a', 'hang', 'b'])
+        finally:
+            deployexec.job_timeout = saved
+        self.assertTrue(completed['hang'][1].startswith("Timed Out"))
+        self.assertEqual(results[2]['ip'], 'b')
+
+
+class DeployExecutorAdaptTest(unittest.TestCase):
+    def test_window_halves_on_errors(self):
+        executor = DeployExecutor(workers=8, max_workers=10)
+        for num in range(deployexec.sample_size):
+            executor.adapt(1.0, num % 2 == 0)
+        self.assertEqual(executor.window, 4)
+
+    def test_window_grows_after_clean_runs(self):
+        executor = DeployExecutor(workers=2, max_workers=3)
+        for num in range(deployexec.sample_size + 6):
+            executor.adapt(1.0, False)
+        self.assertEqual(executor.window, 3)
+
+    def test_window_stays_within_limits(self):
+        executor = DeployExecutor(workers=50, max_workers=4, min_workers=2)
+        self.assertEqual(executor.window, 4)
+        for num in range(deployexec.sample_size * 4):
+            executor.adapt(1.0, True)
+        self.assertEqual(executor.window, 2)
+
+
+class SiteKeyTest(unittest.TestCase):
+    def test_falls_back_to_subnet(self):
+        self.assertEqual(site_key('10.1.2.3'), '10.1.2')
+        self.assertEqual(site_key('10.1.2.3', 'nohyphen'), '10.1.2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# File: test_devicedb.py
+# Author: Tyler Jordan
+# Purpose: Tests for the device store, its SQLite backend and journal, the subnet index and the failing device tracker.
+
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from devicedb import DeviceStore, SqliteDeviceDB, DeviceJournal, SubnetIndex, FailTracker, JournalLock, \
+    replay_journal
+
+
+def make_record(num, site=1):
+    inet_intf = {'interface': 'vlan.{0}'.format(num), 'ipaddr': '10.{0}.{1}.1'.format(site, num), 'ipmask': '24',
+                 'status': 'up', 'updated': ''}
+    return {'ip': '10.{0}.0.{1}'.format(site, num), 'hostname': 'sw{0}'.format(num),
+            'serialnumber': 'SN{0}'.format(num), 'version': '15.1', 'inet_intf': [inet_intf]}
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+
+class DeviceStoreTest(unittest.TestCase):
+    def test_lookups_follow_changes(self):
+        store = DeviceStore([make_record(1), make_record(2)])
+        record = store.find('hostname', 'sw1')
+        store.update_record(record, {'hostname': 'core1'})
+        self.assertIsNone(store.find('hostname', 'sw1'))
+        self.assertIs(store.get_record(hostname='core1'), record)
+        self.assertIs(store.get_record(ip='10.1.1.1'), record)
+        store.remove(record)
+        self.assertFalse(store.get_record(ip='10.1.1.1'))
+
+    def test_tracks_changes(self):
+        store = DeviceStore([make_record(1), make_record(2)])
+        self.assertEqual((store.changed, store.removed), ({}, {}))
+        first, second = list(store)
+        store.update_record(first, {'last_access': 'now'})
+        store.remove(second)
+        added = make_record(3)
+        store.append(added)
+        self.assertEqual(sorted(record['hostname'] for record in store.changed.values()), ['sw1', 'sw3'])
+        self.assertEqual(store.removed.values(), [second])
+        store.clear_changes()
+        self.assertEqual((store.changed, store.removed), ({}, {}))
+
+
+class SqliteDeviceDBTest(TempDirTest):
+    def load(self):
+        return SqliteDeviceDB(self.path('main_db.sqlite')).load()
+
+    def test_save_only_changed_records(self):
+        db = SqliteDeviceDB(self.path('main_db.sqlite'))
+        self.assertEqual(db.save([make_record(num) for num in range(5)]), 5)
+        store = db.load()
+        self.assertEqual(db.save(store), 0)
+        store.update_record(store.find('hostname', 'sw2'), {'hostname': 'core2'})
+        store.remove(store.find('hostname', 'sw3'))
+        store.append(make_record(9))
+        self.assertEqual(db.save(store), 3)
+        self.assertEqual(db.save(store), 0)
+        self.assertEqual([record['hostname'] for record in self.load()], ['sw0', 'sw1', 'core2', 'sw4', 'sw9'])
+        self.assertEqual(db.find_by_address('10.1.9.1')[0]['hostname'], 'sw9')
+
+    def test_removed_and_added_back(self):
+        db = SqliteDeviceDB(self.path('main_db.sqlite'))
+        db.save([make_record(1)])
+        store = db.load()
+        record = store.find('hostname', 'sw1')
+        store.remove(record)
+        store.append(record)
+        db.save(store)
+        self.assertEqual([record['hostname'] for record in self.load()], ['sw1'])
+
+    def test_changed_by_position(self):
+        db = SqliteDeviceDB(self.path('main_db.sqlite'))
+        db.save([make_record(num) for num in range(3)])
+        store = db.load()
+        del store[0]
+        self.assertEqual(db.save(store), 3)
+        self.assertEqual([record['hostname'] for record in self.load()], ['sw1', 'sw2'])
+
+
+class JournalTest(TempDirTest):
+    def test_replay(self):
+        store = DeviceStore([make_record(1), make_record(2)])
+        store.journal = DeviceJournal(self.path('main_db.journal'))
+        store.update_record(store.find('hostname', 'sw1'), {'version': '18.4'})
+        store.delete_key(store.find('hostname', 'sw1'), 'serialnumber')
+        store.remove(store.find('hostname', 'sw2'))
+        store.append(make_record(3))
+        store.journal.close()
+        # A partly written last line is skipped
+        with open(self.path('main_db.journal'), 'a') as fout:
+            fout.write('{"op": "remove", "ip"')
+
+        saved = DeviceStore([make_record(1), make_record(2)])
+        self.assertEqual(replay_journal(saved, self.path('main_db.journal')), 4)
+        self.assertEqual([record['hostname'] for record in saved], ['sw1', 'sw3'])
+        self.assertEqual(saved.find('hostname', 'sw1')['version'], '18.4')
+        self.assertNotIn('serialnumber', saved.find('hostname', 'sw1'))
+
+    def test_replay_missing_journal(self):
+        self.assertEqual(replay_journal(DeviceStore(), self.path('none.journal')), 0)
+
+    def test_lock_has_one_owner(self):
+        first = JournalLock(self.path('main_db.json'))
+        second = JournalLock(self.path('main_db.json'))
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertEqual(second.owner(), str(os.getpid()))
+        first.release()
+        self.assertTrue(second.acquire())
+        second.release()
+
+
+class SubnetIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.core = {'hostname': 'core', 'inet_intf': [{'ipaddr': '10.0.0.0', 'ipmask': '8'},
+                                                       {'ipaddr': '10.1.0.0', 'ipmask': '255.255.0.0'}]}
+        self.access = {'hostname': 'access', 'inet_intf': [{'ipaddr': '10.1.2.0', 'ipmask': '24'},
+                                                           {'ipaddr': 'bad', 'ipmask': '24'}]}
+        self.index = SubnetIndex([self.core, self.access])
+
+    def test_longest_match(self):
+        matches = self.index.longest('10.1.2.77')
+        self.assertEqual([(prefixlen, record['hostname']) for prefixlen, record, inet_intf in matches],
+                         [(24, 'access')])
+
+    def test_all_matches_most_specific_first(self):
+        self.assertEqual([match[0] for match in self.index.matches('10.1.2.77')], [24, 16, 8])
+        self.assertEqual(self.index.matches('192.168.1.1'), [])
+        self.assertEqual(self.index.networks, 3)
+
+    def test_lookup_many(self):
+        results = self.index.lookup_many(['10.9.9.9', 'not an ip'])
+        self.assertEqual(results[0][1][0][0], 8)
+        self.assertEqual(results[1], ('not an ip', []))
+
+
+class FailTrackerTest(TempDirTest):
+    def tracker(self, limit=3):
+        return FailTracker(self.path('Failing_Devices.csv'), self.path('Removed_Devices.csv'), limit)
+
+    def days_ago(self, days):
+        return (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d_%H%M")
+
+    def test_first_and_later_failures(self):
+        tracker = self.tracker()
+        now = self.days_ago(0)
+        self.assertEqual(tracker.failed('10.0.0.1', now), ("1", True, False))
+        self.assertEqual(tracker.failed('10.0.0.1', now), ("0", False, False))
+
+    def test_removed_past_limit(self):
+        tracker = self.tracker()
+        tracker.failed('10.0.0.1', self.days_ago(5))
+        tracker.failed('10.0.0.2', self.days_ago(1))
+        tracker.records['10.0.0.1']['date_added'] = self.days_ago(5)
+        self.assertEqual(tracker.failed('10.0.0.1', self.days_ago(0)), ("5", False, True))
+        self.assertTrue(tracker.save())
+        # The removed device is dropped from the failing devices, and listed as removed
+        tracker = self.tracker()
+        self.assertEqual(tracker.records.keys(), ['10.0.0.2'])
+        with open(self.path('Removed_Devices.csv')) as fin:
+            self.assertIn('10.0.0.1', fin.read())
+
+    def test_saved_between_runs(self):
+        tracker = self.tracker()
+        tracker.failed('10.0.0.1', self.days_ago(0))
+        tracker.save()
+        self.assertEqual(self.tracker().failed('10.0.0.1', self.days_ago(0))[1], False)
+
+
+if __name__ == '__main__':
+    unittest.main()
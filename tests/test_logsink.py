@@ -0,0 +1,92 @@
+# File: test_logsink.py
+# Author: Tyler Jordan
+# Purpose: Tests for the buffered log writes.
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from logsink import LogSink, CaptureSink
+
+
+class LogSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.temp_dir, "test.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read(self):
+        if not os.path.exists(self.log):
+            return ""
+        with open(self.log) as fin:
+            return fin.read()
+
+    def test_buffered_until_flush(self):
+        sink = LogSink(flush_interval=60)
+        sink.write("one\n", self.log)
+        sink.write("two", self.log)
+        self.assertEqual(self.read(), "")
+        # Only whole lines, unless asked to complete
+        sink.flush()
+        self.assertEqual(self.read(), "one\n")
+        sink.write(" halves\n", self.log)
+        sink.flush(complete=True)
+        self.assertEqual(self.read(), "one\ntwo halves\n")
+
+    def test_flushed_when_buffer_fills(self):
+        sink = LogSink(buffer_size=100, flush_interval=60)
+        for num in range(20):
+            sink.write("line {0}\n".format(num), self.log)
+        self.assertTrue(self.read().startswith("line 0\n"))
+
+    def test_timer_flushes_idle_logs(self):
+        sink = LogSink(flush_interval=0.2)
+        sink.write("line\n", self.log)
+        sink.write("prompt: ", self.log)
+        time.sleep(0.6)
+        self.assertEqual(self.read(), "line\nprompt: ")
+
+    def test_unicode(self):
+        sink = LogSink()
+        sink.write(u"caf\xe9\n", self.log)
+        sink.close()
+        self.assertEqual(self.read(), "caf\xc3\xa9\n")
+
+    def test_forked_writers_keep_lines_whole(self):
+        sink = LogSink(buffer_size=512, flush_interval=60)
+        sink.write("parent\n", self.log)
+        pids = []
+        for num in range(4):
+            pid = os.fork()
+            if pid == 0:
+                for count in range(500):
+                    sink.write("worker {0} ".format(num), self.log)
+                    sink.write("line {0} {1}\n".format(count, "x" * 40), self.log)
+                sink.close()
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        sink.close()
+        lines = self.read().splitlines()
+        self.assertEqual(len(lines), 2001)
+        self.assertEqual(lines.count("parent"), 1)
+        for line in lines:
+            self.assertTrue(line == "parent" or (line.startswith("worker ") and line.endswith("x" * 40)), line)
+
+
+class CaptureSinkTest(unittest.TestCase):
+    def test_take(self):
+        sink = CaptureSink()
+        sink.write("one\n", "a.log")
+        sink.write("two", "b.log")
+        self.assertEqual(sorted(sink.take()), [("a.log", "one\n"), ("b.log", "two")])
+        self.assertEqual(sink.take(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# File: test_template_engine.py
+# Author: Tyler Jordan
+# Purpose: Tests for the template compiler and the prefix matcher that narrows config lines to template regex.
+
+import os
+import re
+import shutil
+import random
+import tempfile
+import unittest
+
+from template_engine import PrefixMatcher, TemplateSet, TemplateCompiler, template_str_parse, literal_prefix, \
+    trie_regex
+
+
+map_dict = {'IP': '\\d+\\.\\d+\\.\\d+\\.\\d+', 'NAME': '\\S+', 'NUM': '\\d+'}
+
+template_lines = [
+    "set system host-name {{NAME}}",
+    "set system name-server {{IP}}",
+    "set snmp community {{NAME}} authorization read-only",
+    "set snmp location {{NAME}}",
+    "set snmp",
+    "{{NAME}} interfaces ge-0/0/{{NUM}} unit 0",
+    "set interfaces ge-0/0/{{NUM}} description {{NAME}}",
+    "set interfaces ge-0/0/{{NUM}} unit 0 family ethernet-switching",
+    "set protocols lldp interface all",
+]
+
+config_lines = [
+    "set system host-name abc-sw1",
+    "set system name-server 10.0.0.1",
+    "set snmp community public authorization read-only",
+    "set snmp location closet",
+    "set interfaces ge-0/0/1 description uplink",
+    "set interfaces ge-0/0/1 unit 0 family ethernet-switching",
+    "delete interfaces ge-0/0/2 unit 0",
+    "set protocols lldp interface all",
+    "set protocols rstp",
+    "set routing-options static route 0.0.0.0/0 next-hop 10.0.0.254",
+]
+
+
+class PrefixMatcherTest(unittest.TestCase):
+    def test_candidates_cover_every_match_in_order(self):
+        template_set = TemplateSet(template_lines, [], map_dict, 'digest')
+        for line in config_lines:
+            expected = [index for index, pattern in enumerate(template_set.patterns) if pattern.search(line)]
+            candidates = template_set.matcher.candidates(line)
+            self.assertEqual(candidates, sorted(candidates))
+            for index in expected:
+                self.assertIn(index, candidates)
+
+    def test_first_match_same_as_full_scan(self):
+        template_set = TemplateSet(template_lines, [], map_dict, 'digest')
+        remaining = set(range(len(template_set.patterns)))
+        for line in config_lines:
+            expected = None
+            for index, pattern in enumerate(template_set.patterns):
+                if index in remaining and pattern.search(line):
+                    expected = index
+                    break
+            self.assertEqual(template_set.first_match(line, remaining), expected)
+            if expected is not None:
+                remaining.remove(expected)
+
+    def test_random_prefixes(self):
+        random.seed(7)
+        words = ['set', 'snmp', 'system', 'interfaces', 'vlan', 'a', 'ab', 'abc']
+        for trial in range(50):
+            prefixes = [" ".join(random.sample(words, random.randint(0, 3))) for num in range(12)]
+            matcher = PrefixMatcher(prefixes)
+            for num in range(20):
+                line = " ".join(random.choice(words) for count in range(6))
+                candidates = set(matcher.candidates(line))
+                for index, prefix in enumerate(prefixes):
+                    if prefix in line:
+                        self.assertIn(index, candidates)
+
+    def test_no_prefixes(self):
+        matcher = PrefixMatcher(["", ""])
+        self.assertEqual(matcher.candidates("set anything"), [0, 1])
+
+    def test_trie_regex(self):
+        pattern = re.compile("^" + trie_regex(["set", "set snmp", "show"]) + "$")
+        for word in ["set", "set snmp", "show"]:
+            self.assertTrue(pattern.match(word))
+        self.assertFalse(pattern.match("se"))
+
+    def test_literal_prefix(self):
+        line = "set snmp community {{NAME}}"
+        self.assertEqual(literal_prefix(line, template_str_parse(line, map_dict)), "set snmp community ")
+        self.assertEqual(literal_prefix("{{NAME}} interfaces", template_str_parse("{{NAME}} interfaces", map_dict)),
+                         "")
+
+
+class TemplateCompilerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.files = {}
+        for name in ['all', 'els', 'nonels', 'ospf', 'opt']:
+            self.files[name] = self.write(name + ".conf", "set system host-name {{NAME}}\n")
+        self.files['regex_csv'] = self.write("template_regex.csv", "name;\\S+\n")
+        self.files['map_csv'] = self.write("template_regex_map.csv", "NAME;name\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as fout:
+            fout.write(text)
+        return path
+
+    def test_cached_until_a_file_changes(self):
+        compiler = TemplateCompiler(self.files)
+        first = compiler.get('EX4300-48P', False)
+        self.assertIs(compiler.get('EX4300-24T', False), first)
+        self.assertIsNot(compiler.get('EX2200-48P', False), first)
+        self.write("els.conf", "set system host-name {{NAME}}\nset snmp location {{NAME}}\n")
+        stat = os.stat(self.files['els'])
+        os.utime(self.files['els'], (stat.st_atime, stat.st_mtime + 10))
+        changed = compiler.get('EX4300-48P', False)
+        self.assertIsNot(changed, first)
+        self.assertNotEqual(changed.digest, first.digest)
+        self.assertEqual(len(changed.patterns), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
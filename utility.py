@@ -3,6 +3,7 @@
 # Purpose: Assist CBP engineers with Juniper configuration tasks
 
 import re, os, csv
+import socket
 import fileinput
 import glob
 import math
@@ -26,6 +27,16 @@ from jnpr.junos.exception import CommitError
 from ncclient import manager  # https://github.com/ncclient/ncclient
 from ncclient.transport import errors
 from sys import stdout
+from sessions import open_device, close_device
+from logsink import write_log, write_json_log, flush_logs
+from configstore import replace_file
+from devicedb import DeviceStore, SqliteDeviceDB, DeviceJournal, JournalLock, sqlite_db_file, journal_file, replay_journal
+
+# Most "set" lines loaded per pass, configs up to this size are loaded in one pass
+chunk_lines = 1000
+# Older, low memory platforms get smaller passes
+small_chunk_lines = 300
+small_chunk_models = ('EX2200', 'EX3200', 'EX4200', 'EX4500', 'SRX1', 'SRX2')
 
 ####################
 # ANSWER FUNCTIONS #
@@ -358,11 +369,10 @@ def txt_to_string(src_file):
     else:
         return command_file
 
-# Write database to JSON
+# Write database to JSON, through a temp file so a crash mid-write leaves the previous file whole
 def write_to_json(list_dict, main_list_dict):
     try:
-        with open(main_list_dict, 'w') as fout:
-            json.dump(list_dict, fout)
+        replace_file(main_list_dict, json.dumps(list_dict))
     except Exception as err:
         print "Problem opening or writing to JSON file from database -> ERROR: {0}".format(err)
         return False
@@ -384,22 +394,85 @@ def json_to_listdict(json_file):
         else:
             return list_data
 
+# Load the device database, from SQLite if it has been imported (devicedb.py -i), otherwise from JSON
+def load_device_db(json_file, journal_owner=False):
+    """ Purpose: Load the device database and replay the journal of unsaved changes onto it.
+
+    :param json_file:       -   Path of main_db.json, the SQLite database and journal sit next to it
+    :param journal_owner:   -   True only for the process holding the JournalLock (device_refresh). The owner saves
+                                the replayed changes and empties the journal. Other tools keep the changes in memory
+                                and leave the database and journal as they are, a device_refresh run may be
+                                writing to them.
+    :return:                -   DeviceStore, or False if the database couldn't be read
+    """
+    db_file = sqlite_db_file(json_file)
+    if os.path.exists(db_file):
+        try:
+            list_dict = SqliteDeviceDB(db_file).load()
+        except Exception as err:
+            print "Problem opening or reading from SQLite database -> ERROR: {0}".format(err)
+            return False
+    else:
+        list_dict = json_to_listdict(json_file)
+        if list_dict is False:
+            return False
+        list_dict = DeviceStore(list_dict)
+    # Recover the changes of a run that didn't finish (or that is still running)
+    recovered = replay_journal(list_dict, journal_file(json_file))
+    if recovered and journal_owner:
+        print "Recovered {0} unsaved database changes from the journal".format(recovered)
+        if save_device_db(list_dict, json_file):
+            open(journal_file(json_file), 'w').close()
+    return list_dict
+
+# Write every change to the device database to its journal as it happens
+def open_journal(list_dict, json_file):
+    list_dict.journal = DeviceJournal(journal_file(json_file))
+    return list_dict.journal
+
+# Save the device database and empty its journal
+def checkpoint_device_db(list_dict, json_file):
+    with list_dict.lock:
+        if not save_device_db(list_dict, json_file):
+            return False
+        if list_dict.journal:
+            list_dict.journal.truncate()
+    return True
+
+# Save the device database, writing only the changed records if it came from SQLite
+def save_device_db(list_dict, json_file):
+    if isinstance(list_dict, DeviceStore) and list_dict.backend:
+        try:
+            list_dict.backend.save(list_dict)
+        except Exception as err:
+            print "Problem writing to SQLite database -> ERROR: {0}".format(err)
+            return False
+        else:
+            return True
+    return write_to_json(list_dict, json_file)
+
 
 ##########################
 # MISCELLAEOUS FUNCTIONS #
 ##########################
 
 # Removes a record from the specified list of dictionaries
-def remove_record(listDict, key, value, config_dir):
+def remove_record(listDict, key, value, config_dir, config_index=None):
     """ Purpose: Remove a record from the provided list of dictionaries. 
     NOTE: Removes only the first record found with the specified value.
 
     :param key:         -   The key to search for
     :param value:       -   The value to search for
+    :param config_index:-   ConfigIndex to remove the device's config from, so searches stop matching it
     :return:            -   Returns True/False
     """
     was_changed = False
-    for record in listDict:
+    # The device store finds the matches from its index
+    if isinstance(listDict, DeviceStore):
+        matches = listDict.find_all(key, value)
+    else:
+        matches = [record for record in listDict if record[key] == value]
+    for record in matches:
         # print "Provided: {0} -> Comparing to Key: {1} | Value: {2} --> ".format(listDict[i][key], key, value)
         if record[key] == value:
             # print "Removing: {0}".format(listDict[i])
@@ -408,8 +481,12 @@ def remove_record(listDict, key, value, config_dir):
             # Remove directory
             record_dir = os.path.join(config_dir, getSiteCode(record['hostname']), record['hostname'])
             if os.path.isdir(record_dir):
+                # Write any pending logs of the device before its folder goes
+                flush_logs()
                 if rm_rf(record_dir):
                     print "| Device Directory Removed!"
+            if config_index is not None:
+                config_index.remove(record['hostname'])
             was_changed = True
     if was_changed:
         return listDict
@@ -429,7 +506,9 @@ def get_record(listDict, ip='', hostname='', sn='', code=''):
     """
     has_record = False
     # Make sure listDict has contents
-    if listDict:
+    if isinstance(listDict, DeviceStore):
+        return listDict.get_record(ip, hostname, sn, code)
+    elif listDict:
         if ip:
             for record in listDict:
                 # Make sure this info exists, it may have failed
@@ -939,6 +1018,8 @@ def load_with_pyez(dev, config_temp_dir, conf_file, output_log, ip, hostname, us
             hostname        -   device hostname
             username        -   username for logging in
             password        -   password for username
+        The config is read once and loaded from memory in passes sized by config_chunks(), no temp files are
+        written to config_temp_dir.
     """
     #print "Commands To Be Run:"
     #print conf_file
@@ -974,11 +1055,20 @@ def load_with_pyez(dev, config_temp_dir, conf_file, output_log, ip, hostname, us
         screen_and_log("{0}: ({1}): Locked Configuration.\n".format(ip, hostname), output_log)
 
     # Load the configuration changes
-    file_list = split_large_file(conf_file, config_temp_dir, ip)
+    try:
+        chunk_list = config_chunks(conf_file, dev.facts['model'])
+    except Exception as err:
+        err_message = "Unable to read configuration file"
+        screen_and_log("{0}: ({1}): ERROR - {2}: {3}\n".format(ip, hostname, err_message, err), output_log)
+        try:
+            dev.cu.unlock()
+        except UnlockError:
+            pass
+        return err_message
     pass_num = 1
-    for small_file in file_list:
+    for chunk in chunk_list:
         try:
-            dev.cu.load(path=small_file, merge=True, format="set", ignore_warning=True, timeout=500)
+            dev.cu.load(chunk, merge=True, format="set", ignore_warning=True, timeout=500)
         except ConfigLoadError as err:
             #print "ConfigLoadError: {0}".format(err)
             err_message = "Unable to load configuration [Pass: " + str(pass_num) + "]"
@@ -1052,6 +1142,23 @@ def ping(ip):
         except subprocess.CalledProcessError:
             return False
 
+def tcp_port_open(ip, port, timeout=2):
+    """ Purpose: Determine if a TCP port on an IP accepts connections
+    :param ip: IP address of host to check
+    :param port: TCP port to connect to
+    :param timeout: Seconds to wait for the connection
+    :return: True if the connection was accepted
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((ip, port))
+        return True
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+
 # Get a fact from one of the database records, using t. Could be used for any list_dict.
 # list_dict: database
 # fact: target value
@@ -1059,6 +1166,8 @@ def ping(ip):
 # src_key: key of fact to use to get target
 def get_db_fact(list_dict, fact, src_val, src_key='ip'):
     empty_str = ""
+    if isinstance(list_dict, DeviceStore):
+        list_dict = list_dict.find_all(src_key, src_val)
     for record in list_dict:
         if record[src_key] == src_val:
             if fact in record.keys():
@@ -1076,9 +1185,8 @@ def get_fact(ip, username, password, fact):
         Parameters:
     """
     myfact = ""
-    dev = Device(ip, user=username, password=password)
     try:
-        dev.open()
+        dev = open_device(ip, username, password)
     except Exception as err:
         print("Unable to open connection to: {0} | ERROR: {1}").format(ip, err)
         return False
@@ -1101,53 +1209,27 @@ def get_fact(ip, username, password, fact):
 # FILE OPERATIONS FUNCTIONS #
 #############################
 
-# Breaks up a large configuration file into multiple configuration files
-def split_large_file(conf_file, dest_path, ip):
-    lc = len(open(conf_file).readlines())
-    lines_per_file = 300
-    file_list = []
-    line_list = []
-    file_num = 1
-    total_line_num = 0
-
-    # Make sure this config file is large enough to be broken up
-    if lc > lines_per_file:
-        with open(conf_file) as bigfile:
-            line_num = 1
-            for bigline in bigfile:
-                total_line_num += 1
-                line_list.append(bigline.strip())
-                # If we are on the last line of this file or we are at the max line size
-                if total_line_num == lc or line_num == lines_per_file:
-                    file_fp = create_conf_file(file_num, line_list, dest_path, ip)
-                    if file_fp:
-                        file_list.append(file_fp)
-                        file_num += 1
-                    # Reset line_num
-                    line_num = 1
-                # Otherwise, we are just appending this line and incrementing line_num
-                else:
-                    line_num += 1
-        # Return the file list
-        #print "File List: {0}".format(file_list)
-        return file_list
-    # If its less than the line count, then just use the config file as is
-    else:
-        file_list.append(conf_file)
-        return file_list
-
-# Creates a small configuration file
-def create_conf_file(file_num, line_list, dest_path, ip):
-    # Create a file template for small files
-    smallfile = 'sf_{0}_{1}.txt'.format(ip, file_num)
-    smallfile_fp = os.path.join(dest_path, smallfile)
-    try:
-        list_to_txt(smallfile_fp, line_list)
-    except Exception as err:
-        print "Error creating small file: {0}".format(err)
-        return False
-    else:
-        return smallfile_fp
+# Lines per load pass for a config of this size on this model
+def chunk_size(line_count, model=''):
+    limit = chunk_lines
+    if model and str(model).upper().startswith(small_chunk_models):
+        limit = small_chunk_lines
+    # Spread the lines evenly over the passes, rather than leaving a small last pass
+    passes = int(math.ceil(line_count / float(limit))) or 1
+    return int(math.ceil(line_count / float(passes))) or 1
+
+# Breaks up a large configuration file into "set" command strings that can be loaded one after another
+def config_chunks(conf_file, model=''):
+    """ Purpose: Read the configuration file once and split it in memory into load passes.
+
+    :param conf_file:   -   Path of the configuration file
+    :param model:       -   Model of the device, older platforms get smaller passes
+    :return:            -   List of configuration strings
+    """
+    with open(conf_file) as bigfile:
+        line_list = [line.strip() for line in bigfile if line.strip()]
+    size = chunk_size(len(line_list), model)
+    return ["\n".join(line_list[start:start + size]) for start in range(0, len(line_list), size)]
 
 # Return list of files from a directory with an optional extension filter
 def getFileList(mypath, ext_filter=False):
@@ -1223,29 +1305,13 @@ def screen_and_log(statement, file_list):
     else:
         log_only(statement, file_list)
 
-# Append output to log file only
+# Append output to log file only, buffered by logsink until a whole line (or more) is ready
 def log_only(statement, logfile):
-    # Print to log
-    #print "Log File: {0}".format(logfile)
-    try:
-        logobj = open(logfile, 'a')
-    except Exception as err:
-        print "Error opening log file {0}".format(err)
-    else:
-        logobj.write(statement)
-        logobj.close()
+    write_log(statement, logfile)
 
-# Append output to log file only
+# Append output to log file only, buffered by logsink until a whole line (or more) is ready
 def print_log(statement, logfile):
-    # Print to log
-    # print "Log File: {0}".format(logfile)
-    try:
-        logobj = open(logfile, 'a')
-    except Exception as err:
-        print "Error opening log file {0}".format(err)
-    else:
-        logobj.write(statement)
-        logobj.close()
+    write_log(statement, logfile)
 
 # Print output to the screen and a log file (either a list or string)
 def print_sl(statement, file_list):